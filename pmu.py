@@ -3,10 +3,11 @@
 # System imports
 import argparse
 from argparse import RawTextHelpFormatter
+import signal
 import sys
 
-# PMU imports
-from pmu_cli import *
+# PMU imports; the CLI is only imported when needed, clients stay light
+from pmu_serve import *
 
 if __name__ == '__main__':
     versionString = 'v2.0.0'
@@ -17,16 +18,40 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description=descriptionText, formatter_class=RawTextHelpFormatter)
     parser.add_argument('-c', '--conf',    help='PMU configuration filename. If omited, pmu.conf will be loaded.')
     parser.add_argument('-v', '--version', help='Display version.', action='store_true')
+    parser.add_argument('-s', '--serve',   help='Serve the PMU shell on a Unix socket, keeping files and\n'
+                                                'buffers loaded between requests.', action='store_true')
+    parser.add_argument('-e', '--send',    help='Run a command on the PMU server and print its output.\n'
+                                                'May be repeated; commands run in order.',
+                                           action='append', metavar='CMD')
+    parser.add_argument('--socket',        help='Server socket. If omited, pmu.sock is used.', default='pmu.sock')
     args = parser.parse_args()
 
     if args.version:
         print('PMU {}'.format(versionString))
         sys.exit()
 
+    if args.send:
+        sys.exit(0 if send(args.socket, args.send) else 1)
+
+    from pmu_cli import *
+
     cli = pmuCLI()
     cli.descriptionText = descriptionText
     cli.versionString = versionString
     cli.confFilePath = args.conf if args.conf is not None else 'pmu.conf'
-    cli.run()
+    if args.serve:
+        cli.start()
+        server = pmuServer(cli, args.socket)
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        print('Serving PMU on {}. Press Ctrl+C to stop.'.format(server.path))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            print('')
+        finally:
+            server.server_close()
+            cli.stop()
+    else:
+        cli.run()
 
 
@@ -2,21 +2,34 @@ from collections import OrderedDict
 from enum import Enum
 from typing import Union
 
+import numpy as np
+
+import itertools
+import threading
 import re
 import sys
 import os
 
 
 class BuffType(Enum):
-    NONE, GRID, HMAP, GCOD, EXCE = range(5)
+    NONE, GRID, HMAP, GCOD, EXCE, GERB = range(6)
 
 
 class GenericBuffer(object):
+    """
+    List of blocks.
+    Iterators are independent of each other, and indexing with a slice returns a
+    BufferView sharing the buffer's storage. Clearing or replacing the contents
+    swaps in a new list, so iterators and views taken before keep seeing the
+    previous contents; appends are visible to running iterators.
+    Changes are serialized by the buffer's lock, which consumers may also hold
+    to keep the buffer from changing over several operations.
+    """
     def __init__(self, type = BuffType.NONE):
         self.__data   = list()
         self.__type   = type
-        self.__size   = 0
-        self.__i      = 0
+        self.__version = 0
+        self.__lock   = threading.RLock()
 
     @property
     def data(self):
@@ -26,8 +39,23 @@ class GenericBuffer(object):
     def data(self, value):
         if type(value) is not list:
             raise TypeError
-        self.__data = value
-        self.__size   = len(value)
+        with self.__lock:
+            self.__data = value
+            self.modified()
+
+    @property
+    def version(self) -> int:
+        """ Bumped whenever the buffer's contents change. """
+        return self.__version
+
+    @property
+    def lock(self) -> threading.RLock:
+        return self.__lock
+
+    def modified(self):
+        """ Marks the buffer contents as changed. """
+        with self.__lock:
+            self.__version += 1
 
     @property
     def type(self):
@@ -35,35 +63,145 @@ class GenericBuffer(object):
 
     @property
     def size(self):
-        return self.__size
+        return len(self.__data)
 
     def __str__(self):
-        return "<" + self.__type.name + ": " + str(self.__size) + ">"
+        return "<" + self.__type.name + ": " + str(self.size) + ">"
+
+    def __len__(self):
+        return self.size
 
     def __iter__(self):
-        self.__i = 0
-        return self
+        return iter(self.__data)
 
-    def __next__(self):
-        if self.__i < self.__size:
-            self.__i += 1
-            return self.__data[self.__i - 1]
-        else:
-            raise StopIteration
+    def __getitem__(self, item):
+        if type(item) is slice:
+            data = self.__data
+            return BufferView(data, range(len(data))[item], self.__type)
+        return self.__data[item]
 
-    def current(self):
-        return self.__data[self.__i]
+    def chunks(self, size: int):
+        """ Iterates over consecutive views of (at most) size blocks. """
+        if size < 1:
+            raise ValueError('Chunk size must be positive.')
+        n = len(self)
+        for i in range(0, n, size):
+            yield self[i:min(i + size, n)]
 
     def append(self, value):
-        self.__data.append(value)
-        self.__size = len(self.__data)
+        with self.__lock:
+            self.__data.append(value)
+            self.__version += 1
 
     def clear(self):
-        self.__data.clear()
-        self.__size = 0
+        with self.__lock:
+            self.__data = list()
+            self.__version += 1
+
+    def empty(self) -> bool:
+        return self.size == 0
+
+
+class BufferView(object):
+    """
+    Read-only window over a range of a buffer's blocks, sharing its storage.
+    """
+    def __init__(self, data: list, rng: range, type=BuffType.NONE):
+        self.__data  = data
+        self.__range = rng
+        self.__type  = type
+
+    @property
+    def type(self):
+        return self.__type
+
+    @property
+    def size(self):
+        return len(self.__range)
+
+    @property
+    def data(self) -> list:
+        """ Copy of the viewed blocks. """
+        r = self.__range
+        if r.step == 1:
+            return self.__data[r.start:r.stop]
+        return [self.__data[i] for i in r]
+
+    def __str__(self):
+        return "<" + self.__type.name + " view: " + str(self.size) + ">"
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        r = self.__range
+        if r.step == 1:
+            return itertools.islice(self.__data, r.start, r.stop)
+        return (self.__data[i] for i in r)
+
+    def __getitem__(self, item):
+        if type(item) is slice:
+            return BufferView(self.__data, self.__range[item], self.__type)
+        return self.__data[self.__range[item]]
 
     def empty(self) -> bool:
-        return self.__size == 0
+        return self.size == 0
+
+
+class FixedPoint(object):
+    """
+    Coordinates as integer counts of 10^-digits mm (digits=3: microns).
+    Buffers keep coordinates in mm; values snapped to this grid compare and hash
+    exactly, parse without float round-off and format with integer arithmetic.
+    """
+    def __init__(self, digits=4):
+        self.__digits = int(digits)
+        self.__scale  = 10 ** self.__digits
+
+    @property
+    def digits(self) -> int:
+        return self.__digits
+
+    @property
+    def scale(self) -> int:
+        return self.__scale
+
+    def units(self, v) -> int:
+        """ Nearest count of units to v (mm). """
+        return int(round(v * self.__scale))
+
+    def mm(self, u) -> float:
+        return u / self.__scale
+
+    def snap(self, v) -> float:
+        """ v rounded to the grid; same result as numpy.round(v, digits). """
+        return round(v * self.__scale) / self.__scale
+
+    def parse(self, s: str, exp=0, mul=1, div=1) -> int:
+        """
+        Units of the decimal number s * 10^exp * mul/div (mm), rounded once (half away
+        from zero) using integer arithmetic only.
+        """
+        i, _, f = s.strip().partition('.')
+        sign = i[:1] if i[:1] in ('+', '-') else ''
+        i = i[len(sign):]
+        if not (i + f).isdigit():
+            raise ValueError('could not convert string to number: {}'.format(s))
+        n = int(i + f) * mul
+        e = self.__digits + exp - len(f)
+        if e > 0:
+            n *= 10 ** e
+        else:
+            div *= 10 ** -e
+        q, r = divmod(n, div)
+        q += 2 * r >= div
+        return -q if sign == '-' else q
+
+    def format(self, u: int) -> str:
+        """ Shortest decimal representation (mm) of u units. """
+        q, r = divmod(abs(u), self.__scale)
+        s = ('%d.%0*d' % (q, self.__digits, r)).rstrip('0').rstrip('.') if r else '%d' % q
+        return '-' + s if u < 0 else s
 
 
 class GridBuffer(GenericBuffer):
@@ -72,19 +210,34 @@ class GridBuffer(GenericBuffer):
 
 
 class GCodeBuffer(GenericBuffer):
+    """
+    GCode lines. Motion blocks are tuples (g, f, x, y, z) for G00/G01 and
+    (g, f, x, y, z, i, j, r) for G02/G03 arcs, None marking omitted words;
+    any other line is kept as a string. A string without line break is a prefix:
+    words written on the line of the motion block following it.
+    """
     def __init__(self):
         GenericBuffer.__init__(self, BuffType.GCOD)
+        self.__modal  = (None, None)  # (version, every) and ModalIndex built for them
+        self.__source = (None, None)  # version and first entry of each source file line
 
     @staticmethod
     def is_motion(bl) -> bool:
-        return type(bl) is tuple and len(bl) == 5 and \
+        return type(bl) is tuple and len(bl) in (5, 8) and \
                all([isinstance(i,(int,float,type(None))) for i in bl])
 
+    @staticmethod
+    def is_arc(bl) -> bool:
+        return GCodeBuffer.is_motion(bl) and len(bl) == 8
+
     @staticmethod
     def get_motion_params(bl) -> Union[dict, None]:
         if not GCodeBuffer.is_motion(bl):
             return None
-        return {'g': bl[0], 'f': bl[1], 'x': bl[2], 'y': bl[3], 'z': bl[4]}
+        d = {'g': bl[0], 'f': bl[1], 'x': bl[2], 'y': bl[3], 'z': bl[4]}
+        if len(bl) == 8:
+            d.update({'i': bl[5], 'j': bl[6], 'r': bl[7]})
+        return d
 
     @staticmethod
     def get_gc(bl): return bl[0]
@@ -95,13 +248,377 @@ class GCodeBuffer(GenericBuffer):
     @staticmethod
     def get_pt(bl): return [bl[2], bl[3], bl[4]]
 
+    @staticmethod
+    def get_arc(bl): return [bl[5], bl[6], bl[7]]
+
+    def motion_table(self, initialcoord=(0.0, 0.0, 0.0)):
+        """
+        Resolves the absolute start and end coordinates of every motion block.
+        Omitted (modal) coordinates are pulled from the previous motion.
+        :param initialcoord: Machine coordinates [x y z] before the first block.
+        :return: MotionTable of the buffer.
+        """
+        return MotionTable(self, initialcoord)
+
+    def modal_index(self, every=1000):
+        """
+        Modal state checkpoints of the buffer; built once per buffer version.
+        :param every: Blocks between checkpoints.
+        :return: ModalIndex of the buffer.
+        """
+        with self.lock:
+            key = (self.version, every)
+            if self.__modal[0] != key:
+                self.__modal = (key, ModalIndex(self.data, every))
+            return self.__modal[1]
+
+    def set_source_lines(self, starts: list):
+        """
+        Records which lines of a source file the current contents come from.
+        :param starts: Index of the first entry of every source line (line n at n - 1).
+        """
+        with self.lock:
+            if starts and not 0 <= starts[0] <= starts[-1] < self.size:
+                raise ValueError('Source line entries out of the buffer.')
+            self.__source = (self.version, starts)
+
+    def source_lines(self) -> Union[list, None]:
+        """ See set_source_lines; None if not recorded, or if the buffer changed since. """
+        with self.lock:
+            return self.__source[1] if self.__source[0] == self.version else None
+
+
+class ModalIndex(object):
+    """
+    Modal state of a GCode program, checkpointed every `every` blocks: the state before
+    any line is the closest checkpoint's, updated by less than `every` blocks.
+    A state is a list indexed like `fields`: position, motion mode, feed, spindle
+    (3, 4 or 5 for M03, M04, M05) and speed, units (20 or 21), distance mode (90 or 91)
+    and tool. Values never set are None.
+    """
+    fields = ['x', 'y', 'z', 'g', 'f', 'spindle', 'speed', 'units', 'distance', 'tool']
+    X, Y, Z, G, F, SPINDLE, SPEED, UNITS, DISTANCE, TOOL = range(10)
+
+    __comment = re.compile('\\(.*?\\)|;.*')
+    __word    = re.compile('([A-Z])\\s*([+-]?[0-9]*\\.?[0-9]*)')
+
+    def __init__(self, data: list, every=1000):
+        self.__data  = data
+        self.__every = max(int(every), 1)
+        self.__checkpoints = list()
+        state = [None] * len(self.fields)
+        for k, bl in enumerate(data):
+            if k % self.__every == 0:
+                self.__checkpoints.append(list(state))
+            self.update(state, bl)
+
+    @property
+    def every(self) -> int:
+        return self.__every
+
+    @property
+    def size(self) -> int:
+        return len(self.__data)
+
+    def state(self, k: int) -> list:
+        """ State before block k (k == size gives the state at the end). """
+        if not 0 <= k <= len(self.__data):
+            raise IndexError('line {} is out of range.'.format(k + 1))
+        c = min(k // self.__every, len(self.__checkpoints) - 1) if self.__checkpoints else -1
+        if c < 0:
+            return [None] * len(self.fields)
+        state = list(self.__checkpoints[c])
+        for bl in self.__data[c * self.__every:k]:
+            self.update(state, bl)
+        return state
+
+    @classmethod
+    def update(cls, state: list, bl):
+        """ Updates state with the effect of block bl. """
+        if type(bl) is tuple:
+            state[cls.G] = bl[0]
+            if bl[1] is not None:
+                state[cls.F] = bl[1]
+            for a in range(3):
+                if bl[2 + a] is not None:
+                    state[cls.X + a] = bl[2 + a]
+            return
+        words = cls.__word.findall(cls.__comment.sub('', bl).upper())
+        if not words:
+            return
+        motion = True  # axis words move the tool, unless another G code uses them
+        for c, v in words:
+            try:
+                n = float(v)
+            except ValueError:
+                continue
+            if c == 'G':
+                if n in (0, 1, 2, 3):
+                    state[cls.G] = int(n)
+                elif n in (20, 21):
+                    state[cls.UNITS] = int(n)
+                elif n in (90, 91):
+                    state[cls.DISTANCE] = int(n)
+                elif n not in (17, 18, 19, 40, 49, 54, 94, 80):
+                    motion = False
+            elif c == 'M' and n in (3, 4, 5):
+                state[cls.SPINDLE] = int(n)
+            elif c == 'S':
+                state[cls.SPEED] = n
+            elif c == 'T':
+                state[cls.TOOL] = int(n)
+            elif c == 'F':
+                state[cls.F] = n
+        if motion:
+            for c, v in words:
+                if c in 'XYZ':
+                    try:
+                        state[cls.X + 'XYZ'.index(c)] = float(v)
+                    except ValueError:
+                        pass
+
+
+class MotionTable(object):
+    """
+    Array view of the motion blocks of a GCodeBuffer, with modal values resolved.
+    index:  position of each motion block in the buffer
+    other:  position of each non-motion line in the buffer
+    g, f:   motion code and programmed feed (nan if omitted) per block
+    arc:    True for G02/G03 blocks (start and end are those of the arc)
+    feed:   modal feed active for each block (nan if none was set yet)
+    start:  Mx3 absolute [x y z] at the start of each block
+    end:    Mx3 absolute [x y z] at the end of each block
+    """
+    def __init__(self, gcodebuff, initialcoord=(0.0, 0.0, 0.0)):
+        data = gcodebuff.data
+        motion = np.fromiter((type(bl) is tuple for bl in data), dtype=bool, count=len(data))
+        self.index = np.flatnonzero(motion)
+        self.other = np.flatnonzero(~motion)
+        raw = [data[i] for i in self.index.tolist()]
+        self.arc   = np.fromiter((len(bl) == 8 for bl in raw), dtype=bool, count=len(raw))
+        raw = [bl[0:5] for bl in raw]
+
+        # g, f, x, y, z; None becomes nan
+        raw = np.array(raw, dtype=float).reshape(-1, 5)
+        self.g = raw[:, 0]
+        self.f = raw[:, 1]
+        self.feed = MotionTable.forward_fill(raw[:, 1], np.nan)
+        self.end = np.empty((raw.shape[0], 3))
+        for a in range(3):
+            self.end[:, a] = MotionTable.forward_fill(raw[:, 2 + a], float(initialcoord[a]))
+        self.start = np.empty_like(self.end)
+        self.start[0:1] = [float(i) for i in initialcoord]
+        self.start[1:]  = self.end[:-1]
+
+    @property
+    def size(self) -> int:
+        return self.index.size
+
+    @staticmethod
+    def forward_fill(col, initial):
+        """ Replaces nan entries by the last valid value (or initial, if none). """
+        col = np.concatenate(([initial], col))
+        valid = np.where(np.isnan(col), 0, np.arange(col.size))
+        valid[0] = 0
+        return col[np.maximum.accumulate(valid)][1:]
+
 
 class HMapBuffer(GenericBuffer):
     def __init__(self):
         GenericBuffer.__init__(self, BuffType.HMAP)
 
 
+class GerberBuffer(GenericBuffer):
+    """
+    Graphical objects of a Gerber layer, in drawing order, in mm:
+    ('L', dark, aperture, x0, y0, x1, y1) for lines (arcs are stored as runs of lines),
+    ('F', dark, aperture, x, y) for flashes and ('P', dark, points) for regions,
+    points being a list of [x y] vertices. dark is False for clear polarity objects.
+    Apertures are ('C', d), ('R', w, h) or ('O', w, h).
+    """
+    def __init__(self):
+        GenericBuffer.__init__(self, BuffType.GERB)
+
+    @staticmethod
+    def extent(ob) -> tuple:
+        """ (xmin, xmax, ymin, ymax) covered by an object. """
+        if ob[0] == 'P':
+            p = np.asarray(ob[2], dtype=float)
+            return p[:, 0].min(), p[:, 0].max(), p[:, 1].min(), p[:, 1].max()
+        ap = ob[2]
+        hw, hh = (ap[1] / 2.0, ap[1] / 2.0) if ap[0] == 'C' else (ap[1] / 2.0, ap[2] / 2.0)
+        x0, y0 = ob[3], ob[4]
+        x1, y1 = (ob[5], ob[6]) if ob[0] == 'L' else (x0, y0)
+        return min(x0, x1) - hw, max(x0, x1) + hw, min(y0, y1) - hh, max(y0, y1) + hh
+
+    @property
+    def bbox(self) -> Union[tuple, None]:
+        """ (xmin, xmax, ymin, ymax) of the dark objects, or None if there are none. """
+        e = np.array([self.extent(ob) for ob in self.data if ob[1]]).reshape(-1, 4)
+        if e.shape[0] == 0:
+            return None
+        return e[:, 0].min(), e[:, 1].max(), e[:, 2].min(), e[:, 3].max()
+
+
 class ExcellonBuffer(GenericBuffer):
+    """
+    Drills, stored as an Nx3 float array of [tool x y] rows, sorted by tool.
+    The tool column indexes the tool table (tool numbers and diameters).
+    Iterating yields [diam x y] entries.
+    Appended drills are held apart and sorted in on the next read, so appending many
+    drills costs a single sort; both happen under the buffer's lock.
+    Reads (data, xy, by_tool, slices) are read-only views of the drills; mirror and
+    translate return new buffers, leaving this one untouched.
+    """
+    T, X, Y = range(3)
+
     def __init__(self):
         GenericBuffer.__init__(self, BuffType.EXCE)
+        self.__array  = np.zeros((0, 3))
+        self.__pending = list()                     # appended [tool x y] rows, not sorted in yet
+        self.__toolno = np.zeros(0, dtype=np.int64)  # tool number, per tool index
+        self.__diam   = np.zeros(0)                  # diameter (mm), per tool index
+        self.__first  = np.zeros(1, dtype=np.int64)  # first row of each tool index (and end)
+
+    def load(self, tools: dict, drills):
+        """
+        :param tools: Tool number -> diameter (mm).
+        :param drills: Nx3 [tool_number x y] rows (or a flat sequence of such triples).
+        """
+        drills = np.array(drills, dtype=float).reshape(-1, 3)
+        toolno = np.array(sorted(tools), dtype=np.int64)
+        idx = np.searchsorted(toolno, drills[:, self.T].astype(np.int64))
+        if drills.shape[0] and (idx.max() >= toolno.size or np.any(toolno[idx] != drills[:, self.T])):
+            raise ValueError('Drill with undefined tool.')
+        drills[:, self.T] = idx
+        with self.lock:
+            self.__toolno = toolno
+            self.__diam   = np.array([tools[t] for t in toolno], dtype=float)
+            self.__set(drills[np.argsort(idx, kind='stable')])
+
+    def __set(self, drills):
+        with self.lock:
+            self.__pending = list()
+            self.__sort_in(drills)
+            self.modified()
+
+    def __sort_in(self, drills):
+        drills.flags.writeable = False
+        self.__array = drills
+        self.__first = np.searchsorted(drills[:, self.T], np.arange(self.__toolno.size + 1), side='left')
+
+    @property
+    def __drills(self) -> np.ndarray:
+        """ The drill rows, with the appended ones sorted in. """
+        with self.lock:
+            if self.__pending:
+                d = np.vstack((self.__array, self.__pending))
+                self.__pending = list()
+                self.__sort_in(d[np.argsort(d[:, self.T], kind='stable')])
+            return self.__array
+
+    def __derive(self, drills) -> 'ExcellonBuffer':
+        """ New buffer with the same tool table and the given (tool sorted) drills. """
+        b = ExcellonBuffer()
+        b.__toolno = self.__toolno
+        b.__diam   = self.__diam
+        b.__set(drills)
+        return b
+
+    @property
+    def data(self) -> np.ndarray:
+        """ Read-only Nx3 [tool x y] array. """
+        return self.__drills
+
+    @property
+    def size(self):
+        with self.lock:
+            return self.__array.shape[0] + len(self.__pending)
+
+    @property
+    def tools(self) -> OrderedDict:
+        """ Tool number -> diameter (mm). """
+        return OrderedDict(zip(self.__toolno.tolist(), self.__diam.tolist()))
+
+    @property
+    def diameters(self) -> np.ndarray:
+        """ Diameter of each drill. """
+        with self.lock:
+            return self.__diam[self.__drills[:, self.T].astype(np.int64)]
+
+    @property
+    def xy(self) -> np.ndarray:
+        """ Read-only Nx2 [x y] view of the drill positions. """
+        return self.__drills[:, self.X:self.Y + 1]
+
+    def __iter__(self):
+        return iter(np.column_stack((self.diameters, self.xy)).tolist())
+
+    def __getitem__(self, item):
+        """
+        Integer indices give the [diam x y] drill; slices give an ExcellonBuffer
+        viewing the selected rows (the tool order must be kept, i.e. step > 0).
+        """
+        if type(item) is slice:
+            if item.step is not None and item.step < 0:
+                raise ValueError('Drill views keep the tool order.')
+            with self.lock:
+                return self.__derive(self.__drills[item])
+        with self.lock:
+            d = self.__drills[item]
+            return [float(self.__diam[int(d[self.T])]), float(d[self.X]), float(d[self.Y])]
+
+    def append(self, value):
+        """ Appends a [diam x y] drill, reusing (or adding) a tool of that diameter. """
+        diam, x, y = [float(i) for i in value]
+        with self.lock:
+            i = np.flatnonzero(self.__diam == diam)
+            if i.size:
+                i = int(i[0])
+            else:
+                # New tool numbers come last, so tool indices stay sorted
+                i = self.__toolno.size
+                self.__toolno = np.append(self.__toolno, (self.__toolno[-1] if i else 0) + 1)
+                self.__diam   = np.append(self.__diam, diam)
+            self.__pending.append([i, x, y])
+            self.modified()
+
+    def clear(self):
+        with self.lock:
+            self.__toolno = np.zeros(0, dtype=np.int64)
+            self.__diam   = np.zeros(0)
+            self.__set(np.zeros((0, 3)))
+
+    def by_tool(self, tool: int) -> np.ndarray:
+        """ Read-only view of the [tool x y] rows drilled with tool number `tool`. """
+        with self.lock:
+            drills = self.__drills
+            i = np.searchsorted(self.__toolno, tool)
+            if i >= self.__toolno.size or self.__toolno[i] != tool:
+                return drills[0:0]
+            return drills[self.__first[i]:self.__first[i + 1]]
+
+    def bbox(self) -> list:
+        """ [xmin xmax ymin ymax] of the drill positions (not accounting for diameters). """
+        if self.size == 0:
+            return [0.0, 0.0, 0.0, 0.0]
+        lo = self.xy.min(axis=0)
+        hi = self.xy.max(axis=0)
+        return [float(lo[0]), float(hi[0]), float(lo[1]), float(hi[1])]
+
+    def mirror(self, axis, value) -> 'ExcellonBuffer':
+        """
+        New buffer with the `axis` coordinate mirrored about axis = value.
+        :param axis: 'x', 'y' or 0, 1.
+        """
+        a = self.X + ['x', 'y'].index(axis) if axis in ['x', 'y'] else self.X + int(axis)
+        drills = self.__drills.copy()
+        drills[:, a] = 2.0 * value - drills[:, a]
+        return self.__derive(drills)
 
+    def translate(self, dx, dy) -> 'ExcellonBuffer':
+        """ New buffer with all drills moved by [dx dy]. """
+        drills = self.__drills.copy()
+        drills[:, self.X] += dx
+        drills[:, self.Y] += dy
+        return self.__derive(drills)
@@ -1,10 +1,16 @@
 import re
 import sys
+import time
 import random
 
 from collections import OrderedDict
 from pmu_planner   import *
 from pmu_view      import *
+from pmu_watch     import *
+from pmu_jobs      import *
+from pmu_log       import getLogger, console, set_level, levels
+
+log = getLogger('cli')
 
 class pmuCLI:
     """
@@ -33,19 +39,73 @@ class pmuCLI:
                                                  "Usage: set <varname> <value>", 2)
         self.register_command(self.del_variable, 'del', 'Remove variable from workspace.', "Usage: del <varname>", 1)
         self.register_command(self.load,         'load', 'Load and parse external files.',
-                                                 "Usage: load [drl|hmap|fcu|bcu]\n"
-                                                 "       load gcode <varname>", 1)
+                                                 "Usage: load [drl|hmap|fcu|bcu|reg|gbr]\n"
+                                                 "       load [gcode|bcu|reg|gbr] <varname>\n"
+                                                 "bcu: back copper GCode; reg: registration probes of the flipped board;\n"
+                                                 "gbr: Gerber copper layer (gerber_path), see isolate.", 1, True)
         self.register_command(self.unload, 'unload', 'Unload selected active file.',
-                                                 "Usage: load [drl|hmap|fcu|bcu|gcode]", 1)
+                                                 "Usage: unload [drl|hmap|fcu|bcu|reg|gbr|gcode]", 1)
         self.register_command(self.write,  'write',  'Write work buffer to file.',
                                                  "Usage: write <varname>", 1)
         self.register_command(self.level,  'level',  'Apply leveling to GCode.',
-                                                 "Usage: level [file|buffer]")
+                                                 "Usage: level [file|buffer]\n"
+                                                 "       level bcu\tLevel back copper with the mirrored and inverted heightmap\n"
+                                                 "                \t(corrected by the registration probes, if loaded).\n"
+                                                 "       level mesh [file|buffer]\tLeave the GCode as is, preceded by the heightmap\n"
+                                                 "                \tresampled as a firmware mesh (mesh_fw, mesh_size, mesh_lims).", 0, True)
+        self.register_command(self.crop,   'crop',  'Crop GCode to a region or tile.',
+                                                 "Usage: crop [file|buffer]                \tCrop to crop_lims.\n"
+                                                 "       crop tile <col> <row> [file|buffer]\tCrop to a tile of crop_tiles.", 0, True)
+        self.register_command(self.check,  'check', 'Check heightmap for bad probes.',
+                                                 "Usage: check        \tFit surface, report tilt/bow and outliers.\n"
+                                                 "       check reprobe\tSet work buffer to a grid of the outliers.\n"
+                                                 "       check reject \tReplace outliers by the fitted surface.")
+        self.register_command(self.optimize, 'optimize', 'Reorder GCode cut groups to reduce rapid travel.',
+                                                 "Usage: optimize [file|buffer]", 0, True)
+        self.register_command(self.isolate, 'isolate', 'Generate isolation GCode from the Gerber copper layer.',
+                                                 "Usage: isolate\n"
+                                                 "Contours copper at iso_tool/2 (plus iso_passes - 1 passes overlapping by\n"
+                                                 "iso_overlap), cutting at iso_depth and iso_feed. The copper raster (iso_res)\n"
+                                                 "is kept, so changing the tool only redoes the contours.", 0, True)
+        self.register_command(self.drill,  'drill', 'Generate drilling GCode from the Excellon file.',
+                                                 "Usage: drill\n"
+                                                 "Holes are drilled per tool in a short tour; depths follow the heightmap.", 0, True)
+        self.register_command(self.estimate, 'estimate', 'Estimate machine run time of GCode.',
+                                                 "Usage: estimate [file|buffer]\n"
+                                                 "Also reports the time added by leveling, once GCode was leveled.", 0, True)
+        self.register_command(self.watch,  'watch', 'Re-level and write GCode whenever input files change.',
+                                                 "Usage: watch [poll]\n"
+                                                 "Watches fcu_path, hmap_path and excellon_path; changed files are\n"
+                                                 "parsed again, fcu is leveled and written to gcode_out.\n"
+                                                 "Uses inotify where available, `poll` forces stat polling.\n"
+                                                 "Press Ctrl+C to stop.")
+        self.register_command(self.resume, 'resume', 'Restart GCode from a line, restoring its modal state.',
+                                                 "Usage: resume <line> [buffer|file]\n"
+                                                 "Defaults to the work buffer if it holds GCode, else the loaded GCode.\n"
+                                                 "<line> is a line of the GCode file, also once leveled.\n"
+                                                 "The work buffer is set to a safe preamble followed by the program from <line>.", 1, True)
+        self.register_command(self.undo,   'undo', 'Restore the previous work buffer.', '')
+        self.register_command(self.redo,   'redo', 'Restore the work buffer undone last.', '')
+        self.register_command(self.history, 'history', 'List or compare work buffer versions.',
+                                                 "Usage: history             \tList versions; * marks the current one.\n"
+                                                 "       history diff [a] [b]\tCompare versions a and b (default: previous and current).")
         self.register_command(self.probe,  'probe', 'Generate grid and execute probing.',
                                                  "Usage: probe [grid]\tGenerate grid.\n"
-                                                 "       probe run   \tConnect to CNC and execute probing.")
+                                                 "       probe reg   \tGenerate back side registration points.\n"
+                                                 "       probe run   \tProbe the grid with the CNC (probe_port), into hmap_path.\n"
+                                                 "Probed points are logged as they come; an interrupted run\n"
+                                                 "resumes where it stopped.", 0, True)
+        self.register_command(self.jobs,   'jobs', 'List background jobs.', '')
+        self.register_command(self.wait,   'wait', 'Wait for a job, showing its progress.',
+                                                 "Usage: wait [id]\tDefaults to the running job.\n"
+                                                 "Press Ctrl+C to cancel the job.")
+        self.register_command(self.cancel, 'cancel', 'Cancel a job.',
+                                                 "Usage: cancel [id]\tDefaults to the running job.\n"
+                                                 "Buffers are left as they were before the job started.")
         self.register_command(self.view,   'view', 'Visualize data.',
                                                  "Usage: view [drl|drltol|probe|new|clear|grid]\n"
+                                                 "       view [hmap3d|path3d]\tHeightmap surface, toolpath (work buffer\n"
+                                                 "                           \tif it holds GCode, else the loaded GCode).\n"
                                                  "Multiple parameters can be combined at once.", 1)
 
         # PMU Model objects
@@ -54,41 +114,106 @@ class pmuCLI:
         self.hmapParser     = HMapParser()
         self.Planner        = pmuPlanner()
         self.gcodeParser    = GCodeParser()
+        self.bcuParser      = GCodeParser()
+        self.regParser      = HMapParser()
+        self.gerberParser   = GerberParser()
         self.View           = pmuView()
+        self.Jobs           = JobManager()
+        # Messages of every component are printed as they come; those of jobs with their output
+        console()
+
+        # Components follow the configuration parameters; each change is handed over once
+        for ws in [self.Planner.Leveler, self.Planner.Cropper, self.Planner.Optimizer,
+                   self.Planner.HMapChecker, self.Planner.Estimator, self.Planner.History,
+                   self.Planner.Driller, self.Planner.BackSide, self.Planner.Resumer,
+                   self.Planner.Isolator, self.Planner.Prober, self.Planner.Mesher, self.View]:
+            self.pmuConfParser.subscribe(ws)
 
     def run(self):
+        self.start()
+        print(self.greetingText)
+
+        while True:
+            self.__announce_jobs()
+            try:
+                liin = input('pmu> ')
+            except KeyboardInterrupt:
+                print('')
+                continue
+            self.execute(liin)
+
+    def start(self):
+        """ Parses the project configuration and loads the files it declares. """
+        # What jobs and served commands print is routed from here on, until stop
+        self.Jobs.install()
         # Parse project configuration; exits on error
         self.pmuConfParser.parse_file(self.confFilePath)
+        self.__set_log_level()
         # If excellon file was declared, try to parse it:
         self.load(['drl'])
         # If heightmap file was declared, try to parse it:
         self.load(['hmap'])
         # If frontcopper was declared, try to load it:
         self.load(['fcu'])
+        # Back copper is optional
+        if 'bcu_path' in self.pmuConfParser.param:
+            self.load(['bcu'])
 
-        print(self.greetingText)
+    def execute(self, liin: str):
+        """
+        Executes one command line; job commands are waited for, unless followed by &.
+        """
+        self.__announce_jobs()
+        # A trailing & runs the command in the background
+        background = liin.strip().endswith('&')
+        argv = liin.strip().rstrip('&').strip().split(' ')
+        # argv = re.findall(r"[\w']+", liin)
+        argc = len(argv) - 1 # exclude command itself
 
-        while True:
-            liin = input('pmu> ')
-            argv = liin.strip().split(' ')
-            # argv = re.findall(r"[\w']+", liin)
-            argc = len(argv) - 1 # exclude command itself
+        self.cmd = argv[0]
+        self.arg = argv[1:] if argc > 0 else []
 
-            self.cmd = argv[0]
-            self.arg = argv[1:] if argc > 0 else []
+        if self.cmd == '':
+            return
+        if self.cmd not in self.commands:
+            print('Unrecognized command {}'.format(self.cmd))
+            return
+        c = self.commands[self.cmd]
+        if argc < c['minc']:
+            self.print_help([self.cmd])
+            return
+        active = self.Jobs.active
+        if active is not None and self.cmd not in ['jobs', 'wait', 'cancel', 'list', 'help', 'quit']:
+            print('Job [{}] ({}) is running; `wait` for it or `cancel` it first.'.format(active.id, active.name))
+            return
+        # Executing commands from registered command list
+        if c['job']:
+            job = self.Jobs.start(' '.join(argv), c['f'], self.arg)
+            if background:
+                print('[{}] {}'.format(job.id, job.name))
+            else:
+                self.__wait(job)
+            return
+        if background:
+            print('Command {} runs in the foreground.'.format(self.cmd))
+        try:
+            c['f'](self.arg)
+        except KeyboardInterrupt:
+            print('\nInterrupted.')
 
-            if self.cmd is not '':
-                if self.cmd not in self.commands:
-                    print('Unrecognized command {}'.format(self.cmd))
-                    continue
-                # Executing commands from registered command list
-                if argc >= self.commands[self.cmd]['minc']:
-                    self.commands[self.cmd]['f'](self.arg)
-                else:
-                    self.print_help([self.cmd])
+    def __announce_jobs(self):
+        for j in self.Jobs.finished():
+            self.__print_job_output(j)
+            print('[{}] {} {} ({:.1f} s)'.format(j.id, j.state.capitalize(), j.name, j.elapsed))
 
     def set_variable(self, arglist):
         self.pmuConfParser.set(arglist[0], ' '.join(arglist[1:]))
+        if arglist[0] == 'log_level':
+            self.__set_log_level()
+
+    def __set_log_level(self):
+        if not set_level(self.pmuConfParser['log_level']):
+            print('log_level must be one of {}.'.format(', '.join(levels)))
 
     def del_variable(self, arglist):
         self.pmuConfParser.delete(arglist[0])
@@ -102,6 +227,12 @@ class pmuCLI:
                 self.load(['hmap',  'hmap_path'])
             elif arglist[0] == 'fcu':
                 self.load(['gcode', 'fcu_path'])
+            elif arglist[0] == 'bcu':
+                self.load(['bcu',   'bcu_path'])
+            elif arglist[0] == 'reg':
+                self.load(['reg',   'reg_path'])
+            elif arglist[0] == 'gbr':
+                self.load(['gbr',   'gerber_path'])
             else:
                 self.print_help(['load'])
         # processing type and variable
@@ -109,6 +240,7 @@ class pmuCLI:
             var = self.pmuConfParser.get(arglist[1])
             if var is None:
                 return
+            self.__configure_parsers()
             if   arglist[0] == 'gcode':
                 if self.gcodeParser.parse_file(var):
                     self.Planner.activeGCodeFile = var
@@ -118,11 +250,30 @@ class pmuCLI:
             elif arglist[0] == 'hmap':
                 if self.hmapParser.parse_file(var):
                     self.Planner.activeHMapFile = var
+                    self.__check_summary()
+            elif arglist[0] == 'bcu':
+                if self.bcuParser.parse_file(var):
+                    self.Planner.activeBCuFile = var
+            elif arglist[0] == 'reg':
+                if self.regParser.parse_file(var):
+                    self.Planner.activeRegFile = var
+            elif arglist[0] == 'gbr':
+                if self.gerberParser.parse_file(var):
+                    self.Planner.activeGerberFile = var
             else:
                 self.print_help(['load'])
         else:
             self.print_help(['load'])
 
+    def __configure_parsers(self):
+        """ Hands the fixed point coordinate grid (if fixed_point is set), parse_procs and gcode_modal to the parsers. """
+        fp = FixedPoint(self.pmuConfParser['precision']) if self.pmuConfParser['fixed_point'] else None
+        for p in [self.gcodeParser, self.excellonParser, self.bcuParser]:
+            p.fixed = fp
+        for p in [self.gcodeParser, self.bcuParser]:
+            p.procs = self.pmuConfParser['parse_procs']
+            p.modal_axes = bool(self.pmuConfParser['gcode_modal'])
+
     def unload(self, arglist):
         if arglist[0] == 'drl':
             self.Planner.activeDrillFile = None
@@ -130,9 +281,18 @@ class pmuCLI:
         elif arglist[0] == 'hmap':
             self.Planner.activeHMapFile  = None
             self.hmapParser.buffer.clear()
-        elif arglist[0] in ['fcu', 'bcu', 'gcode']:
+        elif arglist[0] in ['fcu', 'gcode']:
             self.Planner.activeGCodeFile = None
             self.gcodeParser.buffer.clear()
+        elif arglist[0] == 'bcu':
+            self.Planner.activeBCuFile = None
+            self.bcuParser.buffer.clear()
+        elif arglist[0] == 'reg':
+            self.Planner.activeRegFile = None
+            self.regParser.buffer.clear()
+        elif arglist[0] == 'gbr':
+            self.Planner.activeGerberFile = None
+            self.gerberParser.buffer.clear()
         else:
             self.print_help(['unload'])
 
@@ -143,10 +303,11 @@ class pmuCLI:
             return
         if var is not None:
             if type(self.Planner.buffer) is GCodeBuffer:
+                self.__configure_parsers()
                 if self.gcodeParser.write_file(var, self.Planner.buffer):
-                    print('Successfully wrote to file {}'.format(var))
+                    log.info('Successfully wrote to file {}', var)
                 else:
-                    print('Failed to write to {}'.format(var))
+                    log.error('Failed to write to {}', var)
             else:
                 print('Work buffer type can not be saved.')
 
@@ -160,6 +321,9 @@ class pmuCLI:
             print('GCode          : {}'.format(self.Planner.activeGCodeFile))
             print('Excellon       : {}'.format(self.Planner.activeDrillFile))
             print('Heightmap      : {}'.format(self.Planner.activeHMapFile))
+            print('Back copper    : {}'.format(self.Planner.activeBCuFile))
+            print('Registration   : {}'.format(self.Planner.activeRegFile))
+            print('Gerber         : {}'.format(self.Planner.activeGerberFile))
             print('\nWork Buffer    : {} ({})'.format(self.Planner.buffer, self.Planner.bufferDescription))
         # List the parsed drill points
         elif arglist[0] == 'drl':
@@ -175,7 +339,7 @@ class pmuCLI:
                 print('\n\t:Probing Points ([x, y]):')
                 for x in range(0,xt):
                     for y in range(0,yt):
-                        print('{}\t'.format(pg.data[x * yt + y]), end='')
+                        print('{}\t'.format(pg[x * yt + y]), end='')
                     print('')
             else:
                 print('Grid not yet generated.')
@@ -187,39 +351,327 @@ class pmuCLI:
 
     def probe(self, arglist):
         if len(arglist) == 0 or arglist[0] == 'grid':
-            # Pull parameters directly off configuration file
-            try:
-                self.Planner.Leveler.parse_dict(self.pmuConfParser.dict)
-            except:
-                print(sys.exc_info()[1])
-                return
             if (self.Planner.leveling_gen_grid(self.excellonParser.buffer)):
-                print('Successfully generated grid.')
+                log.info('Successfully generated grid.')
             else:
-                print('Unable to generate probing grid.')
+                log.error('Unable to generate probing grid.')
                 return
+        elif arglist[0] == 'reg':
+            if self.Planner.backside_gen_reg_grid():
+                print('\n\t:Registration Points ([x, y]):')
+                for p in self.Planner.buffer:
+                    print(p)
+                print('')
         elif arglist[0] == 'run':
-            # connect to CNC and do physical probing
-            pass
+            var = self.pmuConfParser.get('hmap_path')
+            if var is None:
+                return
+            if self.Planner.probing_run(self.Planner.Leveler.probingGrid, var, self.excellonParser.buffer):
+                log.info('Probed heightmap written to {}', var)
+                self.load(['hmap'])
+            else:
+                log.error('Probing stopped; `probe run` again resumes it.')
 
     def level(self, arglist):
+        if len(arglist) > 0 and arglist[0] == 'bcu':
+            if self.Planner.leveling_run_back(self.bcuParser.buffer, self.hmapParser.buffer, self.regParser.buffer):
+                log.info('Successfully leveled back copper G-Code.')
+            else:
+                log.error('Failed to level back copper G-Code.')
+            return
+        if len(arglist) > 0 and arglist[0] == 'mesh':
+            b = self.Planner.buffer if arglist[1:2] == ['buffer'] else self.gcodeParser.buffer
+            if type(b) is GCodeBuffer and self.Planner.meshing_run(b, self.hmapParser.buffer):
+                log.info('Successfully generated mesh leveled G-Code.')
+            else:
+                log.error('Failed to generate mesh leveled G-Code.')
+            return
         b = None
         if len(arglist) == 0 or arglist[0] == 'file':
             b = self.gcodeParser.buffer
         elif arglist[0] == 'buffer':
             b = self.Planner.buffer
         if(self.Planner.leveling_run(b, self.hmapParser.buffer)):
-            print('Successfully leveled G-Code.')
+            log.info('Successfully leveled G-Code.')
         else:
-            print('Failed to level G-Code.')
+            log.error('Failed to level G-Code.')
 
-    def view(self, arglist):
-        # Pull parameters directly off configuration file
+    def crop(self, arglist):
+        lims = None
+        tile = None
+        if len(arglist) > 0 and arglist[0] == 'tile':
+            if len(arglist) < 3:
+                self.print_help(['crop'])
+                return
+            try:
+                tile = (int(arglist[1]), int(arglist[2]))
+            except ValueError:
+                print('Tile indices must be integers.')
+                return
+            arglist = arglist[3:]
+        b = None
+        if len(arglist) == 0 or arglist[0] == 'file':
+            b = self.gcodeParser.buffer
+        elif arglist[0] == 'buffer':
+            b = self.Planner.buffer
+        if type(b) is not GCodeBuffer:
+            print('Work buffer does not hold GCode.')
+            return
+        if tile is not None:
+            lims = self.Planner.cropping_tile_lims(b, tile[0], tile[1])
+            if lims is None:
+                return
+        if self.Planner.cropping_run(b, lims):
+            log.info('Successfully cropped G-Code.')
+        else:
+            log.error('Failed to crop G-Code.')
+
+    def __check_summary(self):
+        """ Checks a loaded heightmap; says so in one line if it has outliers. """
+        if not self.Planner.hmap_check(self.hmapParser.buffer):
+            return
+        r = self.Planner.HMapChecker.report
+        if r['outliers']:
+            log.warning('Heightmap: {} outliers, max deviation {:.4f} mm; see `check`.', r['outliers'], r['max_dev'])
+
+    def check(self, arglist):
+        if len(arglist) == 0:
+            if not self.Planner.hmap_check(self.hmapParser.buffer):
+                return
+            r = self.Planner.HMapChecker.report
+            print('\n\t:Heightmap check:')
+            print('Points         : {}'.format(r['points']))
+            print('Height range   : {:.4f} mm'.format(r['range']))
+            print('Tilt (x, y)    : {:.3f}, {:.3f} um/mm'.format(r['tilt_x'] * 1000, r['tilt_y'] * 1000))
+            print('Bow            : {:.4f} mm'.format(r['bow']))
+            print('Max deviation  : {:.4f} mm (rms {:.4f} mm)'.format(r['max_dev'], r['rms']))
+            print('Outliers       : {}'.format(r['outliers']))
+            if r['outliers']:
+                for i in self.Planner.HMapChecker.outliers:
+                    print('\t{}'.format(self.hmapParser.buffer[i]))
+                print('Use `check reprobe` to probe them again, or `check reject` to replace them.')
+            print('')
+        elif arglist[0] == 'reprobe':
+            self.Planner.hmap_gen_reprobe_grid()
+        elif arglist[0] == 'reject':
+            self.Planner.hmap_reject(self.hmapParser.buffer)
+        else:
+            self.print_help(['check'])
+
+    def optimize(self, arglist):
+        b = None
+        if len(arglist) == 0 or arglist[0] == 'file':
+            b = self.gcodeParser.buffer
+        elif arglist[0] == 'buffer':
+            b = self.Planner.buffer
+        if type(b) is not GCodeBuffer:
+            print('Work buffer does not hold GCode.')
+            return
+        if self.Planner.optimizing_run(b):
+            log.info('Successfully optimized G-Code.')
+        else:
+            log.error('Failed to optimize G-Code.')
+
+    def isolate(self, arglist):
+        if self.Planner.isolating_run(self.gerberParser.buffer):
+            log.info('Successfully generated isolation G-Code.')
+        else:
+            log.error('Failed to generate isolation G-Code.')
+
+    def drill(self, arglist):
+        if self.Planner.drilling_run(self.excellonParser.buffer, self.hmapParser.buffer):
+            log.info('Successfully generated drilling G-Code.')
+        else:
+            log.error('Failed to generate drilling G-Code.')
+
+    def resume(self, arglist):
         try:
-            self.View.parse_dict(self.pmuConfParser.dict)
-        except:
-            print(sys.exc_info()[1])
+            line = int(arglist[0])
+        except ValueError:
+            print('Line must be an integer.')
+            return
+        b = self.Planner.buffer
+        if (len(arglist) > 1 and arglist[1] == 'file') or type(b) is not GCodeBuffer or b.empty():
+            b = self.gcodeParser.buffer
+        if self.Planner.resuming_run(b, line):
+            log.info('Successfully generated resumed G-Code.')
+        else:
+            log.error('Failed to generate resumed G-Code.')
+
+    def estimate(self, arglist):
+        b = None
+        if len(arglist) == 0 or arglist[0] == 'file':
+            b = self.gcodeParser.buffer
+        elif arglist[0] == 'buffer':
+            b = self.Planner.buffer
+        if type(b) is not GCodeBuffer:
+            print('Work buffer does not hold GCode.')
             return
+        r = self.Planner.estimating_run(b)
+        if r is None:
+            return
+        print('\n\t:Run time estimate:')
+        print('Motion blocks  : {} ({} segments, {} stops)'.format(r['blocks'], r['segments'], r['stops']))
+        print('Cutting        : {} ({:.1f} mm)'.format(self.__hms(r['cut_time']), r['cut_length']))
+        print('Rapids         : {} ({:.1f} mm)'.format(self.__hms(r['rapid_time']), r['rapid_length']))
+        print('Total          : {}'.format(self.__hms(r['total_time'])))
+
+        # Compare leveled GCode with the GCode it was leveled from
+        lvl = self.Planner.Leveler
+        src = lvl.leveledSource
+        if src is not None and not lvl.leveledGCode.empty() and b in (src, lvl.leveledGCode):
+            other = self.Planner.estimating_run(lvl.leveledGCode if b is src else src)
+            if other is not None:
+                before, after = (r, other) if b is src else (other, r)
+                dt = after['total_time'] - before['total_time']
+                print('Leveling adds  : {:+.1f} s ({:+.2f}%, {:+d} blocks)'.format(
+                    dt,
+                    100.0 * dt / before['total_time'] if before['total_time'] > 0 else 0.0,
+                    after['blocks'] - before['blocks']))
+        print('')
+
+    @staticmethod
+    def __hms(s: float) -> str:
+        m, s = divmod(s, 60.0)
+        return '{:d}:{:02d}:{:04.1f}'.format(int(m // 60), int(m % 60), s)
+
+    def watch(self, arglist):
+        sources = OrderedDict()  # watched path -> load alias
+        for alias, var in [('drl', 'excellon_path'), ('hmap', 'hmap_path'), ('fcu', 'fcu_path')]:
+            if self.pmuConfParser[var] is not None:
+                sources[os.path.abspath(self.pmuConfParser[var])] = alias
+        if 'fcu' not in sources.values() or self.pmuConfParser.get('gcode_out') is None:
+            print('Watch: fcu_path and gcode_out must be set.')
+            return
+        watcher = FileWatcher(list(sources), self.pmuConfParser['watch_debounce'],
+                              poll=len(arglist) > 0 and arglist[0] == 'poll')
+        print('Watching {} ({}). Press Ctrl+C to stop.'.format(', '.join(sources), watcher.method))
+        try:
+            while True:
+                changed = watcher.wait()
+                t0 = time.monotonic()
+                for p in changed:
+                    self.load([sources[p]])
+                # Drills only matter for probing grids
+                if all(sources[p] == 'drl' for p in changed):
+                    continue
+                if self.__level_and_write():
+                    print('Watch: {} updated {:.0f} ms after the change.'.format(
+                        self.pmuConfParser['gcode_out'], 1000.0 * (time.monotonic() - t0)))
+        except KeyboardInterrupt:
+            print('')
+        finally:
+            watcher.close()
+
+    def __level_and_write(self) -> bool:
+        if not self.Planner.leveling_run(self.gcodeParser.buffer, self.hmapParser.buffer):
+            log.error('Failed to level G-Code.')
+            return False
+        self.__configure_parsers()
+        if not self.gcodeParser.write_file(self.pmuConfParser['gcode_out'], self.Planner.buffer):
+            log.error('Failed to write to {}', self.pmuConfParser['gcode_out'])
+            return False
+        return True
+
+    def undo(self, arglist):
+        if self.Planner.undo():
+            print('Work buffer: {} ({})'.format(self.Planner.buffer, self.Planner.bufferDescription))
+
+    def redo(self, arglist):
+        if self.Planner.redo():
+            print('Work buffer: {} ({})'.format(self.Planner.buffer, self.Planner.bufferDescription))
+
+    def history(self, arglist):
+        h = self.Planner.History
+        if len(arglist) == 0:
+            print('\n\t:Work buffer history ({:.1f} MB):'.format(h.bytes / 1024.0 / 1024.0))
+            for i, (desc, typ, size) in enumerate(h.entries):
+                print('{} {}\t{} blocks\t{}'.format('*' if i == h.cursor else ' ', i, size, desc))
+            print('')
+        elif arglist[0] == 'diff':
+            try:
+                a = int(arglist[1]) if len(arglist) > 1 else h.cursor - 1
+                b = int(arglist[2]) if len(arglist) > 2 else h.cursor
+            except ValueError:
+                print('Versions must be integers.')
+                return
+            n = len(h.entries)
+            if not (0 <= a < n and 0 <= b < n):
+                print('No such versions in history.')
+                return
+            hunks = h.diff(a, b)
+            print('\n\t:Version {} -> {}: {} changed regions:'.format(a, b, len(hunks)))
+            for a0, a1, b0, b1 in hunks[:20]:
+                print('lines {}-{} ({} blocks) -> {}-{} ({} blocks)'.format(a0 + 1, a1, a1 - a0, b0 + 1, b1, b1 - b0))
+            if len(hunks) > 20:
+                print('... {} more'.format(len(hunks) - 20))
+            print('')
+        else:
+            self.print_help(['history'])
+
+    def jobs(self, arglist):
+        if not self.Jobs.jobs:
+            print('No jobs.')
+            return
+        for j in self.Jobs.jobs:
+            print('[{}] {}\t{}\t{}'.format(j.id, j.state.capitalize(), j.name, j.status()))
+
+    def __job(self, arglist):
+        """ Job selected by id, or the running job. """
+        if len(arglist) == 0:
+            j = self.Jobs.active
+            if j is None:
+                print('No job is running.')
+            return j
+        try:
+            j = self.Jobs.get(int(arglist[0]))
+        except ValueError:
+            j = None
+        if j is None:
+            print('No job {}.'.format(arglist[0]))
+        return j
+
+    def wait(self, arglist):
+        j = self.__job(arglist)
+        if j is not None:
+            self.__wait(j)
+
+    def cancel(self, arglist):
+        j = self.__job(arglist)
+        if j is None:
+            return
+        if not j.running:
+            print('Job [{}] already {}.'.format(j.id, j.state))
+            return
+        j.cancel()
+        self.__wait(j)
+
+    def __print_job_output(self, job: Job):
+        out = job.read_output()
+        if out:
+            print(out, end='')
+
+    def __wait(self, job: Job):
+        """ Waits for job, showing its output and progress; Ctrl+C cancels it. """
+        bar = ''
+        while job.running:
+            try:
+                job.join(0.2)
+            except KeyboardInterrupt:
+                job.cancel()
+            out = job.read_output()
+            status = job.status() if job.running and job.elapsed > 0.5 and sys.stdout.isatty() else ''
+            if out or status != bar:
+                # Erase the progress line before printing output over it
+                print('\r' + ' ' * len(bar) + '\r' + out + status, end='', flush=True)
+                bar = status
+        print('\r' + ' ' * len(bar) + '\r', end='')
+        self.__print_job_output(job)
+        self.Jobs.acknowledge(job)
+        if job.state != 'done':
+            print('[{}] {} {}'.format(job.id, job.state.capitalize(), job.name))
+
+    def view(self, arglist):
         if   arglist[0] == 'drl':
             self.View.print_drills(self.excellonParser.buffer)
         elif arglist[0] == 'drltol':
@@ -232,6 +684,11 @@ class pmuCLI:
             self.View.clear_plot()
         elif arglist[0] == 'grid':
             self.View.toggle_grid()
+        elif arglist[0] == 'hmap3d':
+            self.View.print_hmap3d(self.hmapParser.buffer)
+        elif arglist[0] == 'path3d':
+            b = self.Planner.buffer
+            self.View.print_path3d(b if type(b) is GCodeBuffer and not b.empty() else self.gcodeParser.buffer)
         else:
             print('Unrecognized view command {}'.format(arglist[0]))
         # Allows to concatenate more arguments
@@ -260,13 +717,20 @@ class pmuCLI:
         bye = ['Don\'t break your fine endmills.', 'Don\'t home with disabled endstops.',
                'DIY PCB etching is for noobs.', 'Pro tip: try out the esoteric 0-point probing method.',
                'Right angled traces make the PCB-Gods mad.', 'Don\'t scratch your forehead with a running spindle.']
+        self.stop()
         print(bye[random.randint(0,len(bye)-1)])
         sys.exit(0)
 
-    def register_command(self, fcn, command, help, ddescription='', minargc=0):
+    def stop(self):
+        """ Cancels the jobs and restores standard output. """
+        self.Jobs.shutdown()
+
+    def register_command(self, fcn, command, help, ddescription='', minargc=0, job=False):
+        """ Commands registered as jobs run on a worker thread, in the background if followed by &. """
         nc = {}
         nc['f']    = fcn
         nc['help'] = help
         nc['desc'] = ddescription
         nc['minc'] = minargc
+        nc['job']  = job
         self.commands[command] = nc
\ No newline at end of file
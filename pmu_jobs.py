@@ -0,0 +1,253 @@
+from collections import OrderedDict
+
+import threading
+import time
+import sys
+import io
+
+
+class JobCancelled(Exception):
+    """ Raised inside a job, at its next progress report, once it was cancelled. """
+    def __init__(self):
+        Exception.__init__(self, 'Cancelled by user.')
+
+
+# Job running on the current thread, if any
+_current = threading.local()
+
+
+def current_job():
+    return getattr(_current, 'job', None)
+
+
+def progress(done, total=None, unit=''):
+    """
+    Reports the progress of the job running on this thread; does nothing outside jobs.
+    Raises JobCancelled if the job was cancelled, so components should only call it
+    where stopping leaves their state untouched.
+    :param done: Amount of work done.
+    :param total: Total amount of work, or None if unknown.
+    :param unit: Name of the unit of work (lines, points...).
+    """
+    job = current_job()
+    if job is not None:
+        job.report(done, total, unit)
+
+
+def thread_output(default):
+    """
+    Where the output of this thread goes: its job if it runs one, else the stream given
+    by redirect_output, else default.
+    """
+    job = current_job()
+    if job is not None:
+        return job
+    out = getattr(_current, 'out', None)
+    return default if out is None else out
+
+
+class Job(object):
+    """
+    A command running on a worker thread.
+    Everything the command prints (with JobManager installed) and logs is kept until
+    read with read_output.
+    """
+    def __init__(self, id: int, name: str, fcn, args: list):
+        self.__id    = id
+        self.__name  = name
+        self.__state = 'running'  # running, done, cancelled or failed
+        self.__done  = 0
+        self.__total = None
+        self.__unit  = ''
+        self.__start = time.monotonic()
+        self.__end   = None
+
+        self.__cancel = threading.Event()
+        self.__ended  = threading.Event()
+        self.__out    = io.StringIO()
+        self.__lock   = threading.Lock()
+        self.__thread = threading.Thread(target=self.__run, args=(fcn, args),
+                                         name='pmu-job-{}'.format(id), daemon=True)
+        self.__thread.start()
+
+    def __run(self, fcn, args):
+        _current.job = self
+        try:
+            fcn(args)
+            self.__state = 'cancelled' if self.__cancel.is_set() else 'done'
+            if self.__state == 'done' and self.__total:
+                self.__done = self.__total
+        except JobCancelled:
+            self.__state = 'cancelled'
+        except Exception as e:
+            self.write('Job: {}\n'.format(e))
+            self.__state = 'failed'
+        finally:
+            self.__end = time.monotonic()
+            _current.job = None
+            self.__ended.set()
+
+    @property
+    def id(self) -> int:
+        return self.__id
+
+    @property
+    def name(self) -> str:
+        return self.__name
+
+    @property
+    def state(self) -> str:
+        return self.__state
+
+    @property
+    def running(self) -> bool:
+        return not self.__ended.is_set()
+
+    @property
+    def elapsed(self) -> float:
+        return (self.__end if self.__end is not None else time.monotonic()) - self.__start
+
+    @property
+    def rate(self) -> float:
+        """ Work done per second. """
+        return self.__done / self.elapsed if self.elapsed > 0 else 0.0
+
+    def report(self, done, total=None, unit=''):
+        if self.__cancel.is_set():
+            raise JobCancelled()
+        self.__done, self.__total, self.__unit = done, total, unit
+
+    def cancel(self):
+        self.__cancel.set()
+
+    def join(self, timeout=None):
+        # Waiting on an event rather than the thread: an interrupted Thread.join can leave
+        # the thread looking finished
+        self.__ended.wait(timeout)
+
+    def write(self, s: str):
+        with self.__lock:
+            self.__out.write(s)
+        return len(s)
+
+    def flush(self):
+        pass
+
+    def isatty(self) -> bool:
+        return False
+
+    def read_output(self) -> str:
+        """ Output printed by the job since the last call. """
+        with self.__lock:
+            s = self.__out.getvalue()
+            self.__out = io.StringIO()
+        return s
+
+    def status(self, width=30) -> str:
+        """ One line status: progress bar (if the total is known), work done and rate. """
+        if not self.__unit:
+            return '{:.1f} s'.format(self.elapsed)
+        if self.__total:
+            f = min(max(self.__done / self.__total, 0.0), 1.0)
+            bar = '[{}{}] {:3.0f}% '.format('#' * int(f * width), '.' * (width - int(f * width)), 100.0 * f)
+            work = '{}/{} {}'.format(self.__done, self.__total, self.__unit)
+        else:
+            bar = ''
+            work = '{} {}'.format(self.__done, self.__unit)
+        return '{}{}, {:.0f} {}/s, {:.1f} s'.format(bar, work, self.rate, self.__unit, self.elapsed)
+
+
+def redirect_output(stream):
+    """
+    Sends what this thread prints to stream (None restores sys.stdout's own stream).
+    Needs sys.stdout to be a JobStdout (see JobManager.install).
+    """
+    _current.out = stream
+
+
+class JobStdout(object):
+    """
+    Stands in for sys.stdout: writes from job threads go to their job, writes from
+    threads given a stream by redirect_output go there, everything else to the
+    wrapped stream.
+    """
+    def __init__(self, stream):
+        self.__stream = stream
+
+    @property
+    def wrapped(self):
+        return self.__stream
+
+    @property
+    def stream(self):
+        """ Stream the current thread writes to. """
+        return thread_output(self.__stream)
+
+    def write(self, s):
+        return self.stream.write(s)
+
+    def flush(self):
+        self.stream.flush()
+
+    def isatty(self) -> bool:
+        return self.stream.isatty()
+
+    def __getattr__(self, item):
+        return getattr(self.__stream, item)
+
+
+class JobManager(object):
+    """
+    Starts jobs and keeps track of them; only one job runs at a time.
+    What jobs print is only kept apart once install swapped sys.stdout for a JobStdout
+    (starting a job does it); shutdown puts sys.stdout back.
+    """
+    def __init__(self):
+        self.__jobs     = OrderedDict()  # id -> Job
+        self.__reported = set()          # ids of finished jobs already announced
+
+    def install(self):
+        """ Swaps sys.stdout for a JobStdout wrapping it, unless it already is one. """
+        if not isinstance(sys.stdout, JobStdout):
+            sys.stdout = JobStdout(sys.stdout)
+
+    def shutdown(self):
+        """ Cancels and waits for the running jobs, then restores sys.stdout. """
+        for j in self.__jobs.values():
+            j.cancel()
+            j.join()
+        if isinstance(sys.stdout, JobStdout):
+            sys.stdout = sys.stdout.wrapped
+
+    @property
+    def jobs(self) -> list:
+        return list(self.__jobs.values())
+
+    @property
+    def active(self):
+        """ Running job, or None. """
+        for j in self.__jobs.values():
+            if j.running:
+                return j
+        return None
+
+    def get(self, id: int):
+        return self.__jobs.get(id)
+
+    def start(self, name: str, fcn, args: list) -> Job:
+        if self.active is not None:
+            raise RuntimeError('job [{}] is still running.'.format(self.active.id))
+        self.install()
+        id = max(self.__jobs) + 1 if self.__jobs else 1
+        self.__jobs[id] = Job(id, name, fcn, args)
+        return self.__jobs[id]
+
+    def acknowledge(self, job: Job):
+        """ Marks a finished job as announced. """
+        self.__reported.add(job.id)
+
+    def finished(self) -> list:
+        """ Finished jobs not announced yet; they are marked as announced. """
+        r = [j for j in self.__jobs.values() if not j.running and j.id not in self.__reported]
+        self.__reported.update(j.id for j in r)
+        return r
@@ -0,0 +1,113 @@
+from pmu_jobs import thread_output
+
+import logging
+import sys
+
+
+class _Message(object):
+    """ str.format style message, formatted only when a handler emits it. """
+    def __init__(self, fmt: str, args: tuple):
+        self.fmt  = fmt
+        self.args = args
+
+    def __str__(self):
+        return self.fmt.format(*self.args) if self.args else self.fmt
+
+
+class Logger(logging.LoggerAdapter):
+    """
+    Logger taking str.format style messages: log.info('Leveler: added {} points', n).
+    Arguments are only formatted if the message is emitted.
+    """
+    def __init__(self, logger):
+        logging.LoggerAdapter.__init__(self, logger, {})
+
+    def log(self, level, msg, *args, **kwargs):
+        if self.isEnabledFor(level):
+            self.logger.log(level, _Message(msg, args), **kwargs)
+
+
+def getLogger(name: str) -> Logger:
+    """ Logger of a PMU module; all are children of the 'pmu' logger. """
+    return Logger(logging.getLogger('pmu.' + name))
+
+
+# Silent when used as a library, until the application sets up a handler
+logging.getLogger('pmu').addHandler(logging.NullHandler())
+
+
+class Tally(object):
+    """
+    Stands for a message repeated in a loop: only the first few occurrences are logged
+    (at level), then a single summary with their count once the loop is done.
+    """
+    def __init__(self, log: Logger, summary=None, level=logging.DEBUG, first=10):
+        """
+        :param summary: Message taking the count, e.g. 'Leveler: relocated {} points';
+                        None if the caller reports the count itself.
+        """
+        self.__log     = log
+        self.__summary = summary
+        self.__level   = level
+        self.__first   = first
+        self.__count   = 0
+
+    @property
+    def count(self) -> int:
+        return self.__count
+
+    def __call__(self, msg, *args):
+        self.__count += 1
+        if self.__count <= self.__first:
+            self.__log.log(self.__level, msg, *args)
+
+    def done(self, level=logging.INFO):
+        """ Logs the summary, if anything was counted. """
+        if self.__count and self.__summary is not None:
+            self.__log.log(level, self.__summary, self.__count)
+
+
+class _ConsoleHandler(logging.StreamHandler):
+    """
+    Writes to its own stream, whatever sys.stdout is swapped for. Records emitted by a
+    job go to the job's output, and those of a thread given a stream by redirect_output
+    to that stream (see pmu_jobs.thread_output).
+    """
+    def __init__(self, stream):
+        self.console = stream
+        logging.StreamHandler.__init__(self, stream)
+
+    @property
+    def stream(self):
+        return thread_output(self.console)
+
+    @stream.setter
+    def stream(self, value):
+        self.console = value
+
+
+levels = ['debug', 'info', 'warning', 'error']
+
+
+def console(level='info', stream=None):
+    """
+    Prints PMU messages of level and above, as they are, to stream.
+    :param stream: Defaults to the process' standard output (sys.__stdout__).
+    """
+    stream = sys.__stdout__ if stream is None else stream
+    root = logging.getLogger('pmu')
+    h = next((h for h in root.handlers if type(h) is _ConsoleHandler), None)
+    if h is None:
+        h = _ConsoleHandler(stream)
+        h.setFormatter(logging.Formatter('%(message)s'))
+        root.addHandler(h)
+    else:
+        h.setStream(stream)
+    set_level(level)
+
+
+def set_level(level: str) -> bool:
+    if level.lower() not in levels:
+        return False
+    logging.getLogger('pmu').setLevel(getattr(logging, level.upper()))
+    return True
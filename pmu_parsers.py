@@ -1,21 +1,34 @@
 from pmu_workspace import *
 from pmu_buffers import *
+from pmu_jobs import progress, JobCancelled
+from pmu_log import getLogger, Tally
+from pmu_spatial import arc_geometry, arc_linearize
 
 from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from typing import Union
+from array import array
 
+import numpy as np
+import logging
 import sys
+import bisect
 import csv
 import re
+import io
 import os
 import os.path
 
 
+log = getLogger('parsers')
+
+
 class GenericParser(object):
     def __init__(self, bufferType=GenericBuffer):
         self.__filepath = None
         self.__buff     = bufferType()
         self.__verbose  = False
+        self.__fixed    = None  # FixedPoint coordinates are snapped to; None keeps them as read
 
     @property
     def filepath(self):
@@ -47,16 +60,25 @@ class GenericParser(object):
             raise TypeError
         self.__verbose = value
 
+    @property
+    def fixed(self):
+        return self.__fixed
+
+    @fixed.setter
+    def fixed(self, value):
+        if value is not None and type(value) is not FixedPoint:
+            raise TypeError
+        self.__fixed = value
+
     def parse_file(self, fpath=None) -> bool:
         self.__filepath = fpath if fpath is not None else self.__filepath
         if self.__filepath is None:
             return False
         if not os.path.isfile(self.__filepath):
-            print('{} does not exist!'.format(self.__filepath))
+            log.error('{} does not exist!', self.__filepath)
             return False
-        # Clear buffer
-        self.__buff.clear()
-        # Parsing done in derived classes
+        # Parsing done in derived classes; they replace the buffer contents once done,
+        # so failed or cancelled parses keep the previous ones
         return True
 
 
@@ -66,6 +88,8 @@ class ConfParser(GenericParser, DefaultWorkspace):
     After parsing, holds the parameter dictionary.
     """
 
+    __variable = re.compile('\\$\\((\\w*)\\)')
+
     def __init__(self):
         GenericParser.__init__(self)
         DefaultWorkspace.__init__(self)
@@ -75,7 +99,7 @@ class ConfParser(GenericParser, DefaultWorkspace):
             return False
 
         cfd = open(self.filepath, 'r')
-        print('Parsing configuration file {}'.format(self.filepath))
+        log.info('Parsing configuration file {}', self.filepath)
 
         __indict = OrderedDict()
         for line in cfd:
@@ -102,16 +126,17 @@ class ConfParser(GenericParser, DefaultWorkspace):
         """
         if type(name) is str:
             if name not in self.param:
-                print('Adding new variable {} to workspace.'.format(name))
+                log.info('Adding new variable {} to workspace.', name)
             try:
-                # self[name] = self.__expand_variables(value)
                 self.parse_dict({name: self.__expand_variables(value)}, allow_new=True)
-            except:
+            except KeyError:
                 pass
+            except TypeError as e:
+                log.error('{}', e)
 
     def get(self, name) -> Union[str, None]:
         if name not in self.param:
-            print('No variable {} in workspace!'.format(name))
+            log.error('No variable {} in workspace!', name)
             return None
         return self[name]
 
@@ -123,19 +148,20 @@ class ConfParser(GenericParser, DefaultWorkspace):
             if name in self.param:
                 del self[name]
             else:
-                print('No variable {} to delete.'.format(name))
+                log.error('No variable {} to delete.', name)
 
     def __expand_variables(self, line, dict=None) -> str:
-        dict = self.dict if dict is None else dict
-        m = []
-        while m is not None:
-            m = re.match('(.*)\$\((?P<varname>\w*)\)(.*)', line)
-            if m is not None:
-                if m.group('varname') not in dict:
-                    print('Undefined variable {}'.format(m.group('varname')))
-                    raise Exception
-                line = m.group(1) + dict[m.group('varname')] + m.group(3)
-        return line
+        """ Replaces every $(varname) in line, in a single pass. """
+        def value(m):
+            if dict is not None:
+                v = dict.get(m.group(1))
+            else:
+                v = self[m.group(1)] if m.group(1) in self.param else None
+            if v is None:
+                log.error('Undefined variable {}', m.group(1))
+                raise KeyError(m.group(1))
+            return str(v)
+        return self.__variable.sub(value, line)
 
 
 class HMapParser(GenericParser):
@@ -150,7 +176,8 @@ class HMapParser(GenericParser):
         if not super().parse_file(fpath):
             return False
 
-        print('Parsing heigthmap file {}'.format(self.filepath))
+        log.info('Parsing heigthmap file {}', self.filepath)
+        pts = list()
         with open(self.filepath, 'r') as hfd:
             line = csv.reader(hfd, delimiter=',')
             for row in line:
@@ -159,91 +186,387 @@ class HMapParser(GenericParser):
                     y = float(row[1])
                     z = float(row[2])
                 except:
-                    print('Unable to parse heightmap.')
+                    log.error('Unable to parse heightmap.')
                     return False
-                self.buffer.append((x, y, z))
+                pts.append((x, y, z))
+                if len(pts) & 4095 == 0:
+                    progress(len(pts), None, 'points')
+        self.buffer.data = pts
         return True
 
     def write_file(self, fpath=None):
         pass
 
 
+_UNKNOWN = -1  # modal motion or plane not known yet, at the start of a byte range
+
+
+class _GCodeReader(object):
+    """
+    Turns GCode lines into GCodeBuffer entries, tracking the modal motion and plane.
+    A motion line holding other G, M, S, T, H or D words gives a motion block preceded by
+    those words as a prefix (a string without line break, written on the block's line).
+    Program stops and ends (M00, M01, M02, M30, M60) take effect after the motion: they
+    follow the block on a line of their own.
+    With modal_axes set, coordinates without a G word continue the modal motion;
+    otherwise such lines are kept as text.
+    Reading a byte range of a file, both are unknown until set there: lines depending on
+    them are returned as pending [w, g, plane, words, whole, line, lineno] lists, to be
+    resolved once the state at the start of the range is known (see resolve).
+    """
+    __comment = re.compile('\\(.*?\\)|;.*')
+    __word    = re.compile('([A-Z])\\s*([+-]?[0-9]*\\.?[0-9]*)')
+    axes      = 'XYZIJR'
+    # G codes taking the axis words of their line as arguments (dwell, offsets, homing,
+    # machine coordinates): such lines are kept whole
+    __argcodes = (4, 10, 28, 30, 52, 53, 92)
+    __stops    = (0, 1, 2, 30, 60)
+    snapsMax   = 1 << 16
+
+    def __init__(self, fixed=None, modal=None, plane=17, verbatim=None, badarc=None, modal_axes=False):
+        """
+        :param verbatim: Called as verbatim(lineno, line) for lines kept as text, if given.
+        :param badarc: Called as badarc(lineno, line) for arcs kept as text, if given.
+        """
+        self.modal = modal
+        self.plane = plane
+        self.fixed = fixed
+        self.modal_axes = modal_axes
+        self.motions  = 0
+        self.arcs     = 0
+        self.verbatim = 0
+        self.badarcs  = 0
+        self.prefixed = 0
+        self.__snaps  = dict()  # coordinate word -> mm, on the fixed point's grid; at most snapsMax
+        self.__onVerbatim = verbatim
+        self.__onBadArc   = badarc
+
+    def read(self, line: str, lineno=None) -> list:
+        """ Entries of a line: motion block and the words beside it, the line itself, or a pending list. Raises ValueError. """
+        g, w, words, whole = None, {}, [], False
+        fp = self.fixed
+        for c, v in self.__word.findall(self.__comment.sub('', line).upper()):
+            if c == 'G':
+                code = float(v)
+                if code in (0, 1, 2, 3):
+                    g = self.modal = int(code)
+                    continue
+                if code in (17, 18, 19):
+                    self.plane = int(code)
+                elif int(code) == 38 or 80 <= code <= 89:
+                    # Probing and canned cycles: neither they nor the lines continuing them are motion blocks
+                    self.modal = None
+                    whole = True
+                elif int(code) in self.__argcodes:
+                    whole = True
+                words.append(c + v)
+            elif c in 'F' + self.axes and c not in w:
+                if fp is None or c == 'F':
+                    w[c] = float(v)
+                else:
+                    x = self.__snaps.get(v)
+                    if x is None:
+                        if len(self.__snaps) >= self.snapsMax:
+                            self.__snaps.clear()
+                        x = self.__snaps[v] = fp.mm(fp.parse(v))
+                    w[c] = x
+            elif c == 'N':
+                continue  # line numbers are not kept
+            elif c in 'MSTHD':
+                words.append(c + v)
+            else:
+                whole = True
+        # Coordinates without a G word continue the modal motion
+        if g is None and self.modal_axes and any(a in w for a in self.axes):
+            if self.modal == _UNKNOWN:
+                return [[w, None, self.plane, words, whole, line, lineno]]
+            g = self.modal
+        if g in (2, 3) and self.plane == _UNKNOWN and any(a in w for a in 'IJR'):
+            return [[w, g, _UNKNOWN, words, whole, line, lineno]]
+        return self.__entries(w, g, self.plane, words, whole, line, lineno)
+
+    def resolve(self, pending: list, modal, plane, line0=0) -> list:
+        """
+        Entries of a pending line, given the modal motion and plane at the start of its range.
+        :param line0: Lines before the range.
+        """
+        w, g, pl, words, whole, line, lineno = pending
+        return self.__entries(w, modal if g is None else g, plane if pl == _UNKNOWN else pl,
+                              words, whole, line, None if lineno is None else line0 + lineno)
+
+    def __entries(self, w, g, plane, words, whole, line, lineno) -> list:
+        if g in (2, 3) and (plane != 17 or not any(a in w for a in 'IJR')):
+            whole = True
+            self.badarcs += 1
+            if self.__onBadArc is not None:
+                self.__onBadArc(lineno, line)
+        if g is None or whole:
+            # Line was not recognized as a G command; archive it entirely
+            self.verbatim += 1
+            if self.__onVerbatim is not None:
+                self.__onVerbatim(lineno, line)
+            return [line]
+        bl = (g, w.get('F'), w.get('X'), w.get('Y'), w.get('Z'))
+        if g in (2, 3):
+            bl += (w.get('I'), w.get('J'), w.get('R'))
+            self.arcs += 1
+        self.motions += 1
+        if not words:
+            return [bl]
+        self.prefixed += 1
+        stop = [k for k in words if k[0] == 'M' and k[1:] and float(k[1:]) in self.__stops]
+        rest = [k for k in words if k not in stop]
+        return ([' '.join(rest) + ' '] if rest else []) + [bl] + ([' '.join(stop) + '\n'] if stop else [])
+
+
+def _parse_gcode_range(path: str, start: int, end: int, digits, modal_axes=False) -> tuple:
+    """
+    Parses the lines in bytes [start, end) of a GCode file, from an unknown state.
+    :param digits: Digits of the fixed point, or None.
+    :return: (entries, indices of pending entries, first entry of each line, lines, motions,
+              arcs, verbatim, badarcs, prefixed, modal, plane), or (None, line) if a line could
+              not be parsed.
+    """
+    with open(path, 'rb') as fd:
+        fd.seek(start)
+        raw = fd.read(end - start)
+    rd = _GCodeReader(None if digits is None else FixedPoint(digits), _UNKNOWN, _UNKNOWN, modal_axes=modal_axes)
+    data, pending, starts = list(), list(), list()
+    n = 0
+    # Decoded like open() would, universal newlines included
+    for n, line in enumerate(io.TextIOWrapper(io.BytesIO(raw)), 1):
+        starts.append(len(data))
+        try:
+            es = rd.read(line, n)
+        except ValueError:
+            return None, line
+        if type(es[0]) is list:
+            pending.append(len(data))
+        data += es
+    return data, pending, starts, n, rd.motions, rd.arcs, rd.verbatim, rd.badarcs, rd.prefixed, rd.modal, rd.plane
+
+
 class GCodeParser(GenericParser):
     """
     Reads/parses and writes GCode.
     All values are converted to and handled in mm.
+    Lines holding a motion (G00 to G03; modal too if modal_axes is set) with F, X, Y, Z,
+    I, J and R words become motion blocks (line numbers are dropped); their other G, M,
+    S, T, H and D words are kept and written on the same line. Anything else is kept verbatim.
+    Arcs are only parsed in the XY plane (G17).
+    With a fixed point set, coordinates are read onto its grid exactly, and written
+    from their integer units.
+    The buffer records the entries each line of the file gave (see
+    GCodeBuffer.set_source_lines).
+    Files of parallelMin bytes or more are parsed by procs processes (0: all cores), in
+    byte ranges cut at line breaks; lines relying on the modal motion or plane set in an
+    earlier range are completed while stitching the ranges in order.
     """
+    parallelMin = 8 << 20
+
     def __init__(self):
         GenericParser.__init__(self, GCodeBuffer)
+        self.__report = OrderedDict()
+        self.__procs  = 1
+        self.__modalAxes = False
+
+    @property
+    def report(self) -> OrderedDict:
+        """
+        Counts of the last parse: lines, motions, arcs, verbatim (lines kept as text),
+        skipped_arcs, and prefixed (motion lines holding other words).
+        """
+        return self.__report
+
+    @property
+    def modal_axes(self) -> bool:
+        """ Whether lines with coordinates but no G word continue the modal motion. """
+        return self.__modalAxes
+
+    @modal_axes.setter
+    def modal_axes(self, value):
+        if type(value) is not bool:
+            raise TypeError
+        self.__modalAxes = value
+
+    @property
+    def procs(self) -> int:
+        return self.__procs
+
+    @procs.setter
+    def procs(self, value):
+        if type(value) is not int:
+            raise TypeError
+        self.__procs = value
 
     def parse_file(self, fpath = None) -> bool:
         if not super().parse_file(fpath):
             return False
 
-        gfd = open(self.filepath, 'r')
-        print('Parsing GCode file {}'.format(self.filepath))
+        log.info('Parsing GCode file {}', self.filepath)
+        nbytes = os.path.getsize(self.filepath)
+        procs  = self.__procs if self.__procs > 0 else (os.cpu_count() or 1)
+        detail   = logging.INFO if self.verbose else logging.DEBUG
+        # First lines kept as text, in detail; their counts are reported below
+        verbatim = Tally(log, level=detail)
+        badarcs  = Tally(log, level=detail)
+        rd = _GCodeReader(self.fixed,
+                          verbatim=lambda n, l: verbatim('Line {} - not a G command: {}', n, l.strip()),
+                          badarc=lambda n, l: badarcs('Line {} - arc not in the XY plane or without center: {}',
+                                                      n, l.strip()),
+                          modal_axes=self.__modalAxes)
+        if procs > 1 and nbytes >= self.parallelMin:
+            r = self.__parse_parallel(rd, nbytes, procs)
+        else:
+            r = self.__parse_serial(rd, nbytes)
+        if r is None:
+            return False
+        data, starts = r
+
+        lineno = len(starts)
+        self.buffer.data = data
+        self.buffer.set_source_lines(starts)
+        log.info('Parsed {} lines, with {} valid G commands ({} arcs)', lineno, rd.motions, rd.arcs)
+        if rd.badarcs:
+            log.warning('GCodeParser: kept {} arcs not in the XY plane or without center verbatim', rd.badarcs)
+        if rd.verbatim:
+            log.log(detail, 'GCodeParser: kept {} lines verbatim', rd.verbatim)
+        if rd.prefixed:
+            log.log(detail, 'GCodeParser: kept the other words of {} motion lines beside their blocks', rd.prefixed)
+        self.__report = OrderedDict([('lines', lineno), ('motions', rd.motions), ('arcs', rd.arcs),
+                                     ('verbatim', rd.verbatim), ('skipped_arcs', rd.badarcs),
+                                     ('prefixed', rd.prefixed)])
+        return True
 
+    def __parse_serial(self, rd: _GCodeReader, nbytes: int):
+        """ :return: (entries, first entry of each line), or None on error. """
+        data   = list()
+        starts = list()
+        nread  = 0
         lineno = 0
-        gcmdno = 0
-        for line in gfd:
-            lineno += 1
-            # Is line a G00 or G01?
-            x, y, z, f, g = [None for _ in range(5)]
-            for m in re.finditer('.*G(?P<g>[0-9\.]*)|.*F(?P<f>[0-9\.]*)|.*X(?P<x>[0-9\.-]*)|'
-                                 '.*Y(?P<y>[0-9\.-]*)|.*Z(?P<z>[0-9\.-]*)', line):
+        with open(self.filepath, 'r') as gfd:
+            for line in gfd:
+                lineno += 1
+                nread  += len(line)
+                starts.append(len(data))
+                if lineno & 4095 == 0:
+                    progress(nread, nbytes, 'bytes')
                 try:
-                    x = float(m.group('x')) if m.group('x') is not None else x
-                    y = float(m.group('y')) if m.group('y') is not None else y
-                    z = float(m.group('z')) if m.group('z') is not None else z
-                    f = float(m.group('f')) if m.group('f') is not None else f
-                    g = int(m.group('g'))   if m.group('g') is not None else g
-                except:
-                    print('In GCode file: unable to processes line {}'.format(line))
-                    return False
-            # Currently accept only G01 and G00 as motion codes
-            if any([i is not None for i in [x, y, z, f, g]]) and g in [0,1]:
-                self.buffer.append((g, f, x, y, z))
-                gcmdno += 1
-            # Line was not recognized as a G command; archive it entirely
-            else:
-                self.buffer.append(line)
-                if self.verbose:
-                    print('Line {} - not a G command: {}'.format(lineno, line.replace('\n','').replace('\r','')))
-
-        gfd.close()
-        print('Parsed {} lines, with {} valid G commands'.format(lineno, gcmdno))
-        return True
+                    data += rd.read(line, lineno)
+                except ValueError:
+                    log.error('In GCode file: unable to processes line {}', line)
+                    return None
+        return data, starts
+
+    def __parse_parallel(self, rd: _GCodeReader, nbytes: int, procs: int):
+        """ :return: (entries, first entry of each line), or None on error. """
+        # Ranges start right after a line break
+        bounds = [0]
+        with open(self.filepath, 'rb') as fd:
+            for k in range(1, procs * 4):
+                fd.seek(k * nbytes // (procs * 4))
+                fd.readline()
+                if bounds[-1] < fd.tell() < nbytes:
+                    bounds.append(fd.tell())
+        bounds.append(nbytes)
+        digits = None if self.fixed is None else self.fixed.digits
+        log.info('GCodeParser: parsing {} byte ranges in {} processes', len(bounds) - 1, procs)
+
+        res = list()
+        with ProcessPoolExecutor(procs) as ex:
+            try:
+                for r in ex.map(_parse_gcode_range, [self.filepath] * (len(bounds) - 1),
+                                bounds[:-1], bounds[1:], [digits] * (len(bounds) - 1),
+                                [self.__modalAxes] * (len(bounds) - 1)):
+                    if r[0] is None:
+                        log.error('In GCode file: unable to processes line {}', r[1])
+                        ex.shutdown(wait=False, cancel_futures=True)
+                        return None
+                    res.append(r)
+                    progress(bounds[len(res)], nbytes, 'bytes')
+            except JobCancelled:
+                ex.shutdown(wait=False, cancel_futures=True)
+                raise
+
+        # Stitch in order, completing pending lines with the state left by earlier ranges
+        data   = list()
+        starts = list()
+        lineno = 0
+        for entries, pending, first, n, motions, arcs, verb, bad, prefixed, modal, plane in res:
+            base, k = len(data), 0
+            grown = [0]  # entries added before each pending one, by the ones resolved earlier
+            for i in pending:
+                data += entries[k:i]
+                es = rd.resolve(entries[i], rd.modal, rd.plane, lineno)
+                data += es
+                grown.append(grown[-1] + len(es) - 1)
+                k = i + 1
+            data += entries[k:]
+            starts += [base + s + grown[bisect.bisect_left(pending, s)] for s in first]
+            rd.motions  += motions
+            rd.arcs     += arcs
+            rd.verbatim += verb
+            rd.badarcs  += bad
+            rd.prefixed += prefixed
+            rd.modal = rd.modal if modal == _UNKNOWN else modal
+            rd.plane = rd.plane if plane == _UNKNOWN else plane
+            lineno += n
+        return data, starts
 
     def write_file(self, fpath, buffer=None) -> bool:
         if fpath is None or fpath.strip() is '':
             return False
         if type(buffer) is not GCodeBuffer:
-            print('GCodeParser: wrong buffer type.')
+            log.error('GCodeParser: wrong buffer type.')
             return False
         try:
             ofd = open(fpath, 'w')
         except:
-            print('GCodeParser: {}'.format(sys.exc_info()[1]))
+            log.error('GCodeParser: {}', sys.exc_info()[1])
             return False
         if buffer is None:
             buffer = self.buffer
 
+        fp  = self.fixed
+        fmt = dict()  # units -> formatted coordinate; exact, as coordinates repeat often
+        prefix = ''   # words of the next motion block's line (see GCodeBuffer)
         for bl in buffer:
             #print(bl)
             if not GCodeBuffer.is_motion(bl):
-                ofd.write('{}'.format(bl))
+                if prefix:
+                    ofd.write('{}\n'.format(prefix.rstrip(' ')))
+                    prefix = ''
+                if type(bl) is str and bl and not bl.endswith('\n'):
+                    prefix = bl
+                else:
+                    ofd.write('{}'.format(bl))
                 continue
-            line = str()
+            words = [prefix.rstrip(' ')] if prefix else []
+            prefix = ''
             g = GCodeBuffer.get_gc(bl)
             f = GCodeBuffer.get_fr(bl)
-            p = GCodeBuffer.get_pt(bl)
             if g is not None:
-                line += 'G0{} '.format(g)
+                words.append('G0{}'.format(g))
             if f is not None:
-                line += 'F{} '.format(f)
-            for i, a in enumerate(['X','Y','Z']):
-                line += ' {}{}'.format(a, p[i]) if p[i] is not None else ''
-            ofd.write('{}\n'.format(line))
+                words.append('F{}'.format(f))
+            v = GCodeBuffer.get_pt(bl)
+            a = ['X', 'Y', 'Z']
+            if GCodeBuffer.is_arc(bl):
+                v += GCodeBuffer.get_arc(bl)
+                a += ['I', 'J', 'R']
+            if fp is None:
+                words += ['{}{}'.format(a[i], v[i]) for i in range(len(v)) if v[i] is not None]
+            else:
+                for i in range(len(v)):
+                    if v[i] is not None:
+                        u = fp.units(v[i])
+                        t = fmt.get(u)
+                        if t is None:
+                            t = fmt[u] = fp.format(u)
+                        words.append(a[i] + t)
+            ofd.write('{}\n'.format(' '.join(words)))
+        if prefix:
+            ofd.write('{}\n'.format(prefix.rstrip(' ')))
         ofd.close()
         return True
 
@@ -252,92 +575,369 @@ class ExcellonParser(GenericParser):
     """
     Reads/parses Excellon drill files.
     All values are converted to and handled in mm.
+    Supports LZ/TZ zero suppression, implied decimals, absolute and incremental
+    (ICI, G91) coordinates and repeat codes (R).
     """
+    __token  = re.compile('([A-Z])([+-]?[0-9.]*)')
+    __coord  = re.compile('(?:X([+-]?[0-9.]+))?(?:Y([+-]?[0-9.]+))?$')
+    __digits = re.compile(';\\s*FILE_FORMAT\\s*=\\s*([0-9]+):([0-9]+)')
+
     def __init__(self):
         GenericParser.__init__(self, ExcellonBuffer)
 
-        self.__excellonFormat = None
-        self.__excellonZeroT  = None
+        self.__metric = None  # Units; None while undefined
+        self.__zeros  = 'LZ'  # Zeros kept in implied-decimal numbers: LZ (leading) or TZ (trailing)
+        self.__format = None  # (integer, decimal) digits of implied-decimal numbers
+        self.__incremental = False
+        self.__drilling    = True  # False in routing mode
 
-        # Dictionary indexed by toolname; tuple with diameter/drill list (list of X/Y tuples).
-        # All units are metric
-        self.__drill = OrderedDict()
-        self.__drill['T0'] = (-1, []) # Default tool; may be empty (diam = -1)
-        self.__currdrill   = None
+        # Tool number -> diameter (mm)
+        self.__tools    = OrderedDict()
+        self.__currtool = None
+        self.__pos      = [0.0, 0.0]
+        # Drills, as consecutive (tool, x, y) triples
+        self.__holes    = array('d')
+        self.__skipped  = 0
 
     def parse_file(self, fpath = None) -> bool:
         if not super().parse_file(fpath):
             return False
 
-        efd = open(self.filepath, 'r')
-        print('Parsing drill file {}'.format(self.filepath))
-
-        for line in efd:
-            # Is line a comment?
-            if re.match('[\s\t]*;.*', line) is not None:
-                continue
-            # If file uses incremental (ICI) mode, break; unsupported
-            if re.match('[\s\t]*ICI', line) is not None:
-                print('Excellon file uses unsupported incremental mode (ICI).')
-                return False
-            # Is line a format definition?
-            m = re.match('[\s\t]*(?P<format>\w*),(?P<zerot>\w*)', line)
-            if m is not None and m.group('format') and m.group('zerot'):
-                self.__excellonFormat = m.group('format').upper()
-                self.__excellonZeroT  = m.group('zerot').upper()
-            # Is line a tool definition?
-            m = re.match('[\s\t]*(?P<id>T[0-9]*)C(?P<diam>[0-9\.]*)', line)
-            if m is not None and m.group('id') and m.group('diam'):
+        log.info('Parsing drill file {}', self.filepath)
+        self.__metric, self.__zeros, self.__format = None, 'LZ', None
+        self.__incremental, self.__drilling = False, True
+        self.__tools.clear()
+        self.__currtool = None
+        self.__pos   = [0.0, 0.0]
+        self.__holes = array('d')
+        self.__skipped = 0
+
+        with open(self.filepath, 'r') as efd:
+            for lineno, line in enumerate(efd, 1):
+                if lineno & 4095 == 0:
+                    progress(len(self.__holes) // 3, None, 'drills')
+                line = line.strip().upper()
+                if not line:
+                    continue
                 try:
-                    diam = float(m.group('diam'))
-                except:
-                    print('In excellon file: incorrect definition for {}'.format(m.group('id')))
+                    if not self.__parse_line(line):
+                        break
+                except ValueError as e:
+                    log.error('In excellon file, line {}: {}', lineno, e)
                     return False
-                self.__drill[m.group('id')] = (diam, [])
-            # Is line beginnig a tool group?
-            m = re.match('[\s\t]*(?P<id>T[0-9]*)[^.]*', line)
-            if m is not None and m.group('id'):
-                id = m.group('id')
-                if id not in self.__drill:
-                    print('In excellon file: undefined tool {}'.format(id))
-                    return False
-                self.__currdrill = id
-            # Is line a drill definition?
-            m = re.match('.*X(?P<x>[0-9\.]*)Y(?P<y>[0-9\.]*)', line)
-            if m is not None and m.group('x') and m.group('y') and self.__currdrill is not None:
-                try:
-                    x = self.__convert_unit(float(m.group('x')))
-                    y = self.__convert_unit(float(m.group('y')))
-                except:
-                    print('In excellon file: unable to parse drill - {}'.format(m.group(0)))
-                    return False
-                self.__drill[self.__currdrill][1].append((x, y))
-        efd.close()
-        # Translate dictionary into system-wide usable buffer
+        if self.__skipped:
+            log.warning('In excellon file: ignored {} drills without a selected tool.', self.__skipped)
+        # Translate drill array into system-wide usable buffer
         self.__gen_drill_buffer()
         return True
 
-    def __gen_drill_buffer(self):
+    def __parse_line(self, line) -> bool:
         """
-        Returns self.drill organized into a list of tuples:
-        (diam, x, y)
+        Parses one (stripped, upper case) line.
+        :return: False once the end of program is reached.
         """
-        self.buffer.clear()
-        for t in self.__drill:
-            for d in self.__drill[t][1]:
-                self.buffer.append([self.__drill[t][0], d[0], d[1]])
+        c = line[0]
+        # Plain coordinates, by far the most common line
+        if c == 'X' or c == 'Y':
+            m = self.__coord.match(line)
+            if m is not None:
+                self.__drill(m.groups())
+                return True
+        # Comment; may carry the number format
+        if c == ';':
+            m = self.__digits.match(line)
+            if m is not None:
+                self.__format = (int(m.group(1)), int(m.group(2)))
+            return True
+        # Header keywords: units/zeros/format, incremental mode; others are ignored
+        if c.isalpha() and len(line) > 1 and line[1].isalpha():
+            fields = line.split(',')
+            if fields[0] in ['METRIC', 'INCH']:
+                self.__metric = fields[0] == 'METRIC'
+                for f in fields[1:]:
+                    if f in ['LZ', 'TZ']:
+                        self.__zeros = f
+                    elif re.match('0+\\.0+$', f) is not None:
+                        self.__format = tuple(len(i) for i in f.split('.'))
+            elif fields[0] == 'ICI':
+                self.__incremental = len(fields) < 2 or fields[1] != 'OFF'
+            return True
+
+        xy = [None, None]
+        repeat = None
+        for letter, value in self.__token.findall(line):
+            if letter in 'XY':
+                xy['XY'.index(letter)] = value
+            elif letter == 'T':
+                self.__tool(line)
+                return True
+            elif letter == 'R':
+                repeat = int(value)
+            elif letter == 'G':
+                g = int(value)
+                if g == 85:  # Slot; drill its start, then its end
+                    self.__drill(xy)
+                    xy = [None, None]
+                elif g in [5, 81]:
+                    self.__drilling = True
+                elif g in [0, 1, 2, 3]:
+                    self.__drilling = False
+                elif g in [90, 91]:
+                    self.__incremental = g == 91
+            elif letter == 'M':
+                m = int(value)
+                if m in [0, 30]:
+                    return False
+                elif m in [71, 72]:
+                    self.__metric = m == 71
+        if repeat is not None:
+            dx, dy = [self.__number(i) if i else 0.0 for i in xy]
+            for _ in range(repeat):
+                self.__pos = [self.__pos[0] + dx, self.__pos[1] + dy]
+                self.__add_hole()
+        else:
+            self.__drill(xy)
+        return True
 
-    def __convert_unit(self, value) -> float:
+    def __tool(self, line):
+        """ Tool definition (T<n>C<diam>...) or selection (T<n>). """
+        tokens = dict(self.__token.findall(line))
+        t = int(tokens['T'])
+        if 'C' in tokens:
+            if not tokens['C']:
+                raise ValueError('incorrect definition for T{}'.format(t))
+            self.__tools[t] = self.__unit(float(tokens['C']))
+        elif t == 0:
+            self.__currtool = None
+            return
+        elif t not in self.__tools:
+            raise ValueError('undefined tool T{}'.format(t))
+        self.__currtool = t
+
+    def __drill(self, xy):
+        """ Moves to (possibly partial) coordinates xy and, if drilling, adds a hole there. """
+        if xy[0] is None and xy[1] is None:
+            return
+        for i in range(2):
+            if xy[i]:
+                v = self.__number(xy[i])
+                self.__pos[i] = self.__pos[i] + v if self.__incremental else v
+        if self.__drilling:
+            self.__add_hole()
+
+    def __add_hole(self):
+        if self.__currtool is None:
+            self.__skipped += 1
+            return
+        if self.fixed is not None:
+            # Incremental moves add up off the grid
+            self.__pos = [self.fixed.snap(i) for i in self.__pos]
+        self.__holes.extend((self.__currtool, self.__pos[0], self.__pos[1]))
+
+    def __number(self, s) -> float:
+        """
+        Converts a coordinate (explicit or implied decimal) into mm.
+        With a fixed point set, the digits are scaled onto its grid with integer arithmetic.
         """
-        Converts and returns the input value into an absolute metric value.
+        u = self.__unit(1.0)
+        intd, decd = self.__format if self.__format is not None else \
+            ((3, 3) if self.__metric else (2, 4))
+        fp = self.fixed
+        if fp is not None:
+            exp = 0 if '.' in s else -decd if self.__zeros == 'TZ' else \
+                intd - len(s) + (s[0] in '+-')
+            return fp.mm(fp.parse(s, exp) if self.__metric else fp.parse(s, exp, 254, 10))
+        if '.' in s:
+            return float(s) * u
+        if self.__zeros == 'TZ':
+            # Trailing zeros kept, leading ones suppressed: count decimals from the right
+            return int(s) * u / 10.0 ** decd
+        # Leading zeros kept, trailing ones suppressed: count integers from the left
+        return int(s) * u * 10.0 ** (intd - len(s) + (s[0] in '+-'))
+
+    def __unit(self, value) -> float:
+        """
+        Converts and returns the input value into a metric value.
         All units are in mm.
+        """
+        if self.__metric is None:
+            raise ValueError('incorrect format definition, units not declared.')
+        return value if self.__metric else value * 25.4
 
-        \TODO: Support LT and TZ schemes, investigate further formats.
+    def __gen_drill_buffer(self):
         """
-        if self.__excellonFormat is None or self.__excellonZeroT is None:
-            print('Incorrect format definition for excellon file.')
-            raise Exception
-        if self.__excellonFormat == 'METRIC':
-            return value
-        elif self.__excellonFormat == 'INCH':
-            return value * 25.4
\ No newline at end of file
+        Loads the tool table and the drill array into the buffer.
+        """
+        self.buffer.load(self.__tools, np.frombuffer(self.__holes, dtype=float))
+
+
+class GerberParser(GenericParser):
+    """
+    Reads Gerber (RS-274X) layers into a GerberBuffer, in mm.
+    Supports circle, rectangle, obround and polygon apertures (polygons are taken as
+    their circumscribed circle), linear and circular interpolation (arcs are replaced by
+    lines deviating less than arcTol), regions and dark/clear polarity.
+    Objects drawn with aperture macros are skipped; step and repeat is not supported.
+    """
+    arcTol = 0.001  # mm
+
+    __extended = re.compile('%([^%]*)%|([^%*]*)\\*')
+    __word     = re.compile('([GDMXYIJ])([+-]?[0-9]+)')
+    __aperture = re.compile('ADD([0-9]+)([A-Za-z_$.][A-Za-z0-9_.$]*)(?:,(.*))?', re.S)
+    __standard = {'C': 1, 'R': 2, 'O': 2, 'P': 2}  # standard apertures, and their required modifiers
+
+    def __init__(self):
+        GenericParser.__init__(self, GerberBuffer)
+
+        self.__metric = True
+        self.__format = (2, 6)  # (integer, decimal) digits
+        self.__trailing = False  # True if trailing zeros are omitted
+        self.__apertures = dict()
+
+    def parse_file(self, fpath=None) -> bool:
+        if not super().parse_file(fpath):
+            return False
+
+        log.info('Parsing Gerber file {}', self.filepath)
+        with open(self.filepath, 'r') as gfd:
+            text = gfd.read()
+        self.__metric, self.__format, self.__trailing = True, (2, 6), False
+        self.__apertures = dict()
+
+        obs  = list()
+        dark = True
+        ap   = None  # current aperture number
+        pos  = [0.0, 0.0]
+        mode = 1  # 1 linear, 2 clockwise, 3 counterclockwise
+        quadrant = 'multi'
+        region = None  # contours of the open region, if any
+        skipped = 0
+        for n, m in enumerate(self.__extended.finditer(text)):
+            if n & 4095 == 0:
+                progress(m.start(), len(text), 'bytes')
+            try:
+                if m.group(1) is not None:
+                    for cmd in m.group(1).split('*'):
+                        cmd = cmd.strip()
+                        if cmd.startswith('LP'):
+                            dark = cmd[2:3] != 'C'
+                        else:
+                            self.__parameter(cmd)
+                    continue
+                cmd = m.group(2).strip()
+                if not cmd or cmd.startswith('G04') or cmd.startswith('G4 '):
+                    continue
+                w = {}
+                for c, v in self.__word.findall(cmd):
+                    if c == 'G' or c == 'D':
+                        w.setdefault(c, []).append(int(v))
+                    else:
+                        w[c] = v
+                for g in w.get('G', []):
+                    if g in (1, 2, 3):
+                        mode = g
+                    elif g == 74:
+                        quadrant = 'single'
+                    elif g == 75:
+                        quadrant = 'multi'
+                    elif g in (70, 71):
+                        self.__metric = g == 71
+                    elif g == 36:
+                        region = [[]]
+                    elif g == 37:
+                        obs += [('P', dark, c) for c in region if len(c) > 2]
+                        region = None
+                if 'M' in w and int(w['M']) == 2:
+                    break
+                for d in w.get('D', []):
+                    if d >= 10:
+                        ap = d
+                        continue
+                    end = [self.__coord(w['X']) if 'X' in w else pos[0],
+                           self.__coord(w['Y']) if 'Y' in w else pos[1]]
+                    if d == 1:
+                        pts = [end]
+                        if mode in (2, 3):
+                            ij = [self.__coord(w.get('I', '0')), self.__coord(w.get('J', '0'))]
+                            pts = self.__arc(pos, end, ij, mode == 2, quadrant)
+                        if region is not None:
+                            if not region[-1]:
+                                region[-1].append(list(pos))
+                            region[-1] += pts
+                        elif self.__apertures.get(ap) is None:
+                            skipped += 1
+                        else:
+                            p0 = pos
+                            for p1 in pts:
+                                obs.append(('L', dark, self.__apertures[ap], p0[0], p0[1], p1[0], p1[1]))
+                                p0 = p1
+                    elif d == 2:
+                        if region is not None and region[-1]:
+                            region.append([])
+                    elif d == 3:
+                        if self.__apertures.get(ap) is None:
+                            skipped += 1
+                        else:
+                            obs.append(('F', dark, self.__apertures[ap], end[0], end[1]))
+                    pos = end
+            except (ValueError, KeyError, IndexError) as e:
+                log.error('In Gerber file, at {}: {}', m.group(0).strip(), e)
+                return False
+        if skipped:
+            log.warning('In Gerber file: skipped {} objects with undefined or macro apertures.', skipped)
+        self.buffer.data = obs
+        log.info('Parsed {} objects', len(obs))
+        return True
+
+    def __parameter(self, cmd):
+        if cmd.startswith('FS'):
+            m = re.match('FS([LT])([AI])X([0-9])([0-9])Y([0-9])([0-9])', cmd)
+            if m is None:
+                raise ValueError('unsupported format {}'.format(cmd))
+            if m.group(2) == 'I':
+                raise ValueError('incremental coordinates are not supported.')
+            self.__trailing = m.group(1) == 'T'
+            self.__format = (int(m.group(3)), int(m.group(4)))
+        elif cmd.startswith('MO'):
+            self.__metric = cmd[2:4] == 'MM'
+        elif cmd.startswith('AD'):
+            m = self.__aperture.fullmatch(cmd)
+            if m is None:
+                raise ValueError('invalid aperture {}'.format(cmd))
+            t = m.group(2)
+            ap = None  # aperture macro, or a standard one lacking modifiers
+            if t in self.__standard:
+                mods = [float(v) for v in (m.group(3) or '').split('X') if v.strip()]
+                if len(mods) < self.__standard[t]:
+                    log.warning('In Gerber file: aperture {} lacks modifiers; its objects are skipped.', cmd)
+                elif t in ('C', 'P'):
+                    ap = ('C', self.__unit(mods[0]))  # polygons by their outer diameter
+                else:
+                    ap = (t, self.__unit(mods[0]), self.__unit(mods[1]))
+            self.__apertures[int(m.group(1))] = ap
+        elif cmd.startswith('SR') and cmd not in ('SR', 'SRX1Y1I0J0'):
+            raise ValueError('step and repeat is not supported.')
+
+    def __unit(self, value) -> float:
+        return value if self.__metric else value * 25.4
+
+    def __coord(self, s: str) -> float:
+        sign = -1.0 if s.startswith('-') else 1.0
+        s = s.lstrip('+-')
+        if self.__trailing:
+            s = s.ljust(sum(self.__format), '0')
+        return self.__unit(sign * int(s) / 10.0 ** self.__format[1])
+
+    def __arc(self, p0, p1, ij, cw: bool, quadrant) -> list:
+        """ Points of an arc, p0 excluded. Single quadrant arcs take the signs of i and j that fit. """
+        q0 = [p0[0], p0[1], 0.0]
+        q1 = [p1[0], p1[1], 0.0]
+        if quadrant == 'multi':
+            geom = arc_geometry(q0, q1, ij + [None], cw)
+        else:
+            cand = [arc_geometry(q0, q1, [si * abs(ij[0]), sj * abs(ij[1]), None], cw)
+                    for si in (1, -1) for sj in (1, -1)]
+            # A quarter turn at most; any sweep is a full circle when start and end coincide
+            cand = [g if abs(g[2]) < 2.0 * np.pi else g[:2] + (0.0,) + g[3:] for g in cand]
+            geom = min(cand, key=lambda g: (abs(g[2]) > np.pi / 2.0 + 1e-9, abs(g[3] - g[4])))
+        return arc_linearize(q0, q1, geom, self.arcTol)[:, 0:2].tolist()
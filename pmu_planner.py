@@ -2,30 +2,57 @@ from collections import OrderedDict
 from enum import Enum
 
 from pmu_workspace import *
+from pmu_spatial import *
+from pmu_jobs import progress, JobCancelled
+from pmu_probe import Probing
+from pmu_log import getLogger, Tally
 
-import scipy as sp
+import numpy as np
 from scipy import interpolate
+from scipy.interpolate import griddata
 from scipy.spatial.distance import pdist
+from scipy import ndimage
 
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import difflib
 import re
 import sys
 import os
 
 
+log = getLogger('planner')
+
+
 class pmuPlanner:
     """
     Implements handling of main functions (leveling, cropping, redo, painting...).
     Holds references to active files (gcode, drill, hmap) and output gcode buffer.
+    Every new work buffer is recorded in the history, to be undone and redone.
     """
     def __init__(self):
         self.activeGCodeFile = None
         self.activeDrillFile = None
         self.activeHMapFile  = None
+        self.activeBCuFile   = None
+        self.activeRegFile   = None
+        self.activeGerberFile = None
 
         self.__buff     = GenericBuffer()
         self.__buffDesc = ''
 
         self.__Leveler  = Leveling()
+        self.__Cropper  = Cropping()
+        self.__Optimizer = Optimizing()
+        self.__HMapCheck = HMapCheck()
+        self.__Estimator = Estimating()
+        self.__History   = BufferHistory()
+        self.__Driller   = Drilling()
+        self.__BackSide  = BackSide()
+        self.__Resumer   = Resuming()
+        self.__Isolator  = Isolating()
+        self.__Prober    = Probing()
+        self.__Mesher    = Meshing()
 
     @property
     def buffer(self):
@@ -43,46 +70,388 @@ class pmuPlanner:
     def Leveler(self):
         return self.__Leveler
 
+    @property
+    def Cropper(self):
+        return self.__Cropper
+
+    @property
+    def Optimizer(self):
+        return self.__Optimizer
+
+    @property
+    def HMapChecker(self):
+        return self.__HMapCheck
+
+    @property
+    def Estimator(self):
+        return self.__Estimator
+
+    @property
+    def History(self):
+        return self.__History
+
+    @property
+    def Driller(self):
+        return self.__Driller
+
+    @property
+    def BackSide(self):
+        return self.__BackSide
+
+    @property
+    def Resumer(self):
+        return self.__Resumer
+
+    @property
+    def Isolator(self):
+        return self.__Isolator
+
+    @property
+    def Prober(self):
+        return self.__Prober
+
+    @property
+    def Mesher(self):
+        return self.__Mesher
+
+    def __set_buffer(self, buff: GenericBuffer, desc: str):
+        self.__buff     = buff
+        self.__buffDesc = desc
+        self.__History.push(buff, desc)
+
+    def undo(self) -> bool:
+        if not self.__History.undo():
+            log.warning('Planner: nothing to undo.')
+            return False
+        self.__buff, self.__buffDesc = self.__History.restore()
+        return True
+
+    def redo(self) -> bool:
+        if not self.__History.redo():
+            log.warning('Planner: nothing to redo.')
+            return False
+        self.__buff, self.__buffDesc = self.__History.restore()
+        return True
+
     def leveling_set_params(self, probLims, probTick):
         try: self.__Leveler.set_probing_params(probLims, probTick)
-        except: print('Planner: wrong probing parameters.')
+        except: log.error('Planner: wrong probing parameters.')
 
     def leveling_gen_grid(self, drills=None, mirrpos=None, mirrax=None) -> bool:
         try: r = self.__Leveler.gen_probing_grid(drills, mirrpos, mirrax)
         except:
-            print('Planner: {}'.format(sys.exc_info()[1]))
+            log.error('Planner: {}', sys.exc_info()[1])
             return False
         if r:
-            self.__buff     = self.__Leveler.probingGrid
-            self.__buffDesc = '{} probing points'.format(self.__buff.size)
+            g = self.__Leveler.probingGrid
+            self.__set_buffer(g, '{} probing points'.format(g.size))
+        return r
+
+    def probing_run(self, gridbuff: GridBuffer, hmappath: str, drills=None) -> bool:
+        if gridbuff.empty():
+            log.warning('Planner: no probing grid has been generated yet.')
+            return False
+        try: r = self.__Prober.run_probing(gridbuff, hmappath, drills)
+        except:
+            log.error('Planner: {}', sys.exc_info()[1])
+            return False
+        if r:
+            b = self.__Prober.probedHMap
+            self.__set_buffer(b, 'Probed heightmap, {} points'.format(b.size))
         return r
 
     def leveling_run(self, gcodebuff: GCodeBuffer, hmapbuff: HMapBuffer) -> bool:
         if gcodebuff.empty():
-            print('Planner: no active GCode has been loaded yet.')
+            log.warning('Planner: no active GCode has been loaded yet.')
             return False
         try: r = self.__Leveler.run_leveling(gcodebuff, hmapbuff)
         except:
-            print('Planner: {}'.format(sys.exc_info()[1]))
+            log.error('Planner: {}', sys.exc_info()[1])
+            return False
+        if r:
+            b = self.__Leveler.leveledGCode
+            self.__set_buffer(b, 'Leveled GCode, {} lines'.format(b.size))
+        return r
+
+    def leveling_run_back(self, bcubuff: GCodeBuffer, hmapbuff: HMapBuffer, regbuff=None) -> bool:
+        if bcubuff.empty():
+            log.warning('Planner: no back copper GCode has been loaded yet.')
+            return False
+        try:
+            back = self.__BackSide.derive(hmapbuff, regbuff)
+            r = self.__Leveler.run_leveling(bcubuff, back)
+        except:
+            log.error('Planner: {}', sys.exc_info()[1])
+            return False
+        if r:
+            b = self.__Leveler.leveledGCode
+            self.__set_buffer(b, 'Leveled back copper GCode, {} lines'.format(b.size))
+        return r
+
+    def backside_gen_reg_grid(self) -> bool:
+        try: g = self.__BackSide.reg_grid()
+        except:
+            log.error('Planner: {}', sys.exc_info()[1])
+            return False
+        self.__set_buffer(g, '{} registration points'.format(g.size))
+        return True
+
+    def cropping_tile_lims(self, gcodebuff: GCodeBuffer, col: int, row: int) -> Union[list, None]:
+        try: return self.__Cropper.tile_lims(gcodebuff, col, row)
+        except:
+            log.error('Planner: {}', sys.exc_info()[1])
+            return None
+
+    def cropping_run(self, gcodebuff: GCodeBuffer, lims=None) -> bool:
+        if gcodebuff.empty():
+            log.warning('Planner: no active GCode has been loaded yet.')
+            return False
+        try: r = self.__Cropper.run_cropping(gcodebuff, lims)
+        except:
+            log.error('Planner: {}', sys.exc_info()[1])
+            return False
+        if r:
+            b = self.__Cropper.croppedGCode
+            self.__set_buffer(b, 'Cropped GCode, {} lines'.format(b.size))
+        return r
+
+    def hmap_check(self, hmapbuff: HMapBuffer) -> bool:
+        if hmapbuff.empty():
+            log.warning('Planner: no heightmap has been loaded yet.')
+            return False
+        try: return self.__HMapCheck.run_check(hmapbuff)
+        except:
+            log.error('Planner: {}', sys.exc_info()[1])
+            return False
+
+    def hmap_reject(self, hmapbuff: HMapBuffer) -> bool:
+        try: n = self.__HMapCheck.reject(hmapbuff)
+        except:
+            log.error('Planner: {}', sys.exc_info()[1])
+            return False
+        log.info('Planner: replaced {} heightmap points by the fitted surface.', n)
+        return True
+
+    def hmap_gen_reprobe_grid(self) -> bool:
+        g = self.__HMapCheck.reprobe_grid()
+        if g.empty():
+            log.warning('Planner: no outliers to re-probe.')
+            return False
+        self.__set_buffer(g, '{} re-probing points'.format(g.size))
+        return True
+
+    def estimating_run(self, gcodebuff: GCodeBuffer) -> Union[OrderedDict, None]:
+        if gcodebuff.empty():
+            log.warning('Planner: no active GCode has been loaded yet.')
+            return None
+        try: return self.__Estimator.run_estimate(gcodebuff)
+        except:
+            log.error('Planner: {}', sys.exc_info()[1])
+            return None
+
+    def drilling_run(self, drills: ExcellonBuffer, hmapbuff: HMapBuffer) -> bool:
+        if drills.empty():
+            log.warning('Planner: no drill file has been loaded yet.')
+            return False
+        try:
+            surff = None
+            if hmapbuff.size >= 4:
+                surff = self.__Leveler.surface(hmapbuff)
+            else:
+                log.warning('Planner: no heightmap loaded, holes will not follow the surface.')
+            r = self.__Driller.run_drilling(drills, surff)
+        except:
+            log.error('Planner: {}', sys.exc_info()[1])
+            return False
+        if r:
+            b = self.__Driller.drillGCode
+            self.__set_buffer(b, 'Drilling GCode, {} lines'.format(b.size))
+        return r
+
+    def meshing_run(self, gcodebuff: GCodeBuffer, hmapbuff: HMapBuffer) -> bool:
+        if gcodebuff.empty():
+            log.warning('Planner: no active GCode has been loaded yet.')
+            return False
+        try: r = self.__Mesher.run_mesh(gcodebuff, hmapbuff, self.__Leveler.surface(hmapbuff))
+        except:
+            log.error('Planner: {}', sys.exc_info()[1])
+            return False
+        if r:
+            b = self.__Mesher.meshGCode
+            self.__set_buffer(b, 'Mesh leveled GCode, {} lines'.format(b.size))
+        return r
+
+    def isolating_run(self, gerbbuff: GerberBuffer) -> bool:
+        if gerbbuff.empty():
+            log.warning('Planner: no Gerber file has been loaded yet.')
+            return False
+        try: r = self.__Isolator.run_isolation(gerbbuff)
+        except:
+            log.error('Planner: {}', sys.exc_info()[1])
+            return False
+        if r:
+            b = self.__Isolator.isoGCode
+            self.__set_buffer(b, 'Isolation GCode, {} lines'.format(b.size))
+        return r
+
+    def resuming_run(self, gcodebuff: GCodeBuffer, line: int) -> bool:
+        if gcodebuff.empty():
+            log.warning('Planner: no active GCode has been loaded yet.')
+            return False
+        try: r = self.__Resumer.run_resume(gcodebuff, line)
+        except:
+            log.error('Planner: {}', sys.exc_info()[1])
             return False
         if r:
-            self.__buff     = self.__Leveler.leveledGCode
-            self.__buffDesc = 'Leveled GCode, {} lines'.format(self.__buff.size)
+            b = self.__Resumer.resumedGCode
+            self.__set_buffer(b, 'GCode resumed at line {}, {} lines'.format(line, b.size))
         return r
 
+    def optimizing_run(self, gcodebuff: GCodeBuffer) -> bool:
+        if gcodebuff.empty():
+            log.warning('Planner: no active GCode has been loaded yet.')
+            return False
+        try: r = self.__Optimizer.run_optimizing(gcodebuff)
+        except:
+            log.error('Planner: {}', sys.exc_info()[1])
+            return False
+        if r:
+            b = self.__Optimizer.optimizedGCode
+            self.__set_buffer(b, 'Optimized GCode, {} lines'.format(b.size))
+        return r
+
+
+class SurfaceCache(object):
+    """
+    Bounded LRU cache in front of a heightmap surface function.
+    Points are quantized to precision digits, keyed by their integer units, and the
+    surface is evaluated at the quantized point, so results do not depend on what is
+    cached. Callable like the surface: cache(x, y) returns the depth correction as a float.
+    """
+    def __init__(self, surff, precision=4, maxsize=65536):
+        self.__surff     = surff
+        self.__fp        = FixedPoint(precision)
+        self.__maxsize   = max(int(maxsize), 0)
+        self.__entries   = OrderedDict()
+        self.__hits   = 0
+        self.__misses = 0
+
+    def __call__(self, x, y) -> float:
+        k = (self.__fp.units(float(x)), self.__fp.units(float(y)))
+        z = self.__entries.get(k)
+        if z is not None:
+            self.__hits += 1
+            self.__entries.move_to_end(k)
+            return z
+        self.__misses += 1
+        z = np.asarray(self.__surff(self.__fp.mm(k[0]), self.__fp.mm(k[1]))).item()
+        if self.__maxsize:
+            self.__entries[k] = z
+            if len(self.__entries) > self.__maxsize:
+                self.__entries.popitem(last=False)
+        return z
+
+    @property
+    def hits(self) -> int:
+        return self.__hits
+
+    @property
+    def misses(self) -> int:
+        return self.__misses
+
+    @property
+    def size(self) -> int:
+        return len(self.__entries)
+
+    @property
+    def maxsize(self) -> int:
+        return self.__maxsize
+
+    def clear(self):
+        self.__entries.clear()
+        self.__hits   = 0
+        self.__misses = 0
+
+
+class HeightmapSurface(object):
+    """
+    Surface through the heightmap points; callable as surff(x, y), returning a float.
+    Points forming a full grid (every x with every y, as probed) are interpolated by a
+    spline on the grid, cubic with 4 or more ticks along both axes and linear otherwise.
+    Scattered points (some moved away from drills) are interpolated piecewise cubic
+    (Clough-Tocher) over their triangulation.
+    Outside the probed area the surface is extended flat: from the nearest edge of the
+    grid, or from the nearest point.
+    """
+    def __init__(self, points):
+        p = np.asarray(points, dtype=float).reshape(-1, 3)
+        xs = np.unique(p[:, 0])
+        ys = np.unique(p[:, 1])
+        if xs.size < 2 or ys.size < 2:
+            raise ValueError('Heightmap needs points at 2 different x and y at least.')
+        ix = np.searchsorted(xs, p[:, 0])
+        iy = np.searchsorted(ys, p[:, 1])
+        if p.shape[0] == xs.size * ys.size and np.unique(ix * ys.size + iy).size == p.shape[0]:
+            z = np.zeros((xs.size, ys.size))
+            z[ix, iy] = p[:, 2]
+            k = 3 if min(xs.size, ys.size) >= 4 else 1
+            self.__spline  = interpolate.RectBivariateSpline(xs, ys, z, kx=k, ky=k)
+            self.__lims    = [xs[0], xs[-1], ys[0], ys[-1]]
+            self.__scatter = None
+        else:
+            self.__spline  = None
+            self.__scatter = interpolate.CloughTocher2DInterpolator(p[:, 0:2], p[:, 2])
+            self.__nearest = interpolate.NearestNDInterpolator(p[:, 0:2], p[:, 2])
+
+    @property
+    def gridded(self) -> bool:
+        """ True if the points formed a full grid. """
+        return self.__spline is not None
+
+    def __call__(self, x, y) -> float:
+        if self.__spline is not None:
+            l = self.__lims
+            return float(self.__spline.ev(min(max(x, l[0]), l[1]), min(max(y, l[2]), l[3])))
+        z = float(self.__scatter(x, y))
+        return z if not np.isnan(z) else float(self.__nearest(x, y))
+
 
 class Leveling(DefaultWorkspace):
     """
     Explanation.
     """
+    # Parameters each cached result depends on
+    gridParams  = ['precision', 'drltol', 'drlscope', 'drlstep', 'maxiter', 'randiter',
+                   'probe_lims', 'probe_tick', 'mirrorax', 'mirrorval']
+    levelParams = ['precision', 'initialcoord', 'zthreshold', 'xysampling', 'arc_tol']
+    parallelMin = 20000  # buffers shorter than this are leveled serially
+
     def __init__(self):
         DefaultWorkspace.__init__(self)
 
         self.__probingGrid  = GridBuffer()
         self.__lvlGCodeBuff = GCodeBuffer() # Leveled GCode buffer
 
-        self.__verbose = True
         self.__surff   = None
+        self.__report  = OrderedDict()  # counts of the last grid generation and leveling
+        self.__fp      = FixedPoint(self[self.pt.precision])  # output coordinate grid
+
+        # Inputs the cached surface, grid and leveled GCode were computed from
+        self.__surfKey = None
+        self.__gridKey = None
+        self.__lvlKey  = None
+        self.__lvlVersion = None
+        self.__lvlSource  = None
+
+    def params_changed(self, keys: list):
+        if any(k in self.gridParams for k in keys):
+            self.__gridKey = None
+        if any(k in self.levelParams for k in keys):
+            self.__lvlKey = None
+        if any(k in [self.pt.precision, self.pt.surf_cache] for k in keys):
+            self.__surfKey = None
+        if self.pt.precision in keys:
+            self.__fp = FixedPoint(self[self.pt.precision])
 
     @property
     def probingGrid(self):
@@ -92,6 +461,11 @@ class Leveling(DefaultWorkspace):
     def leveledGCode(self) -> GCodeBuffer:
         return self.__lvlGCodeBuff
 
+    @property
+    def leveledSource(self) -> Union[GCodeBuffer, None]:
+        """ GCode buffer the leveled GCode was computed from. """
+        return self.__lvlSource
+
     def set_probing_params(self, probLims, probTick):
         """
         [float(i) for i in "[1 2 3]".replace('[','').replace(']','').strip().split(' ')]
@@ -109,9 +483,9 @@ class Leveling(DefaultWorkspace):
         """
         Generates coordinates for probing points.
         Updates self.__probingGrid
-        :param drills: List of excellon drills: [diam x y]. If None, ignored.
-        :param mirrpos: Position of mirroring axis.
-        :param mirrax:  Mirror axis parallel to ('x', 'y' or 0, 1)
+        :param drills: ExcellonBuffer. If None, ignored.
+        :param mirrpos: Position of mirroring axis. If None, mirrorval is used.
+        :param mirrax:  Mirror axis parallel to ('x', 'y' or 0, 1). If None, mirrorax is used.
         :return: True if probing points were correctly generated.
         """
         if drills is not None and type(drills) is not ExcellonBuffer:
@@ -120,63 +494,68 @@ class Leveling(DefaultWorkspace):
             raise TypeError
         if mirrax is not None and mirrax not in ['x', 'y', 0, 1]:
             raise ValueError
+        mirrax  = self[self.pt.mirrorax]  if mirrax  is None else mirrax
+        mirrpos = self[self.pt.mirrorval] if mirrpos is None else mirrpos
+        key = (None if drills is None else (id(drills), drills.version), mirrpos, mirrax)
+        if key == self.__gridKey and not self.__probingGrid.empty():
+            return True
+        self.__gridKey = None
+        grid = list()
 
-        # Copy input list
-        __drills = list(drills) if drills is not None else []
-        self.__probingGrid.clear()
-
-        # Mirroring drills if necessary
-        if drills and self[self.pt.mirrorax] in ['x', 'y']:
-            print('Leveler: mirroring drills parallel to {}, at {}'.format(
-                self[self.pt.mirrorax], self[self.pt.mirrorval]))
-            i = 1 if self[self.pt.mirrorax] is 'x' else 2
-            for d in __drills:
-                d[i] += 2*(self[self.pt.mirrorval] - d[i])
+        # Mirroring drills if necessary; the input buffer is left untouched
+        if drills is not None and mirrax in ['x', 'y', 0, 1]:
+            log.info('Leveler: mirroring drills parallel to {}, at {}', mirrax, mirrpos)
+            drills = drills.mirror(mirrax, mirrpos)
+        dxy  = drills.xy if drills is not None else np.zeros((0, 2))
+        drad = drills.diameters / 2.0 if drills is not None else np.zeros(0)
 
+        tol   = self[self.pt.drltol]
+        step  = self[self.pt.drlstep]
         probl = self[self.pt.probe_lims]
         probt = self[self.pt.probe_tick]
+        relocated = Tally(log, 'Leveler: relocated {} probing points away from drills')
         # Compute grid itself,
-        for xp in sp.linspace(probl[0], probl[1], probt[0]):
-            for yp in sp.linspace(probl[2], probl[3], probt[1]):
-                p = sp.array([xp, yp])
-
-                collision = False
-                drl2avoid = []
-                niter     = 0
-                for d in __drills:
-                    dist = pdist([p,d[1:3]])[0] # d = [diam x y]
-                    collision |= (dist - d[0]/2) < self[self.pt.drltol]
-                    if dist < self[self.pt.drlscope]:
-                        drl2avoid.append(d)
+        for xp in np.linspace(probl[0], probl[1], probt[0]):
+            for yp in np.linspace(probl[2], probl[3], probt[1]):
+                progress(len(grid), probt[0] * probt[1], 'points')
+                p = np.array([xp, yp])
+
+                dist = np.linalg.norm(dxy - p, axis=1)
+                collision = np.any(dist - drad < tol)
+                # Drills considered when avoiding (always including colliding ones)
+                near = (dist < self[self.pt.drlscope]) | (dist - drad < tol)
+                nxy, nrad = dxy[near], drad[near]
+                niter = 0
 
                 # If a collison is happening, move probing pt
                 while collision and niter < self[self.pt.maxiter]:
-                    sp.random.seed()
                     niter += 1
-                    d2p = [] # Vectors from drills to p
-                    for d in drl2avoid:
-                        v = sp.subtract(p,d[1:3])
-                        v = v/(sp.linalg.norm(2)**2)
-                        d2p.append(v)
-                    resultVec = sp.sum(d2p, axis=0)
-                    resultVec = self[self.pt.drlstep]*(resultVec/sp.linalg.norm(resultVec))
+                    # Vectors from drills to p, weighted by inverse distance
+                    d2p = p - nxy
+                    d2p = d2p / np.maximum(np.sum(d2p**2, axis=1), 1e-12)[:, None]
+                    resultVec = d2p.sum(axis=0)
+                    norm = np.linalg.norm(resultVec)
+                    resultVec = np.random.rand(2) - .5 if norm == 0.0 else resultVec / norm
                     # Apply fixed step to point
-                    p = sp.sum([p, resultVec], axis=0)
+                    p = p + step * resultVec
                     # Verify if collison if resolved
-                    collision = any([pdist([p,d[1:3]])[0] - d[0]/2 < self[self.pt.drltol] for d in drl2avoid])
+                    collision = np.any(np.linalg.norm(nxy - p, axis=1) - nrad < tol)
 
-                    if not collision and self.__verbose:
-                        print('Avoided drill by moving probe to {}'.format(p.round(4)))
+                    if not collision:
+                        relocated('Avoided drill by moving probe to {}', p.round(4))
                     # Not converging. Add some random motion.
                     if niter > self[self.pt.randiter]:
-                        randVec = self[self.pt.drlstep]*sp.array([sp.rand()-.5, sp.rand()-.5])
-                        p = sp.sum([p, randVec], axis=0)
+                        p = p + step * (np.random.rand(2) - .5)
 
                 if collision:
                     return False
 
                 # Append point to generated grid
-                self.__probingGrid.append(p.round(self[self.pt.precision]).tolist())
+                grid.append(p.round(self[self.pt.precision]).tolist())
+        relocated.done()
+        self.__probingGrid.data = grid
+        self.__gridKey = key
+        self.__report['relocated'] = relocated.count
         return True
 
     def run_leveling(self, gcodebuff: GCodeBuffer, hmapbuff: HMapBuffer):
@@ -190,25 +569,56 @@ class Leveling(DefaultWorkspace):
             raise TypeError
         if hmapbuff.size < 4:
             raise ValueError('Heightmap must have more than 4 entries.')
-        # Empty existing output buffer
-        self.__lvlGCodeBuff.clear()
-        cur_coord = self[self.pt.initialcoord]
-
-        # Creating surface function from heightmap
-        x, y, z = [list() for _ in range(3)]
-        for p in hmapbuff:
-            x.append(p[0])
-            y.append(p[1])
-            z.append(p[2])
-        _kind = 'cubic' if hmapbuff.size >= 16 else 'linear'
-        surff = interpolate.interp2d(x, y, z, kind=_kind)
+        key = (id(gcodebuff), gcodebuff.version, id(hmapbuff), hmapbuff.version)
+        if key == self.__lvlKey and self.__lvlGCodeBuff.version == self.__lvlVersion:
+            log.info('Leveler: inputs and parameters unchanged, leveled GCode is up to date')
+            return True
+        # New output buffer; the input may be the previous output
+        out = GCodeBuffer()
+        surff = self.surface(hmapbuff)
+        procs = self[self.pt.lvl_procs] if self[self.pt.lvl_procs] > 0 else (os.cpu_count() or 1)
+        hits, misses = surff.hits, surff.misses
+        src = gcodebuff.source_lines()
+        if procs > 1 and gcodebuff.size >= self.parallelMin:
+            out.data, newpts, firsts = self.__level_parallel(gcodebuff, hmapbuff, procs)
+        else:
+            firsts = list()
+            out.data, newpts = self.level_blocks(gcodebuff.data, self[self.pt.initialcoord], surff, firsts)
+            log.info('Leveler: surface cache {} hits, {} misses', surff.hits - hits, surff.misses - misses)
+        log.info('Leveler: added {} intermediary points to leveled GCode', newpts)
+        # Source file lines map to the leveled blocks, for resuming
+        if src is not None:
+            out.set_source_lines([firsts[k] for k in src])
+        self.__report.update([('blocks', out.size), ('added_points', newpts),
+                              ('cache_hits', surff.hits - hits), ('cache_misses', surff.misses - misses)])
+        self.__lvlGCodeBuff = out
+        self.__lvlSource    = gcodebuff
+        self.__lvlKey       = key
+        self.__lvlVersion   = out.version
+        return True
+
+    def level_blocks(self, blocks, cur_coord, surff, firsts=None) -> tuple:
+        """
+        Levels a run of GCode blocks.
+        :param blocks: Lines and motion blocks.
+        :param cur_coord: Absolute [x y z] before the first block.
+        :param surff: Surface function (see surface).
+        :param firsts: If a list, the output index of the first leveled block of every
+                       block is appended to it.
+        :return: (leveled blocks, number of points added)
+        """
+        out = list()
         newpts = 0
 
         # Apply leveling
-        for line in gcodebuff:
+        for k, line in enumerate(blocks):
+            if k & 4095 == 0:
+                progress(k, len(blocks), 'lines')
+            if firsts is not None:
+                firsts.append(len(out))
             # Throughput non-motion lines
             if not GCodeBuffer.is_motion(line):
-                self.__lvlGCodeBuff.append(line)
+                out.append(line)
                 continue
 
             # \TODO: GCodeBuffer checks for G00 and G01 cmds. Ideally, this should happen here.
@@ -216,40 +626,1437 @@ class Leveling(DefaultWorkspace):
             new_coord = GCodeBuffer.get_pt(line)
             for i in range(0,3):
                 new_coord[i] = cur_coord[i] if new_coord[i] is None else new_coord[i]
+            if GCodeBuffer.is_arc(line):
+                ep = self.__expand_arc(cur_coord, new_coord, GCodeBuffer.get_gc(line),
+                                       GCodeBuffer.get_arc(line), surff)
+                newpts += len(ep) - 1
+                for p, ij in ep:
+                    if ij is None:
+                        out.append((1, GCodeBuffer.get_fr(line), p[0], p[1], p[2]))
+                    else:
+                        out.append((GCodeBuffer.get_gc(line), GCodeBuffer.get_fr(line),
+                                    p[0], p[1], p[2], ij[0], ij[1], None))
+                cur_coord = new_coord
+                continue
             ep = self.__expand_points(cur_coord, new_coord, surff)
             newpts += len(ep) - 1
             for p in ep:
-                self.__lvlGCodeBuff.append((GCodeBuffer.get_gc(line), GCodeBuffer.get_fr(line),
-                                            p[0], p[1], p[2]))
+                out.append((GCodeBuffer.get_gc(line), GCodeBuffer.get_fr(line), p[0], p[1], p[2]))
             cur_coord = new_coord
-        print('Leveler: added {} intermediary points to leveled GCode'.format(newpts))
-        return True
+        return out, newpts
+
+    def __level_parallel(self, gcodebuff: GCodeBuffer, hmapbuff: HMapBuffer, procs: int) -> tuple:
+        """
+        Levels chunks of gcodebuff in a process pool; same output as level_blocks.
+        The start coordinate of each chunk is taken from the motion table, and every
+        worker builds the heightmap surface once.
+        :return: (leveled blocks, number of points added, output index of every block's first)
+        """
+        t = gcodebuff.motion_table(self[self.pt.initialcoord])
+        bounds = np.linspace(0, gcodebuff.size, procs * 4 + 1).astype(np.int64)
+        first = np.minimum(np.searchsorted(t.index, bounds[:-1]), max(t.size - 1, 0))
+        starts = t.start[first].tolist() if t.size else [self[self.pt.initialcoord]] * (bounds.size - 1)
+        chunks = [gcodebuff.data[a:b] for a, b in zip(bounds[:-1].tolist(), bounds[1:].tolist())]
+        log.info('Leveler: leveling {} chunks in {} processes', len(chunks), procs)
+        res = list()
+        with ProcessPoolExecutor(procs, initializer=_init_leveling_worker,
+                                 initargs=(self.dict, list(hmapbuff))) as ex:
+            try:
+                for r in ex.map(_level_chunk, chunks, starts):
+                    res.append(r)
+                    progress(int(bounds[len(res)]), gcodebuff.size, 'lines')
+            except JobCancelled:
+                ex.shutdown(wait=False, cancel_futures=True)
+                raise
+        firsts, n = list(), 0
+        for r in res:
+            firsts += [n + k for k in r[2]]
+            n += len(r[0])
+        return [bl for r in res for bl in r[0]], sum(r[1] for r in res), firsts
+
+    @property
+    def report(self) -> OrderedDict:
+        """
+        Counts of the last runs: relocated (probing points moved away from drills),
+        blocks, added_points, cache_hits and cache_misses (of the leveled GCode; cache
+        counts are those of this process, so 0 when leveled in parallel).
+        """
+        return self.__report
+
+    @property
+    def surfaceCache(self) -> Union[SurfaceCache, None]:
+        """ Cache of the last surface built (see surface). """
+        return self.__surff
+
+    def surface(self, hmapbuff: HMapBuffer) -> SurfaceCache:
+        """
+        Surface function interpolating the heightmap, behind a SurfaceCache of surf_cache
+        entries; rebuilt (emptying the cache) only when hmapbuff changes.
+        """
+        key = (id(hmapbuff), hmapbuff.version)
+        if key != self.__surfKey:
+            # Creating surface function from heightmap
+            self.__surff   = SurfaceCache(HeightmapSurface(list(hmapbuff)),
+                                          self[self.pt.precision], self[self.pt.surf_cache])
+            self.__surfKey = key
+        return self.__surff
 
     def __expand_points(self, p0, p1, surff) -> list:
         """
         ASCII drawing to come.
         """
         rl = list() # return list
-        p0 = sp.array(p0)
-        p1 = sp.array(p1)
-        dist = sp.linalg.norm(p1[0:2] - p0[0:2]) # 2d distance only
+        p0 = np.array(p0)
+        p1 = np.array(p1)
+        dist = np.linalg.norm(p1[0:2] - p0[0:2]) # 2d distance only
         # wont append starting point; is endpoint of previous segment;
         # automatically avoids printing start coordinate to outupt
         cz = surff(p0[0], p0[1])  # start point depth correction
         # number of tick points to inspect
-        n = int(sp.ceil(dist/self[self.pt.xysampling]))
+        n = int(np.ceil(dist/self[self.pt.xysampling]))
         if n > 1:
             # tick between start and end points
-            xt = sp.linspace(p0[0], p1[0], n, False)
-            yt = sp.linspace(p0[1], p1[1], n, False)
+            xt = np.linspace(p0[0], p1[0], n, False)
+            yt = np.linspace(p0[1], p1[1], n, False)
             for i in range(1,n): # don't iterate over start/endpoints
                 zi = surff(xt[i], yt[i]) # if new depth correction is too large,
                 if abs(zi - cz) > self[self.pt.zthreshold]:
                     cz = zi
-                    di = sp.linalg.norm(sp.array((xt[i], yt[i])) - p0[0:2])
+                    di = np.linalg.norm(np.array((xt[i], yt[i])) - p0[0:2])
                     z01= p0[2] + (p1[2]-p0[2])*(di/dist) # interpolate original depth
-                    rl.append([float(sp.round_(i, self[self.pt.precision])) for i in [xt[i], yt[i], z01 + cz]])
+                    rl.append([self.__fp.snap(float(i)) for i in [xt[i], yt[i], z01 + cz]])
         # append end point
         cz = surff(p1[0], p1[1])  # start point depth correction
-        rl.append([float(sp.round_(i, self[self.pt.precision])) for i in [p1[0], p1[1], p1[2] + cz]])
-        return rl
\ No newline at end of file
+        rl.append([self.__fp.snap(float(i)) for i in [p1[0], p1[1], p1[2] + cz]])
+        return rl
+
+    def __expand_arc(self, p0, p1, g: int, ijr: list, surff) -> list:
+        """
+        Levels an arc. It is sampled every xysampling along its length, and split wherever the
+        depth correction changed by more than zthreshold since the start of the current piece.
+        Pieces are kept as helical arcs (Z varying linearly along them), or replaced by a
+        line where they deviate less than arc_tol from their chord.
+        :return: List of ([x y z], [i j]) pieces, excluding p0; [i j] is None for lines.
+        """
+        snap = self.__fp.snap
+        geom = arc_geometry(p0, p1, ijr, g == 2)
+        c, _, sweep, r0, r1 = geom
+        n = max(int(np.ceil(abs(sweep) * max(r0, r1) / self[self.pt.xysampling])), 1)
+        t = np.linspace(0.0, 1.0, n + 1)
+        pts = arc_sample(p0, p1, geom, t)
+        cz = np.array([surff(x, y) for x, y in pts[:, 0:2]])
+
+        cuts = [0]
+        for k in range(1, n):
+            if abs(cz[k] - cz[cuts[-1]]) > self[self.pt.zthreshold]:
+                cuts.append(k)
+        cuts.append(n)
+
+        rl = list()
+        for k0, k1 in zip(cuts[:-1], cuts[1:]):
+            p = [snap(float(i)) for i in pts[k1, 0:2]] + [snap(float(pts[k1, 2] + cz[k1]))]
+            half = abs(sweep) * (t[k1] - t[k0]) / 2.0
+            sagitta = max(r0, r1) * (1.0 - np.cos(min(half, np.pi / 2.0)))
+            if sagitta <= self[self.pt.arc_tol]:
+                rl.append((p, None))
+            else:
+                rl.append((p, [snap(float(i)) for i in c - pts[k0, 0:2]]))
+        return rl
+
+# Leveling process pool worker state
+_worker = None
+
+
+def _init_leveling_worker(params: dict, hmap: list):
+    global _worker
+    lvl = Leveling()
+    lvl.parse_dict(params, quiet=True)
+    h = HMapBuffer()
+    h.data = hmap
+    _worker = (lvl, lvl.surface(h))
+
+
+def _level_chunk(blocks: list, start: list) -> tuple:
+    lvl, surff = _worker
+    firsts = list()
+    return lvl.level_blocks(blocks, start, surff, firsts) + (firsts,)
+
+
+class BackSide(DefaultWorkspace):
+    """
+    Derives the heightmap of a board's back side from the one probed on its front.
+    Flipped about the mirror axis (mirrorax, mirrorval), the back side sees the front
+    heightmap mirrored and inverted. A few points probed on the flipped board
+    (registration) correct the remaining offset and tilt with a least squares plane.
+    """
+    def __init__(self):
+        DefaultWorkspace.__init__(self)
+
+        self.__backHMap = HMapBuffer()
+        self.__key      = None  # inputs of the derived heightmap
+        self.__report   = OrderedDict()
+
+    def params_changed(self, keys: list):
+        if any(k in [self.pt.mirrorax, self.pt.mirrorval, self.pt.precision] for k in keys):
+            self.__key = None
+
+    @property
+    def backHMap(self) -> HMapBuffer:
+        return self.__backHMap
+
+    @property
+    def report(self) -> OrderedDict:
+        """ Registration correction of the last derivation; lengths in mm, tilt in mm/mm. """
+        return self.__report
+
+    def __axis(self) -> int:
+        if self[self.pt.mirrorax] not in ['x', 'y']:
+            raise ValueError('Two-sided jobs need mirrorax (x or y) and mirrorval.')
+        return ['x', 'y'].index(self[self.pt.mirrorax])
+
+    def derive(self, hmapbuff: HMapBuffer, regbuff=None) -> HMapBuffer:
+        """
+        :param hmapbuff: Heightmap probed on the front side.
+        :param regbuff: HMapBuffer of points probed on the flipped board, or None.
+        :return: Back side heightmap; the same buffer is updated on every derivation.
+        """
+        if type(hmapbuff) != HMapBuffer or (regbuff is not None and type(regbuff) != HMapBuffer):
+            raise TypeError
+        if hmapbuff.size < 4:
+            raise ValueError('Heightmap must have more than 4 entries.')
+        a = self.__axis()
+        reg = regbuff if regbuff is not None and not regbuff.empty() else None
+        key = (id(hmapbuff), hmapbuff.version, None if reg is None else (id(reg), reg.version))
+        if key == self.__key:
+            return self.__backHMap
+
+        p = np.array(list(hmapbuff), dtype=float).reshape(-1, 3)
+        p[:, a] = 2.0 * self[self.pt.mirrorval] - p[:, a]
+        p[:, 2] = -p[:, 2]
+
+        coef = np.zeros(3)
+        rms = 0.0
+        if reg is not None:
+            r = np.array(list(reg), dtype=float).reshape(-1, 3)
+            pred = griddata(p[:, 0:2], p[:, 2], r[:, 0:2], method='linear')
+            near = griddata(p[:, 0:2], p[:, 2], r[:, 0:2], method='nearest')
+            d = r[:, 2] - np.where(np.isnan(pred), near, pred)
+            if r.shape[0] >= 3:
+                A = np.column_stack((np.ones(r.shape[0]), r[:, 0:2]))
+                coef = np.linalg.lstsq(A, d, rcond=None)[0]
+                rms = float(np.sqrt(np.mean((d - A @ coef) ** 2)))
+            else:
+                coef[0] = d.mean()
+            p[:, 2] += coef[0] + p[:, 0:2] @ coef[1:]
+        self.__report = OrderedDict([
+            ('points',   0 if reg is None else int(reg.size)),
+            ('offset',   float(coef[0])),
+            ('tilt_x',   float(coef[1])),
+            ('tilt_y',   float(coef[2])),
+            ('residual', rms)])
+
+        self.__backHMap.data = [tuple(i) for i in p.round(self[self.pt.precision]).tolist()]
+        self.__key = key
+        log.info('BackSide: mirrored heightmap about {} = {}{}',
+                 self[self.pt.mirrorax], self[self.pt.mirrorval],
+                 '' if reg is None else ', registered to {} points (offset {:.4f} mm, rms {:.4f} mm)'.format(
+                     reg.size, coef[0], rms))
+        return self.__backHMap
+
+    def reg_grid(self) -> GridBuffer:
+        """ Registration points: the corners of probe_lims inset by 10%, in back side coordinates. """
+        a = self.__axis()
+        l = self[self.pt.probe_lims]
+        dx, dy = 0.1 * (l[1] - l[0]), 0.1 * (l[3] - l[2])
+        g = GridBuffer()
+        for x in [l[0] + dx, l[1] - dx]:
+            for y in [l[2] + dy, l[3] - dy]:
+                p = [x, y]
+                p[a] = 2.0 * self[self.pt.mirrorval] - p[a]
+                g.append([round(i, self[self.pt.precision]) for i in p])
+        return g
+
+
+class HMapCheck(DefaultWorkspace):
+    """
+    Validates heightmaps before leveling.
+    A quadratic surface is fitted robustly (iteratively reweighted least squares with
+    Tukey's biweight), so bad probes barely pull the fit; points whose residual exceeds
+    outliertol are flagged, and can be re-probed or replaced by the fitted height.
+    """
+    def __init__(self):
+        DefaultWorkspace.__init__(self)
+
+        self.__points   = np.zeros((0, 3))
+        self.__fitted   = np.zeros(0)
+        self.__outliers = np.zeros(0, dtype=np.int64)
+        self.__report   = OrderedDict()
+
+    @property
+    def outliers(self) -> np.ndarray:
+        """ Indices (in the checked HMapBuffer) of the flagged points. """
+        return self.__outliers
+
+    @property
+    def report(self) -> OrderedDict:
+        """ Surface figures of the last check; lengths in mm, tilt in mm/mm. """
+        return self.__report
+
+    def run_check(self, hmapbuff: HMapBuffer) -> bool:
+        """
+        :param hmapbuff: List of (x,y,z) tuples
+        :return: True if the heightmap was checked; see report and outliers.
+        """
+        if type(hmapbuff) != HMapBuffer:
+            raise TypeError
+        if hmapbuff.size < 4:
+            raise ValueError('Heightmap must have more than 4 entries.')
+        self.__points = np.array(list(hmapbuff), dtype=float).reshape(-1, 3)
+        x, y, z = self.__points.T
+
+        # Normalized coordinates keep the fit well conditioned
+        c = [x.mean(), y.mean()]
+        sc = max(np.ptp(x), np.ptp(y), 1e-9) / 2.0
+        u, v = (x - c[0]) / sc, (y - c[1]) / sc
+        one = np.ones_like(u)
+        plane = self.__robust_fit(np.column_stack((one, u, v)), z)
+        quad  = self.__robust_fit(np.column_stack((one, u, v, u*u, u*v, v*v)), z) \
+            if hmapbuff.size >= 9 else np.concatenate((plane, np.zeros(3)))
+
+        self.__fitted = np.column_stack((one, u, v, u*u, u*v, v*v)) @ quad
+        resid = z - self.__fitted
+        self.__outliers = np.flatnonzero(np.abs(resid) > self[self.pt.outliertol])
+
+        # Bow: departure of the quadratic surface from the plane, over the probed area
+        gu, gv = [i.ravel() for i in np.meshgrid(np.linspace(u.min(), u.max(), 25),
+                                                  np.linspace(v.min(), v.max(), 25))]
+        gone = np.ones_like(gu)
+        bow = np.column_stack((gu*gu, gu*gv, gv*gv)) @ quad[3:] + \
+            np.column_stack((gone, gu, gv)) @ (quad[0:3] - plane)
+
+        inl = np.setdiff1d(np.arange(z.size), self.__outliers)
+        self.__report = OrderedDict([
+            ('points',   int(z.size)),
+            ('range',    float(np.ptp(z))),
+            ('tilt_x',   float(plane[1] / sc)),
+            ('tilt_y',   float(plane[2] / sc)),
+            ('bow',      float(np.ptp(bow))),
+            ('max_dev',  float(np.abs(resid).max())),
+            ('rms',      float(np.sqrt(np.mean(resid[inl]**2))) if inl.size else 0.0),
+            ('outliers', int(self.__outliers.size))])
+        return True
+
+    @staticmethod
+    def __robust_fit(A, z, iters=50) -> np.ndarray:
+        """ Least squares fit of A @ coef = z, with Tukey biweights from the MAD of the residuals. """
+        w = np.ones(z.size)
+        coef = np.zeros(A.shape[1])
+        for _ in range(iters):
+            sw = np.sqrt(w)
+            coef = np.linalg.lstsq(A * sw[:, None], z * sw, rcond=None)[0]
+            r = z - A @ coef
+            s = 1.4826 * np.median(np.abs(r - np.median(r)))
+            if s < 1e-9:
+                break
+            k = r / (4.685 * s)
+            wn = np.where(np.abs(k) < 1.0, (1.0 - k**2)**2, 0.0)
+            if np.abs(wn - w).max() < 1e-6:
+                break
+            w = wn
+        return coef
+
+    def reprobe_grid(self) -> GridBuffer:
+        """ Probing grid made of the flagged points only. """
+        g = GridBuffer()
+        for i in self.__outliers:
+            g.append(self.__points[i, 0:2].round(self[self.pt.precision]).tolist())
+        return g
+
+    def reject(self, hmapbuff: HMapBuffer) -> int:
+        """
+        Replaces the height of every flagged point of hmapbuff by the fitted surface's.
+        :return: Number of replaced points.
+        """
+        if type(hmapbuff) != HMapBuffer or hmapbuff.size != self.__points.shape[0]:
+            raise ValueError('Heightmap changed since it was checked.')
+        data = list(hmapbuff)
+        for i in self.__outliers:
+            data[i] = (data[i][0], data[i][1], round(float(self.__fitted[i]), self[self.pt.precision]))
+        hmapbuff.data = data
+        n = self.__outliers.size
+        self.__outliers = np.zeros(0, dtype=np.int64)
+        return n
+
+
+class BufferHistory(DefaultWorkspace):
+    """
+    Bounded history of work buffers.
+    Buffers are split into chunks at content defined boundaries (blocks whose hash has
+    its low bits clear), and chunks are stored once, shared by every version holding
+    them: versions differing in a few places only add the chunks around the changes.
+    Chunks are keyed by their contents, and list blocks (points) are copied in and out,
+    so versions are unaffected by later changes to the buffers pushed or restored.
+    The oldest versions are evicted once the chunks exceed history_mb.
+    """
+    __mask     = 63   # average chunk length - 1
+    __maxchunk = 256  # chunks are cut at this length regardless of content
+
+    def __init__(self):
+        DefaultWorkspace.__init__(self)
+        self.__chunks  = {}  # key -> [blocks tuple, references, bytes]
+        self.__entries = []  # dict(keys, type, desc, size), oldest first
+        self.__cursor  = -1
+        self.__bytes   = 0
+
+    def params_changed(self, keys: list):
+        if self.pt.history_mb in keys:
+            self.__evict()
+
+    @property
+    def entries(self) -> list:
+        """ (buffer description, buffer type name, blocks) of every version, oldest first. """
+        return [(e['desc'], e['type'].__name__, e['size']) for e in self.__entries]
+
+    @property
+    def cursor(self) -> int:
+        """ Index of the current version (-1 if none). """
+        return self.__cursor
+
+    @property
+    def bytes(self) -> int:
+        """ Approximate memory held by the stored chunks. """
+        return self.__bytes
+
+    def push(self, buff: GenericBuffer, desc: str):
+        """ Records buff as the newest version, dropping versions that were undone. """
+        keys = self.__store(buff.data)
+        if self.__cursor >= 0 and keys == self.__entries[self.__cursor]['keys'] and \
+                type(buff) is self.__entries[self.__cursor]['type']:
+            self.__release(keys)
+            self.__entries[self.__cursor]['desc'] = desc
+            return
+        for e in self.__entries[self.__cursor + 1:]:
+            self.__release(e['keys'])
+        del self.__entries[self.__cursor + 1:]
+        self.__entries.append({'keys': keys, 'type': type(buff), 'desc': desc, 'size': len(buff.data)})
+        self.__cursor = len(self.__entries) - 1
+        self.__evict()
+
+    def undo(self) -> bool:
+        if self.__cursor <= 0:
+            return False
+        self.__cursor -= 1
+        return True
+
+    def redo(self) -> bool:
+        if self.__cursor >= len(self.__entries) - 1:
+            return False
+        self.__cursor += 1
+        return True
+
+    def restore(self, i=None) -> tuple:
+        """
+        :param i: Version index; the current one if None.
+        :return: (buffer, description); the buffer is a new copy of version i.
+        """
+        e = self.__entries[self.__cursor if i is None else i]
+        b = e['type']()
+        b.data = [list(bl) if type(bl) is list else bl for k in e['keys'] for bl in self.__chunks[k][0]]
+        return b, e['desc']
+
+    def diff(self, a: int, b: int) -> list:
+        """
+        Differences between versions a and b.
+        :return: List of (a0, a1, b0, b1): blocks a0:a1 of a were replaced by blocks b0:b1 of b.
+        """
+        ka, kb = self.__entries[a]['keys'], self.__entries[b]['keys']
+        oa = np.concatenate(([0], np.cumsum([len(self.__chunks[k][0]) for k in ka], dtype=np.int64)))
+        ob = np.concatenate(([0], np.cumsum([len(self.__chunks[k][0]) for k in kb], dtype=np.int64)))
+        hunks = []
+        for tag, i0, i1, j0, j1 in difflib.SequenceMatcher(None, ka, kb, autojunk=False).get_opcodes():
+            if tag == 'equal':
+                continue
+            # Narrow the hunk down to the blocks that differ
+            da = [bl for k in ka[i0:i1] for bl in self.__chunks[k][0]]
+            db = [bl for k in kb[j0:j1] for bl in self.__chunks[k][0]]
+            p = 0
+            while p < min(len(da), len(db)) and da[p] == db[p]:
+                p += 1
+            q = 0
+            while q < min(len(da), len(db)) - p and da[-1 - q] == db[-1 - q]:
+                q += 1
+            hunks.append((int(oa[i0]) + p, int(oa[i1]) - q, int(ob[j0]) + p, int(ob[j1]) - q))
+        return hunks
+
+    def __store(self, data: list) -> list:
+        """ Stores the chunks of data (sharing existing ones); returns their keys. """
+        lists = False
+        try:
+            h = list(map(hash, data))
+        except TypeError:
+            # Point buffers hold lists
+            h = [hash(tuple(bl)) if type(bl) is list else hash(bl) for bl in data]
+            lists = True
+        cuts = (np.flatnonzero((np.array(h, dtype=np.int64) & self.__mask) == 0) + 1).tolist()
+        keys, a = [], 0
+        for c in cuts + [len(data)]:
+            while a < c:
+                b = min(c, a + self.__maxchunk)
+                k = (b - a, hash(tuple(h[a:b])))
+                blocks = tuple(data[a:b])
+                e = self.__chunks.get(k)
+                if e is not None and e[0] != blocks:
+                    # Hash collision; key the chunk by a digest of its contents instead
+                    k = (k, hashlib.blake2b(repr(blocks).encode(), digest_size=16).digest())
+                    e = self.__chunks.get(k)
+                if e is None:
+                    if lists:
+                        blocks = tuple(list(bl) if type(bl) is list else bl for bl in blocks)
+                    size = sys.getsizeof(blocks) + sum(
+                        sys.getsizeof(bl) + (24 * len(bl) if type(bl) in (tuple, list) else 0) for bl in blocks)
+                    self.__chunks[k] = [blocks, 1, size]
+                    self.__bytes += size
+                else:
+                    e[1] += 1
+                keys.append(k)
+                a = b
+        return keys
+
+    def __release(self, keys: list):
+        for k in keys:
+            e = self.__chunks[k]
+            e[1] -= 1
+            if e[1] == 0:
+                self.__bytes -= e[2]
+                del self.__chunks[k]
+
+    def __evict(self):
+        """ Drops versions farthest from the current one until within history_mb. """
+        budget = self[self.pt.history_mb] * 1024 * 1024
+        while self.__bytes > budget and len(self.__entries) > 1:
+            if self.__cursor > 0:
+                self.__release(self.__entries.pop(0)['keys'])
+                self.__cursor -= 1
+            else:
+                self.__release(self.__entries.pop()['keys'])
+
+
+class Estimating(DefaultWorkspace):
+    """
+    Estimates the machine run time of GCode, planning velocities like common CNC firmware:
+    every segment accelerates at the limit of its axes (max_acc) up to its feed, capped by
+    max_vel, and corners are taken at the speed allowed by junction_dev.
+    The machine stops at program start and end, and at non-motion lines other than
+    comments (tool changes, dwells...). Arcs are planned as lines within arc_tol.
+    """
+    def __init__(self):
+        DefaultWorkspace.__init__(self)
+        self.__report = OrderedDict()
+
+    @property
+    def report(self) -> OrderedDict:
+        """ Figures of the last estimate; times in s, lengths in mm. """
+        return self.__report
+
+    def run_estimate(self, gcodebuff: GCodeBuffer) -> OrderedDict:
+        """
+        :param gcodebuff: GCode to be estimated.
+        :return: The report of the estimate.
+        """
+        if type(gcodebuff) != GCodeBuffer:
+            raise TypeError
+        vmax = np.array(self[self.pt.max_vel], dtype=float) / 60.0
+        amax = np.array(self[self.pt.max_acc], dtype=float)
+        if vmax.size != 3 or amax.size != 3 or np.any(vmax <= 0) or np.any(amax <= 0):
+            raise ValueError('max_vel and max_acc must be three positive values [x y z].')
+
+        t = gcodebuff.motion_table(self[self.pt.initialcoord])
+        start, end, row, stop = self.__segments(gcodebuff, t)
+        d = end - start
+        L = np.linalg.norm(d, axis=1)
+        # Zero length segments are dropped; a stop they carried moves to the next segment
+        keep = np.flatnonzero(L > 1e-9)
+        stop = np.diff(np.concatenate(([0], np.cumsum(stop)[keep]))) > 0
+        d, L, row = d[keep], L[keep], row[keep]
+        rapid = t.g[row] == 0
+        n = L.size
+
+        # Velocity and acceleration along each segment, limited by every moving axis
+        au = np.abs(d / L[:, None]) if n else np.zeros((0, 3))
+        with np.errstate(divide='ignore'):
+            vlim = np.min(np.where(au > 0, vmax / au, np.inf), axis=1)
+            acc  = np.min(np.where(au > 0, amax / au, np.inf), axis=1)
+        f = t.feed[row] / 60.0
+        vn = np.where(rapid | np.isnan(f), vlim, np.minimum(f, vlim))
+        vn2 = vn ** 2
+
+        # Squared junction speeds at the entry of each segment (and at the program end)
+        J = np.zeros(n + 1)
+        if n > 1:
+            u = d / L[:, None]
+            cos = np.clip(-np.sum(u[:-1] * u[1:], axis=1), -1.0, 1.0)
+            sin = np.sqrt(0.5 * (1.0 - cos))  # sin(theta/2)
+            with np.errstate(divide='ignore'):
+                jv2 = np.where(sin < 1.0 - 1e-9, np.minimum(acc[:-1], acc[1:]) *
+                               self[self.pt.junction_dev] * sin / (1.0 - sin), np.inf)
+            J[1:n] = np.minimum(jv2, np.minimum(vn2[:-1], vn2[1:]))
+            J[1:n][stop[1:]] = 0.0
+
+        # Backward (deceleration) and forward (acceleration) passes, closed form:
+        # with S the cumulative 2*a*L, w[k] = min(J[k], w[k+1] + S[k+1] - S[k]) unrolls
+        # into a reversed running minimum, and likewise forward
+        S = np.concatenate(([0.0], np.cumsum(2.0 * acc * L)))
+        w = np.minimum.accumulate((J + S)[::-1])[::-1] - S
+        w = np.maximum(np.minimum.accumulate(w - S) + S, 0.0)
+
+        w0, w1 = w[:-1], w[1:]
+        da = (vn2 - w0) / (2.0 * acc)
+        dd = (vn2 - w1) / (2.0 * acc)
+        trap = da + dd <= L
+        vp = np.sqrt(np.maximum(np.where(trap, vn2, (2.0 * acc * L + w0 + w1) / 2.0), np.maximum(w0, w1)))
+        cruise = np.where(trap, (L - da - dd) / vn, 0.0)
+        tseg = (2.0 * vp - np.sqrt(w0) - np.sqrt(w1)) / acc + cruise
+
+        self.__report = OrderedDict([
+            ('blocks',       int(t.size)),
+            ('segments',     int(n)),
+            ('stops',        int(stop[1:].sum()) if n else 0),
+            ('cut_time',     float(tseg[~rapid].sum())),
+            ('rapid_time',   float(tseg[rapid].sum())),
+            ('total_time',   float(tseg.sum())),
+            ('cut_length',   float(L[~rapid].sum())),
+            ('rapid_length', float(L[rapid].sum()))])
+        return self.__report
+
+    def __segments(self, gcodebuff: GCodeBuffer, t: MotionTable) -> tuple:
+        """
+        Straight segments of the program, arcs being linearized.
+        :return: (start, end, row, stop): end points, motion table row of each segment
+                 and whether the machine stops before it.
+        """
+        arcs = [(k, GCodeBuffer.get_arc(gcodebuff.data[t.index[k]]), t.g[k] == 2) for k in np.flatnonzero(t.arc)]
+        end, row = expand_arcs(t.start, t.end, arcs, self[self.pt.arc_tol])
+        start = np.concatenate((t.start[0:1], end[:-1]))
+        off = np.searchsorted(row, np.arange(t.size))
+
+        # Motion rows following a line that is neither blank nor a comment
+        lines = [i for i in t.other.tolist() if
+                 type(gcodebuff.data[i]) is not str or gcodebuff.data[i].strip()[:1] not in ('', '(', ';')]
+        first = np.searchsorted(t.index, lines)
+        stop = np.zeros(row.size, dtype=bool)
+        stop[off[first[first < t.size]]] = True
+        return start, end, row, stop
+
+
+class Cropping(DefaultWorkspace):
+    """
+    Crops GCode to a rectangular region, or to one tile of a regular tiling.
+    Segments are clipped exactly at the region boundaries; retract, travel and plunge
+    moves (at safez) are inserted wherever the cropped path is interrupted.
+    Arcs are replaced by lines (within arc_tol) before cropping.
+    """
+    def __init__(self):
+        DefaultWorkspace.__init__(self)
+
+        self.__croppedGCode = GCodeBuffer()
+
+        # Motion table and segment index of the last cropped buffer
+        self.__src   = None
+        self.__lines = None  # the buffer, with arcs linearized
+        self.__table = None
+        self.__index = None
+
+    @property
+    def croppedGCode(self) -> GCodeBuffer:
+        return self.__croppedGCode
+
+    def __build_index(self, gcodebuff: GCodeBuffer):
+        """ Indexes gcodebuff's segments, unless it was already indexed. """
+        key = (id(gcodebuff), gcodebuff.version, tuple(self[self.pt.initialcoord]), self[self.pt.arc_tol])
+        if key == self.__src:
+            return
+        self.__table = gcodebuff.motion_table(self[self.pt.initialcoord])
+        if self.__table.arc.any():
+            gcodebuff = self.__linearize(gcodebuff, self.__table)
+            self.__table = gcodebuff.motion_table(self[self.pt.initialcoord])
+        self.__lines = gcodebuff
+        self.__index = SegmentIndex(self.__table.start[:, 0:2], self.__table.end[:, 0:2])
+        self.__src   = key
+
+    def __linearize(self, gcodebuff: GCodeBuffer, t: MotionTable) -> GCodeBuffer:
+        """ Copy of gcodebuff with every arc replaced by G01 lines. """
+        lin = GCodeBuffer()
+        data = list(gcodebuff.data)
+        for k in np.flatnonzero(t.arc):
+            bl = data[t.index[k]]
+            geom = arc_geometry(t.start[k], t.end[k], GCodeBuffer.get_arc(bl), bl[0] == 2)
+            pts = arc_linearize(t.start[k], t.end[k], geom, self[self.pt.arc_tol]).tolist()
+            data[t.index[k]] = [(1, bl[1] if n == 0 else None) + tuple(p) for n, p in enumerate(pts)]
+        lin.data = [bl for e in data for bl in (e if type(e) is list else [e])]
+        return lin
+
+    def tile_lims(self, gcodebuff: GCodeBuffer, col: int, row: int) -> list:
+        """
+        Splits the bounding box of gcodebuff into crop_tiles tiles.
+        :return: Limits [xmin xmax ymin ymax] of tile (col, row); (0, 0) is the lower left tile.
+        """
+        if type(gcodebuff) != GCodeBuffer:
+            raise TypeError
+        nt = self[self.pt.crop_tiles]
+        if not (0 <= col < nt[0] and 0 <= row < nt[1]):
+            raise ValueError('Tile ({}, {}) is out of the {}x{} tiling.'.format(col, row, nt[0], nt[1]))
+        self.__build_index(gcodebuff)
+        bb = self.__index.bbox
+        dx = (bb[1] - bb[0]) / nt[0]
+        dy = (bb[3] - bb[2]) / nt[1]
+        # Outer tile edges are taken from the bounding box itself, avoiding round-off
+        return [bb[0] + col * dx, bb[0] + (col + 1) * dx if col < nt[0] - 1 else bb[1],
+                bb[2] + row * dy, bb[2] + (row + 1) * dy if row < nt[1] - 1 else bb[3]]
+
+    def run_cropping(self, gcodebuff: GCodeBuffer, lims=None) -> bool:
+        """
+        :param gcodebuff: GCode to be cropped.
+        :param lims: [xmin xmax ymin ymax]. If None, crop_lims is used.
+        :return: True if the cropped GCode was generated.
+        """
+        if type(gcodebuff) != GCodeBuffer:
+            raise TypeError
+        lims = self[self.pt.crop_lims] if lims is None else [float(i) for i in lims]
+        if len(lims) != 4 or lims[0] >= lims[1] or lims[2] >= lims[3]:
+            raise ValueError('Cropping limits must be [xmin xmax ymin ymax].')
+        self.__build_index(gcodebuff)
+        gcodebuff = self.__lines
+        t = self.__table
+        sel = self.__index.query(lims)
+
+        # Non-motion lines are kept in place; motion blocks only where they touch the region
+        pos  = np.concatenate((t.index[sel], t.other))
+        kind = np.concatenate((sel, np.full(t.other.size, -1, dtype=np.int64)))
+        order = np.argsort(pos, kind='stable')
+        tail = None  # output length after the last motion kept
+
+        out = GCodeEmitter(self[self.pt.precision], self[self.pt.safez])
+        for b, k in zip(pos[order], kind[order]):
+            if k < 0:
+                out.line(gcodebuff.data[b])
+                continue
+            s, e = t.start[k], t.end[k]
+            if s[0] == e[0] and s[1] == e[1]:
+                if not (lims[0] <= s[0] <= lims[1] and lims[2] <= s[1] <= lims[3]):
+                    continue
+                t0, t1 = 0.0, 1.0
+            else:
+                r = clip_segment(s, e, lims)
+                if r is None or r[0] >= r[1]:
+                    continue
+                t0, t1 = r
+            cs = s + t0 * (e - s)
+            ce = s + t1 * (e - s)
+            if not out.at(cs):
+                out.travel(cs, t.feed[k])
+            out.move(int(t.g[k]), t.feed[k], ce)
+            tail = out.buffer.size
+
+        # Retract after the last motion kept, ahead of the trailing non-motion lines
+        if tail is not None and out.pos[2] < out.safez:
+            rest = out.buffer.data[tail:]
+            out.buffer.data = out.buffer.data[:tail]
+            out.travel()
+            out.buffer.data = out.buffer.data + rest
+
+        self.__croppedGCode = out.buffer
+        log.info('Cropper: kept {} of {} motion blocks inside {}', sel.size, t.size, lims)
+        return True
+
+
+class GCodeEmitter(object):
+    """
+    Appends blocks to a GCodeBuffer with explicit coordinates, keeping track
+    of the tool position and of the feed last stated in the output.
+    """
+    def __init__(self, precision=4, safez=2.0):
+        self.buffer    = GCodeBuffer()
+        self.precision = precision
+        self.safez     = safez
+        self.pos  = None  # tool position [x y z]; None while unknown
+        self.feed = None  # modal feed of the output; None while unknown
+
+    def at(self, p) -> bool:
+        """ True if the tool is known to be at p. """
+        return self.pos is not None and np.abs(self.pos - p).max() <= 1e-9
+
+    def line(self, bl):
+        """ Appends a block as-is; coordinates and feed of motion blocks are tracked. """
+        self.buffer.append(bl)
+        if type(bl) is not tuple:
+            return
+        if bl[1] is not None:
+            self.feed = float(bl[1])
+        p = GCodeBuffer.get_pt(bl)
+        if self.pos is not None:
+            self.pos = np.array([self.pos[a] if p[a] is None else p[a] for a in range(3)], dtype=float)
+        elif None not in p:
+            self.pos = np.array(p, dtype=float)
+
+    def move(self, g: int, feed, p):
+        """ Appends a motion to p, restating feed if the output's modal feed differs. """
+        f = None
+        if g != 0 and feed is not None and not np.isnan(feed) and feed != self.feed:
+            f = self.feed = float(feed)
+        self.buffer.append((g, f) + tuple(round(float(i), self.precision) for i in p[0:3]))
+        self.pos = np.array(p[0:3], dtype=float)
+
+    def spindle_on(self, speed, dwell=0.0):
+        """ Starts the spindle clockwise at speed (rpm), then waits dwell seconds for it. """
+        self.buffer.append('M03 S{:g}\n'.format(speed))
+        if dwell > 0:
+            self.buffer.append('G04 P{:g}\n'.format(dwell))
+
+    def travel(self, p=None, feed=None, travelz=None, plungez=None):
+        """
+        Safe move to p: retract to travelz, rapid in XY, then descend to p.
+        Descents below plungez are done at feed, others as rapids.
+        If p is None, only retracts.
+        :param travelz: Travel height; defaults to safez, or p's height if higher.
+        :param plungez: Defaults to safez.
+        """
+        plungez = self.safez if plungez is None else plungez
+        if travelz is None:
+            travelz = self.safez if p is None else max(self.safez, p[2])
+        z = None if self.pos is None else self.pos[2]
+        if z is None or z < travelz:
+            z = round(float(travelz), self.precision)
+            self.buffer.append((0, None, None, None, z))
+        if p is None:
+            if self.pos is not None:
+                self.pos[2] = z
+            return
+        self.buffer.append((0, None) + tuple(round(float(i), self.precision) for i in p[0:2]) + (None,))
+        self.pos = np.array([p[0], p[1], z], dtype=float)
+        if z != p[2]:
+            self.move(1 if p[2] < plungez else 0, feed, p)
+
+
+class Drilling(DefaultWorkspace):
+    """
+    Generates drilling GCode from an ExcellonBuffer, one tool after another.
+    The holes of each tool are ordered by nearest neighbour and refined by 2-opt.
+    Given a heightmap surface, the clearance height and target depth of every hole
+    follow the surface. Drills are mirrored like for probing (mirrorax, mirrorval).
+    The spindle is stopped before each tool change and started again (drill_speed,
+    then a spindle_dwell wait) before the first plunge of the tool.
+    """
+    def __init__(self):
+        DefaultWorkspace.__init__(self)
+
+        self.__drillGCode = GCodeBuffer()
+        self.__travel = [0.0, 0.0]  # XY travel [file_order optimized] of the last run
+
+    @property
+    def drillGCode(self) -> GCodeBuffer:
+        return self.__drillGCode
+
+    @property
+    def travel(self) -> list:
+        """ XY travel between holes [in file order, optimized] of the last run. """
+        return self.__travel
+
+    def run_drilling(self, drills: ExcellonBuffer, surff=None) -> bool:
+        """
+        :param drills: Holes to drill.
+        :param surff: Surface function (see Leveling.surface); if None, the surface is flat at 0.
+        :return: True if the drilling GCode was generated.
+        """
+        if type(drills) is not ExcellonBuffer:
+            raise TypeError
+        if self[self.pt.mirrorax] in ['x', 'y']:
+            drills = drills.mirror(self[self.pt.mirrorax], self[self.pt.mirrorval])
+        prec  = self[self.pt.precision]
+        depth = self[self.pt.drill_depth]
+        clear = self[self.pt.drill_clear]
+        feed  = self[self.pt.drill_feed]
+
+        out = GCodeEmitter(prec, self[self.pt.safez])
+        out.pos = np.array(self[self.pt.initialcoord], dtype=float)
+        out.line('G21\n')
+        out.line('G90\n')
+        pos = out.pos[0:2].copy()
+        fpos = pos.copy()  # position along the file order tour
+        self.__travel = [0.0, 0.0]
+        done = 0
+        spindle = False
+        for num, diam in drills.tools.items():
+            progress(done, drills.size, 'holes')
+            xy = drills.by_tool(num)[:, ExcellonBuffer.X:ExcellonBuffer.Y + 1]
+            if xy.shape[0] == 0:
+                continue
+            done += xy.shape[0]
+            order = self.__order(pos, xy)
+            self.__travel[0] += self.__length(fpos, xy)
+            self.__travel[1] += self.__length(pos, xy[order])
+            fpos, pos = xy[-1], xy[order[-1]]
+
+            out.travel()
+            if spindle:
+                out.line('M05\n')
+            out.line('(T{} {} mm, {} holes)\n'.format(num, round(diam, prec), xy.shape[0]))
+            out.line('T{} M06\n'.format(num))
+            out.spindle_on(self[self.pt.drill_speed], self[self.pt.spindle_dwell])
+            spindle = True
+            first = True
+            for x, y in xy[order].tolist():
+                cz = 0.0 if surff is None else float(surff(x, y))
+                if first:
+                    out.travel([x, y, clear + cz], plungez=float('-inf'))
+                    first = False
+                else:
+                    # Rapid at the higher of both clearances, as the surface may rise in between
+                    z = max(out.pos[2], clear + cz)
+                    if z > out.pos[2]:
+                        out.move(0, None, [out.pos[0], out.pos[1], z])
+                    out.move(0, None, [x, y, z])
+                    if not out.at([x, y, clear + cz]):
+                        out.move(0, None, [x, y, clear + cz])
+                out.move(1, feed, [x, y, depth + cz])
+                out.move(0, None, [x, y, clear + cz])
+        out.travel()
+        out.line('M05\n')
+
+        self.__drillGCode = out.buffer
+        b, a = self.__travel
+        log.info('Driller: {} holes with {} tools; travel {:.1f} -> {:.1f} mm (saved {:.1f} mm, {:.1f}%)',
+                 drills.size, len(drills.tools), b, a, b - a, 100.0 * (b - a) / b if b > 0 else 0.0)
+        return True
+
+    def __order(self, pos, xy) -> np.ndarray:
+        """ Short tour over the holes xy, starting at pos. """
+        flippable = np.ones(xy.shape[0], dtype=bool)
+        order, flipped = nn_tour(pos, xy, xy, flippable)
+        order, _, _ = two_opt(pos, xy, xy, order, flipped, flippable, passes=self[self.pt.opt_passes])
+        return order
+
+    @staticmethod
+    def __length(pos, xy) -> float:
+        """ XY length of the path from pos through the points xy. """
+        p = np.vstack((np.reshape(pos, (1, 2)), xy))
+        return float(np.linalg.norm(np.diff(p, axis=0), axis=1).sum())
+
+
+class Optimizing(DefaultWorkspace):
+    """
+    Reorders the cut groups of GCode to shorten rapid travel.
+    A cut group runs from the first block reaching below mincutdepth up to the following
+    travel move (both ends above mincutdepth). Groups are ordered by nearest neighbour
+    and refined by 2-opt within sections delimited by non-motion lines (other than
+    comments), so tool changes, pauses and the like keep their place.
+    """
+    def __init__(self):
+        DefaultWorkspace.__init__(self)
+
+        self.__optGCodeBuff = GCodeBuffer()
+        self.__travel = [0.0, 0.0]  # rapid XY travel [before after] of the last run
+
+    @property
+    def optimizedGCode(self) -> GCodeBuffer:
+        return self.__optGCodeBuff
+
+    @property
+    def travel(self) -> list:
+        """ Rapid XY travel between cut groups [before after] the last optimization. """
+        return self.__travel
+
+    def run_optimizing(self, gcodebuff: GCodeBuffer) -> bool:
+        """
+        :param gcodebuff: GCode to be reordered.
+        :return: True if the optimized GCode was generated.
+        """
+        if type(gcodebuff) != GCodeBuffer:
+            raise TypeError
+        t = gcodebuff.motion_table(self[self.pt.initialcoord])
+        sections = self.__split(gcodebuff, t)
+
+        out = GCodeEmitter(self[self.pt.precision], self[self.pt.safez])
+        out.pos = np.array(self[self.pt.initialcoord], dtype=float)
+        self.__travel = [0.0, 0.0]
+        ngroups, nsections = 0, 0
+        for groups, tail in sections:
+            for g in self.__order(out.pos, groups):
+                self.__emit_group(out, gcodebuff, t, g)
+            ngroups += len(groups)
+            nsections += 1 if groups else 0
+            for kind, v in tail:
+                if kind == 'fixed':
+                    v['flip'] = False
+                    self.__emit_group(out, gcodebuff, t, v)
+                else:
+                    out.line(gcodebuff.data[v])
+
+        self.__optGCodeBuff = out.buffer
+        b, a = self.__travel
+        log.info('Optimizer: reordered {} cut groups in {} sections; rapid travel {:.1f} -> {:.1f} mm '
+                 '(saved {:.1f} mm, {:.1f}%)', ngroups, nsections, b, a, b - a,
+                 100.0 * (b - a) / b if b > 0 else 0.0)
+        return True
+
+    def __split(self, gcodebuff: GCodeBuffer, t: MotionTable) -> list:
+        """
+        Splits the program into sections of movable cut groups.
+        :return: List of (groups, tail); tail holds what follows the groups, in order:
+                 ('line', i) lines and travel moves, ('fixed', group) unmovable groups.
+        """
+        mcd = self[self.pt.mincutdepth]
+        cutting = np.minimum(t.start[:, 2], t.end[:, 2]) < mcd
+        row = np.full(gcodebuff.size, -1, dtype=np.int64)
+        row[t.index] = np.arange(t.size)
+
+        sections = []
+        groups, travels, pending = [], [], []
+        cur = None  # group being collected
+
+        def close_group():
+            g = cur
+            rows = g['rows']
+            g['entry'], g['exit'] = t.start[rows[0]], t.end[rows[-1]]
+            g['movable'] = g['entry'][2] >= mcd and g['exit'][2] >= mcd
+            # Plain plunge, cut and retract sequences (of lines) may also be cut backwards
+            g['reversible'] = len(rows) >= 3 and len(rows) == g['last'] - g['first'] + 1 and \
+                not g['lead'] and not t.arc[rows].any() and \
+                all(np.all(t.start[r, 0:2] == t.end[r, 0:2]) for r in (rows[0], rows[-1]))
+            if g['movable']:
+                groups.append(g)
+            else:
+                close_section([('fixed', g)])
+
+        def close_section(end):
+            nonlocal groups, travels, pending
+            sections.append((groups, [('line', i) for i in sorted(travels + pending)] + end))
+            groups, travels, pending = [], [], []
+
+        for i, bl in enumerate(gcodebuff.data):
+            r = row[i]
+            if r >= 0 and cutting[r]:
+                if cur is None:
+                    cur = {'first': i, 'rows': [], 'lead': pending}
+                    travels, pending = [], []
+                cur['rows'].append(r)
+                cur['last'] = i
+            elif r >= 0:
+                if cur is not None:
+                    close_group()
+                    cur = None
+                travels.append(i)
+            elif cur is not None and t.end[cur['rows'][-1], 2] < mcd:
+                cur['last'] = i  # line inside a cut
+            else:
+                if cur is not None:
+                    close_group()
+                    cur = None
+                if type(bl) is str and (bl.strip() == '' or bl.strip()[0] in '(;'):
+                    pending.append(i)
+                else:
+                    close_section([('line', i)])
+        if cur is not None:
+            close_group()
+        close_section([])
+        return sections
+
+    def __order(self, pos, groups: list) -> list:
+        """ Orders (and flips) the groups of one section, accounting for the travel saved. """
+        if not groups:
+            return groups
+        entries = np.array([g['entry'][0:2] for g in groups])
+        exits   = np.array([g['exit'][0:2] for g in groups])
+        closed  = np.all(np.abs(entries - exits) <= 1e-9, axis=1)
+        flippable = closed.copy()
+        if self[self.pt.opt_reverse]:
+            flippable |= [g['reversible'] for g in groups]
+
+        order, flipped = nn_tour(pos[0:2], entries, exits, flippable)
+        order, flipped, _ = two_opt(pos[0:2], entries, exits, order, flipped, flippable,
+                                    passes=self[self.pt.opt_passes])
+
+        self.__travel[0] += self.__length(pos, entries, exits, np.arange(len(groups)), np.zeros(len(groups), bool))
+        self.__travel[1] += self.__length(pos, entries, exits, order, flipped)
+        for k, g in enumerate(groups):
+            g['flip'] = bool(flipped[k] and not closed[k])
+        return [groups[k] for k in order]
+
+    @staticmethod
+    def __length(pos, entries, exits, order, flipped) -> float:
+        """ XY travel length along a tour of the groups. """
+        e = np.where(flipped[order, None], exits[order], entries[order])
+        x = np.where(flipped[order, None], entries[order], exits[order])
+        p = np.concatenate(([pos[0:2]], x[:-1]))
+        return float(np.linalg.norm(e - p, axis=1).sum())
+
+    def __emit_group(self, out: GCodeEmitter, gcodebuff: GCodeBuffer, t: MotionTable, g):
+        rows = g['rows']
+        plunge, retract = rows[0], rows[-1]
+        if g['flip']:
+            # Plunge at the original exit, cut backwards, retract at the original entry
+            entry = np.array([g['exit'][0], g['exit'][1], g['entry'][2]])
+            if not out.at(entry):
+                out.travel(entry, travelz=max(out.pos[2], entry[2]), plungez=self[self.pt.mincutdepth])
+            out.move(int(t.g[plunge]), t.feed[plunge], t.start[retract])
+            for r in rows[-2:0:-1]:
+                out.move(int(t.g[r]), t.feed[r], t.start[r])
+            out.move(int(t.g[retract]), t.feed[retract],
+                     [g['entry'][0], g['entry'][1], g['exit'][2]])
+            return
+
+        for i in g['lead']:
+            out.line(gcodebuff.data[i])
+        feed = t.feed[plunge - 1] if plunge > 0 else np.nan
+        if not out.at(g['entry']):
+            if g['movable']:
+                out.travel(g['entry'], feed, travelz=max(out.pos[2], g['entry'][2]),
+                           plungez=self[self.pt.mincutdepth])
+            else:
+                out.travel(g['entry'], feed)
+        # Blocks are copied verbatim; only the modal feed they rely on may need restating
+        for i in range(g['first'], g['last'] + 1):
+            bl = gcodebuff.data[i]
+            if i == g['first'] and bl[1] is None and not np.isnan(feed) and feed != out.feed:
+                bl = (bl[0], float(feed)) + bl[2:]
+            out.line(bl)
+
+
+class Resuming(DefaultWorkspace):
+    """
+    Restarts a GCode program from any line, e.g. after a tool break or a feed hold.
+    Lines are those of the GCode file the buffer was read (or leveled) from; buffers
+    not recording their source lines are resumed at a line of the buffer.
+    The modal state before the line is taken from the buffer's ModalIndex, and a
+    preamble restores it: units, absolute distance mode, retract to safez, spindle,
+    rapid above the resume point and descent to it (its Z is the buffer's, so the
+    leveled one for leveled GCode), at the program's feed, or at resume_feed if the
+    program set none before the line.
+    """
+    def __init__(self):
+        DefaultWorkspace.__init__(self)
+
+        self.__resGCodeBuff = GCodeBuffer()
+        self.__state = None
+
+    @property
+    def resumedGCode(self) -> GCodeBuffer:
+        return self.__resGCodeBuff
+
+    @property
+    def state(self) -> Union[OrderedDict, None]:
+        """ Modal state the last resume started from. """
+        return self.__state
+
+    def run_resume(self, gcodebuff: GCodeBuffer, line: int) -> bool:
+        """
+        :param gcodebuff: Program to resume.
+        :param line: First line (1-based) to execute again.
+        :return: True if the resumed GCode was generated.
+        """
+        if type(gcodebuff) is not GCodeBuffer:
+            raise TypeError
+        with gcodebuff.lock:
+            data = gcodebuff.data
+            starts = gcodebuff.source_lines()
+            if starts is None:
+                log.info('Resumer: buffer has no source line numbers; resuming at line {} of the buffer', line)
+                starts = range(len(data))
+            if not 1 <= line <= len(starts):
+                raise ValueError('Line {} is out of range (1 to {}).'.format(line, len(starts)))
+            k = starts[line - 1]
+            st = gcodebuff.modal_index(self[self.pt.resume_every]).state(k)
+        M = ModalIndex
+        if st[M.DISTANCE] == 91:
+            raise ValueError('Can not resume in incremental distance mode (G91).')
+        self.__state = OrderedDict(zip(M.fields, st))
+
+        p = [self[self.pt.initialcoord][a] if st[M.X + a] is None else st[M.X + a] for a in range(3)]
+        out = GCodeEmitter(self[self.pt.precision], self[self.pt.safez])
+        out.line('(Resumed at line {})\n'.format(line))
+        if st[M.TOOL] is not None:
+            out.line('(Tool T{} expected)\n'.format(st[M.TOOL]))
+        out.line('G{}\n'.format(st[M.UNITS] if st[M.UNITS] is not None else 21))
+        out.line('G90\n')
+        # Retract from wherever the tool stopped; only its height is known afterwards
+        out.line((0, None, None, None, round(float(self[self.pt.safez]), self[self.pt.precision])))
+        out.pos = np.array([np.nan, np.nan, out.buffer.data[-1][4]])
+        if st[M.SPINDLE] in (3, 4):
+            out.line('M0{}{}\n'.format(st[M.SPINDLE], '' if st[M.SPEED] is None else ' S{:g}'.format(st[M.SPEED])))
+        # Feeding down without a feed set would be rejected (GRBL error 22)
+        out.travel(np.array(p, dtype=float), self[self.pt.resume_feed] if st[M.F] is None else st[M.F],
+                   plungez=self[self.pt.mincutdepth])
+        # The program's blocks may rely on the modal feed
+        if st[M.F] is not None and st[M.F] != out.feed:
+            out.line('F{:g}\n'.format(st[M.F]))
+        out.buffer.data = out.buffer.data + data[k:]
+        self.__resGCodeBuff = out.buffer
+        log.info('Resumer: resuming at line {} from [{}], feed {}, spindle {}',
+                 line, ', '.join('{:g}'.format(i) for i in p), st[M.F], 'M0{}'.format(st[M.SPINDLE]) if st[M.SPINDLE] else None)
+        return True
+
+
+class Meshing(DefaultWorkspace):
+    """
+    Levels on the controller instead of in the program: the heightmap surface is
+    resampled on the firmware's mesh (mesh_size nodes over mesh_lims, which must match
+    the firmware's mesh bounds) and loaded by a preamble, and the motion blocks are
+    passed through unmodified, so the program keeps its size.
+    Firmwares (mesh_fw):
+        marlin_abl  Bilinear/unified bed leveling, nodes set with M421 I J Z.
+        marlin_mbl  Mesh bed leveling, nodes set with G29 S3 I J Z.
+    Leveling is then enabled with fade height 0 (M420 S1 Z0), so the whole cut is corrected.
+    """
+    firmwares = OrderedDict([('marlin_abl', 'M421 I{} J{} Z{}\n'),
+                             ('marlin_mbl', 'G29 S3 I{} J{} Z{}\n')])
+
+    def __init__(self):
+        DefaultWorkspace.__init__(self)
+
+        self.__meshGCodeBuff = GCodeBuffer()
+        self.__mesh = np.zeros((0, 0))
+
+    @property
+    def meshGCode(self) -> GCodeBuffer:
+        return self.__meshGCodeBuff
+
+    @property
+    def mesh(self) -> np.ndarray:
+        """ Node heights of the last mesh, indexed [i, j] (x, y). """
+        return self.__mesh
+
+    def nodes(self) -> tuple:
+        """ (x, y) coordinates of the mesh nodes along each axis. """
+        l = self[self.pt.mesh_lims]
+        n = self[self.pt.mesh_size]
+        if min(n) < 2:
+            raise ValueError('Meshes need at least 2 nodes per axis.')
+        return np.linspace(l[0], l[1], n[0]), np.linspace(l[2], l[3], n[1])
+
+    def run_mesh(self, gcodebuff: GCodeBuffer, hmapbuff: HMapBuffer, surff) -> bool:
+        """
+        :param surff: Surface function of hmapbuff (see Leveling.surface).
+        :return: True if the mesh preamble and program were generated.
+        """
+        if type(gcodebuff) is not GCodeBuffer or type(hmapbuff) is not HMapBuffer:
+            raise TypeError
+        fw = self[self.pt.mesh_fw]
+        if fw not in self.firmwares:
+            raise ValueError('Unknown firmware {} (mesh_fw: {}).'.format(fw, ', '.join(self.firmwares)))
+        xn, yn = self.nodes()
+        hx = [p[0] for p in hmapbuff]
+        hy = [p[1] for p in hmapbuff]
+        if xn[0] < min(hx) or xn[-1] > max(hx) or yn[0] < min(hy) or yn[-1] > max(hy):
+            log.warning('Mesher: mesh_lims exceed the heightmap; outer nodes are extrapolated.')
+
+        prec = self[self.pt.precision]
+        self.__mesh = np.array([[surff(x, y) for y in yn] for x in xn])
+        out = GCodeEmitter(prec, self[self.pt.safez])
+        out.line('({} mesh, {}x{} nodes over X{:g}..{:g} Y{:g}..{:g})\n'.format(
+            fw, xn.size, yn.size, xn[0], xn[-1], yn[0], yn[-1]))
+        for i in range(xn.size):
+            for j in range(yn.size):
+                out.line(self.firmwares[fw].format(i, j, round(float(self.__mesh[i, j]), prec) + 0.0))
+        out.line('M420 S1 Z0\n')
+        n = out.buffer.size
+        with gcodebuff.lock:
+            out.buffer.data = out.buffer.data + gcodebuff.data
+        self.__meshGCodeBuff = out.buffer
+        log.info('Mesher: {} lines of mesh preamble, {} program lines passed through', n, out.buffer.size - n)
+        return True
+
+
+class Isolating(DefaultWorkspace):
+    """
+    Generates isolation toolpaths from a Gerber copper layer.
+    Copper is rasterized every iso_res, which resolves overlapping and clear objects, and
+    the distance to it is computed once for the whole raster. The toolpaths of every pass
+    are contours of that distance at the tool radius plus the pass offsets (marching
+    squares), simplified to arc_tol; changing the tool or the passes only redoes the
+    contours.
+    This stands for polygon offsetting and union, at a cost in accuracy: copper edges
+    are resolved to the cells, so toolpaths lie within about one iso_res (plus arc_tol)
+    of the exact offset; 0.86 iso_res at most was measured on round and slanted copper.
+    A warning is given when iso_res exceeds a tenth of the tool width.
+    Rasterizing takes up to cellBytes per cell (about 850 MB for 100 x 100 mm at 0.02 mm);
+    rasters that would take more than iso_mem are refused.
+    The spindle is started (iso_speed, spindle_dwell) before the first cut.
+    """
+    cellBytes = 34  # peak memory per raster cell while computing the distance field
+
+    def __init__(self):
+        DefaultWorkspace.__init__(self)
+
+        self.__isoGCodeBuff = GCodeBuffer()
+        self.__field    = None  # (x, y, distance) of the raster cells
+        self.__fieldKey = None
+        self.__fieldPad = 0.0   # margin of the raster around the copper
+        self.__contours = list()
+
+    @property
+    def isoGCode(self) -> GCodeBuffer:
+        return self.__isoGCodeBuff
+
+    @property
+    def contours(self) -> list:
+        """ Contours of the last run, per pass; Nx2 arrays, closed ones repeating their first point. """
+        return self.__contours
+
+    def __levels(self) -> list:
+        w = self[self.pt.iso_tool]
+        return [w / 2.0 + k * w * (1.0 - self[self.pt.iso_overlap]) for k in range(max(self[self.pt.iso_passes], 1))]
+
+    def distance_field(self, gerbbuff: GerberBuffer) -> tuple:
+        """
+        :return: (x, y, d): cell centers along x and y, and the distance (mm) from each
+                 cell to the copper (0 inside it), indexed [y, x].
+        """
+        if type(gerbbuff) is not GerberBuffer:
+            raise TypeError
+        res = float(self[self.pt.iso_res])
+        pad = max(self.__levels()) + 4 * res
+        key = (id(gerbbuff), gerbbuff.version, res)
+        # The raster is reused while its margin fits the outermost pass
+        if key == self.__fieldKey and pad <= self.__fieldPad:
+            return self.__field
+        pad *= 2.0  # room for wider tools
+        bb = gerbbuff.bbox
+        if bb is None:
+            raise ValueError('Gerber layer has no copper.')
+        if res <= 0:
+            raise ValueError('iso_res must be positive.')
+        x = np.arange(bb[0] - pad, bb[1] + pad + res, res)
+        y = np.arange(bb[2] - pad, bb[3] + pad + res, res)
+        need = x.size * y.size * self.cellBytes / 2.0 ** 20
+        if need > self[self.pt.iso_mem]:
+            raise ValueError('A raster of {} x {} cells needs about {:.0f} MB (iso_mem {} MB); '
+                             'set iso_res to {:.3f} or more, or raise iso_mem.'.format(
+                             x.size, y.size, need, self[self.pt.iso_mem],
+                             res * np.sqrt(need / self[self.pt.iso_mem])))
+        log.info('Isolator: rasterizing {} objects on {} x {} cells', gerbbuff.size, x.size, y.size)
+        mask = np.zeros((y.size, x.size), dtype=bool)
+        for k, ob in enumerate(gerbbuff.data):
+            if k & 255 == 0:
+                progress(k, gerbbuff.size, 'objects')
+            for piece in self.__pieces(ob, 64 * res):
+                e = GerberBuffer.extent(piece)
+                i0, i1 = np.searchsorted(x, [e[0] - res, e[1] + res])
+                j0, j1 = np.searchsorted(y, [e[2] - res, e[3] + res])
+                if i0 >= i1 or j0 >= j1:
+                    continue
+                cells = self.__cover(piece, x[i0:i1][None, :], y[j0:j1][:, None])
+                if ob[1]:
+                    mask[j0:j1, i0:i1] |= cells
+                else:
+                    mask[j0:j1, i0:i1] &= ~cells
+        self.__field    = (x, y, ndimage.distance_transform_edt(~mask, sampling=res))
+        self.__fieldKey = key
+        self.__fieldPad = pad
+        return self.__field
+
+    @staticmethod
+    def __pieces(ob, maxlen) -> list:
+        """ Lines longer than maxlen split in pieces, so each covers a small window of cells. """
+        if ob[0] != 'L':
+            return [ob]
+        n = int(np.ceil(np.hypot(ob[5] - ob[3], ob[6] - ob[4]) / maxlen))
+        if n <= 1:
+            return [ob]
+        t = np.linspace(0.0, 1.0, n + 1)
+        px = ob[3] + (ob[5] - ob[3]) * t
+        py = ob[4] + (ob[6] - ob[4]) * t
+        return [ob[0:3] + (px[i], py[i], px[i + 1], py[i + 1]) for i in range(n)]
+
+    @staticmethod
+    def __stroke(X, Y, p0, p1, r):
+        """ Cells within r of segment p0 p1. """
+        d = [p1[0] - p0[0], p1[1] - p0[1]]
+        l2 = d[0] * d[0] + d[1] * d[1]
+        t = 0.0
+        if l2 > 0.0:
+            t = np.clip(((X - p0[0]) * d[0] + (Y - p0[1]) * d[1]) / l2, 0.0, 1.0)
+        return (X - p0[0] - t * d[0]) ** 2 + (Y - p0[1] - t * d[1]) ** 2 <= r * r
+
+    @staticmethod
+    def __fill(X, Y, pts):
+        """ Cells inside polygon pts (even-odd rule), by scanlines through the cell centers. """
+        p = np.asarray(pts, dtype=float)
+        q = np.roll(p, -1, axis=0)
+        y = Y[:, 0]
+        r, e = np.nonzero((p[None, :, 1] <= y[:, None]) != (q[None, :, 1] <= y[:, None]))
+        xc = p[e, 0] + (y[r] - p[e, 1]) * (q[e, 0] - p[e, 0]) / (q[e, 1] - p[e, 1])
+        # Every crossing toggles the cells from the first one right of it
+        col = np.searchsorted(X[0], xc)
+        tog = np.zeros((y.size, X.shape[1] + 1), dtype=np.int32)
+        np.add.at(tog, (r, col), 1)
+        return (np.cumsum(tog, axis=1)[:, :-1] & 1).astype(bool)
+
+    def __cover(self, ob, X, Y):
+        """ Cells covered by a GerberBuffer object. """
+        if ob[0] == 'P':
+            return self.__fill(X, Y, ob[2])
+        ap = ob[2]
+        p0 = ob[3:5]
+        p1 = ob[5:7] if ob[0] == 'L' else p0
+        if ap[0] == 'C':
+            return self.__stroke(X, Y, p0, p1, ap[1] / 2.0)
+        w, h = ap[1] / 2.0, ap[2] / 2.0
+        cells = np.zeros(np.broadcast(X, Y).shape, dtype=bool)
+        if ap[0] == 'R':
+            for c in [p0, p1]:
+                cells |= (np.abs(X - c[0]) <= w) & (np.abs(Y - c[1]) <= h)
+        else:
+            # Obround: a stroke along its long side
+            s = abs(w - h)
+            o = [s, 0.0] if w > h else [0.0, s]
+            for c in [p0, p1]:
+                cells |= self.__stroke(X, Y, [c[0] - o[0], c[1] - o[1]], [c[0] + o[0], c[1] + o[1]], min(w, h))
+        if p1 is not p0:
+            # Lines drawn with rectangles and obrounds: the swept area, within the narrow side
+            cells |= self.__stroke(X, Y, p0, p1, min(w, h))
+        return cells
+
+    def run_isolation(self, gerbbuff: GerberBuffer) -> bool:
+        """
+        :param gerbbuff: Copper layer.
+        :return: True if the isolation GCode was generated.
+        """
+        try:
+            import contourpy
+        except ImportError:
+            raise ImportError('Isolation needs contourpy (installed along with matplotlib).')
+        if self[self.pt.iso_res] > self[self.pt.iso_tool] / 10.0:
+            log.warning('Isolator: iso_res {} is coarse for a {} mm tool; toolpaths may be off by up to {:.3f} mm.',
+                        self[self.pt.iso_res], self[self.pt.iso_tool], 0.86 * self[self.pt.iso_res])
+        x, y, d = self.distance_field(gerbbuff)
+        gen = contourpy.contour_generator(x, y, d, line_type='Separate')
+        self.__contours = [[douglas_peucker(c, self[self.pt.arc_tol]) for c in gen.lines(lvl) if len(c) > 1]
+                           for lvl in self.__levels()]
+
+        depth = self[self.pt.iso_depth]
+        feed  = self[self.pt.iso_feed]
+        out = GCodeEmitter(self[self.pt.precision], self[self.pt.safez])
+        out.pos = np.array(self[self.pt.initialcoord], dtype=float)
+        out.line('G21\n')
+        out.line('G90\n')
+        out.travel()
+        out.spindle_on(self[self.pt.iso_speed], self[self.pt.spindle_dwell])
+        n = 0
+        for cs in self.__contours:
+            if not cs:
+                continue
+            ends = np.array([[c[0], c[-1]] for c in cs])
+            order, flipped = nn_tour(out.pos[0:2], ends[:, 0], ends[:, 1],
+                                     np.any(ends[:, 0] != ends[:, 1], axis=1))
+            for k in order.tolist():
+                c = cs[k][::-1] if flipped[k] else cs[k]
+                p = [c[0][0], c[0][1], depth]
+                if not out.at(p):
+                    out.travel(np.array(p), feed, plungez=self[self.pt.mincutdepth])
+                for q in c[1:]:
+                    out.move(1, feed, [q[0], q[1], depth])
+                n += 1
+        out.travel()
+        out.line('M05\n')
+        self.__isoGCodeBuff = out.buffer
+        log.info('Isolator: {} contours in {} passes', n, len(self.__contours))
+        return True
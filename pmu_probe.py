@@ -0,0 +1,262 @@
+from pmu_workspace import *
+from pmu_buffers import *
+from pmu_jobs import progress
+from pmu_log import getLogger
+
+import numpy as np
+
+import hashlib
+import json
+import time
+import re
+import os
+
+
+log = getLogger('probe')
+
+
+class ProbeLog(object):
+    """
+    Append-only log of a probing session, kept next to the heightmap it becomes.
+    The first line identifies the session (probing limits and ticks, drill set and the
+    grid itself); each following line is a probed point, k,x,y,z (k indexing the grid).
+    Every line is fsync'd as soon as it is written, so an interruption loses at most the
+    point being probed; a torn last line is dropped when the log is read back.
+    """
+    suffix = '.probelog'
+    __head = '# pmu probe log '
+
+    def __init__(self, hmappath: str):
+        self.__path = hmappath + self.suffix
+        self.__fd   = None
+
+    @property
+    def path(self) -> str:
+        return self.__path
+
+    def read(self):
+        """
+        :return: (session, OrderedDict k -> (x, y, z)) of the log on disk, or None if there is none.
+        """
+        if not os.path.isfile(self.__path):
+            return None
+        points = OrderedDict()
+        with open(self.__path, 'r') as fd:
+            head = fd.readline()
+            if not head.startswith(self.__head) or not head.endswith('\n'):
+                return None
+            session = json.loads(head[len(self.__head):])
+            for line in fd:
+                if not line.endswith('\n'):
+                    break  # torn by the interruption
+                k, x, y, z = line.split(',')
+                points[int(k)] = (float(x), float(y), float(z))
+        return session, points
+
+    def open(self, session: dict):
+        """ Opens the log for appending; a log of another session is set aside (.old). """
+        log = self.read()
+        if log is not None and log[0] == session:
+            # Cut a torn last line, so appended points start on their own line
+            with open(self.__path, 'rb+') as fd:
+                data = fd.read()
+                fd.truncate(data.rfind(b'\n') + 1)
+            self.__fd = open(self.__path, 'a')
+            return
+        if os.path.exists(self.__path):
+            os.replace(self.__path, self.__path + '.old')
+        self.__fd = open(self.__path, 'w')
+        self.__write(self.__head + json.dumps(session) + '\n')
+        _fsync_dir(self.__path)
+
+    def append(self, k: int, x, y, z):
+        self.__write('{},{},{},{}\n'.format(k, repr(float(x)), repr(float(y)), repr(float(z))))
+
+    def __write(self, s: str):
+        self.__fd.write(s)
+        self.__fd.flush()
+        os.fsync(self.__fd.fileno())
+
+    def close(self):
+        if self.__fd is not None:
+            self.__fd.close()
+            self.__fd = None
+
+    def compact(self, hmappath: str, points: list):
+        """ Atomically writes points as the heightmap CSV at hmappath, then removes the log. """
+        self.close()
+        tmp = hmappath + '.tmp'
+        with open(tmp, 'w') as fd:
+            for p in points:
+                fd.write('{},{},{}\n'.format(*p))
+            fd.flush()
+            os.fsync(fd.fileno())
+        os.replace(tmp, hmappath)
+        _fsync_dir(hmappath)
+        if os.path.exists(self.__path):
+            os.unlink(self.__path)
+
+
+def _fsync_dir(path: str):
+    """ Makes the creation/renaming of the file at path durable. """
+    try:
+        fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+class GrblProbe(object):
+    """
+    Probes points with a GRBL controller over a serial port (needs pyserial).
+    Heights are returned in work coordinates (G54-G59 and G92 offsets, and tool length
+    offset, removed from the reported machine position).
+    """
+    __prb   = re.compile('\\[PRB:([-0-9.]+),([-0-9.]+),([-0-9.]+)(?:,[-0-9.]+)*:([01])\\]')
+    __offs  = re.compile('\\[(G5[4-9]|G92|TLO):([-0-9.,]+)\\]')
+    __wcs   = re.compile('\\[GC:.*?(G5[4-9])')
+    timeout = 120.0  # seconds to wait for a command to be acknowledged
+
+    def __init__(self, port: str, baud=115200):
+        try:
+            import serial
+        except ImportError:
+            raise ImportError('Probing needs pyserial (pip install pyserial).')
+        if not port:
+            raise ValueError('no serial port set (probe_port).')
+        self.__port = serial.Serial(port, baud, timeout=1.0)
+        # Wake up the controller and drop its greeting
+        self.__port.write(b'\r\n\r\n')
+        time.sleep(2.0)
+        self.__port.reset_input_buffer()
+        self.__offset = self.__work_offset()
+
+    def __send(self, line: str) -> list:
+        """ Sends a line and waits for its ok; returns the lines received before it. """
+        self.__port.write((line + '\n').encode('ascii'))
+        rl = list()
+        deadline = time.monotonic() + self.timeout
+        while time.monotonic() < deadline:
+            r = self.__port.readline().decode('ascii', errors='replace').strip()
+            if r == 'ok':
+                return rl
+            if r.startswith('error') or r.startswith('ALARM'):
+                raise RuntimeError('controller answered {} to {}'.format(r, line))
+            if r:
+                rl.append(r)
+        raise TimeoutError('no answer to {}'.format(line))
+
+    def __work_offset(self) -> float:
+        """ Z of the work coordinate origin, in machine coordinates. """
+        wcs = 'G54'
+        for r in self.__send('$G'):
+            m = self.__wcs.match(r)
+            if m is not None:
+                wcs = m.group(1)
+        offs = dict()
+        for r in self.__send('$#'):
+            m = self.__offs.match(r)
+            if m is not None:
+                offs[m.group(1)] = [float(i) for i in m.group(2).split(',')]
+        return offs.get(wcs, [0.0] * 3)[2] + offs.get('G92', [0.0] * 3)[2] + offs.get('TLO', [0.0])[0]
+
+    def probe(self, x, y, depth, feed, clear) -> float:
+        """ Height of the surface at (x, y), probing down to depth; the tool is left at clear. """
+        self.__send('G90')
+        self.__send('G00 Z{}'.format(clear))
+        self.__send('G00 X{} Y{}'.format(x, y))
+        z = None
+        for r in self.__send('G38.2 Z{} F{}'.format(depth, feed)):
+            m = self.__prb.match(r)
+            if m is not None and m.group(4) == '1':
+                z = float(m.group(3)) - self.__offset
+        self.__send('G00 Z{}'.format(clear))
+        if z is None:
+            raise RuntimeError('probe not triggered at ({}, {}) above {}'.format(x, y, depth))
+        return z
+
+    def close(self):
+        self.__port.close()
+
+
+class Probing(DefaultWorkspace):
+    """
+    Probes the points of a grid one at a time, logging each to a ProbeLog next to the
+    heightmap. A run finding the log of the same session (same probe_lims, probe_tick
+    and drills) only probes the points missing from it, on the logged grid.
+    Once every point is probed, the log is compacted into the heightmap CSV.
+    """
+    def __init__(self):
+        DefaultWorkspace.__init__(self)
+        self.__probedHMap = HMapBuffer()
+        self.__resumed = 0
+
+    @property
+    def probedHMap(self) -> HMapBuffer:
+        return self.__probedHMap
+
+    @property
+    def resumed(self) -> int:
+        """ Points of the last run taken from a previous session's log. """
+        return self.__resumed
+
+    def session(self, gridbuff: GridBuffer, drills=None) -> dict:
+        h = hashlib.sha1()
+        if drills is not None and not drills.empty():
+            h.update(np.ascontiguousarray(drills.xy).tobytes())
+            h.update(np.ascontiguousarray(drills.diameters).tobytes())
+        return OrderedDict([
+            ('probe_lims', [float(i) for i in self[self.pt.probe_lims]]),
+            ('probe_tick', [int(i) for i in self[self.pt.probe_tick]]),
+            ('drills',     h.hexdigest()),
+            ('grid',       [[float(i) for i in p[0:2]] for p in gridbuff])])
+
+    def run_probing(self, gridbuff: GridBuffer, hmappath: str, drills=None, machine=None) -> bool:
+        """
+        :param machine: Object probing with probe(x, y, depth, feed, clear) -> z; defaults
+                        to a GrblProbe on probe_port.
+        :return: True once every point is probed and the heightmap written.
+        """
+        plog = ProbeLog(hmappath)
+        sess = self.session(gridbuff, drills)
+        prev = plog.read()
+        done = OrderedDict()
+        if prev is not None:
+            # Same session: the logged grid is kept, as drill avoidance may add random moves
+            keys = ['probe_lims', 'probe_tick', 'drills']
+            if [prev[0][k] for k in keys] == [sess[k] for k in keys]:
+                sess, done = prev
+                log.info('Prober: resuming session from {}, {} of {} points already probed.',
+                         plog.path, len(done), len(sess['grid']))
+            else:
+                log.warning('Prober: {} belongs to another session; starting over.', plog.path)
+        grid = sess['grid']
+        self.__resumed = len(done)
+
+        missing = [k for k in range(len(grid)) if k not in done]
+        if missing:
+            own = machine is None
+            machine = GrblProbe(self[self.pt.probe_port], self[self.pt.probe_baud]) if own else machine
+            plog.open(sess)
+            try:
+                for k in missing:
+                    progress(len(done), len(grid), 'points')
+                    x, y = grid[k]
+                    z = machine.probe(x, y, self[self.pt.probe_depth], self[self.pt.probe_feed],
+                                      self[self.pt.probe_clear])
+                    plog.append(k, x, y, z)
+                    done[k] = (x, y, z)
+            finally:
+                plog.close()
+                if own:
+                    machine.close()
+
+        points = [done[k] for k in range(len(grid))]
+        plog.compact(hmappath, points)
+        self.__probedHMap.data = points
+        return True
@@ -0,0 +1,119 @@
+import socketserver
+import threading
+import codecs
+import socket
+import sys
+import io
+import os
+
+from pmu_jobs import redirect_output
+
+
+class pmuServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Serves a pmuCLI over a Unix socket, so parsed files, buffers and cached surfaces
+    outlive each request.
+    A client sends command lines and closes its writing end; the output of every command
+    is streamed back, and the connection closed after the last one (or after quit).
+    Commands of all clients run one at a time.
+    """
+    daemon_threads = True
+    unavailable    = ['watch', 'view']  # need the terminal or a display
+
+    def __init__(self, cli, path: str):
+        """
+        :param cli: pmuCLI, already started.
+        :param path: Socket path; a stale socket left there is replaced.
+        """
+        self.__cli  = cli
+        self.__lock = threading.Lock()
+        self.__path = os.path.abspath(path)
+        if os.path.exists(self.__path):
+            if connect(self.__path) is not None:
+                raise OSError('a PMU server is already listening on {}'.format(self.__path))
+            os.unlink(self.__path)
+        socketserver.UnixStreamServer.__init__(self, self.__path, _pmuRequestHandler)
+
+    def server_bind(self):
+        # The socket is created private: changing its mode after bind leaves a window
+        # in which other local users could connect
+        umask = os.umask(0o177)
+        try:
+            socketserver.UnixStreamServer.server_bind(self)
+        finally:
+            os.umask(umask)
+
+    @property
+    def path(self) -> str:
+        return self.__path
+
+    def execute(self, line: str, out) -> bool:
+        """
+        Executes a command line, printing to out.
+        :return: False if the client asked to quit.
+        """
+        cmd = line.strip().split(' ')[0]
+        if cmd == 'quit':
+            return False
+        with self.__lock:
+            redirect_output(out)
+            try:
+                if cmd in self.unavailable:
+                    print('Command {} is not available in served sessions.'.format(cmd))
+                else:
+                    self.__cli.execute(line)
+            finally:
+                redirect_output(None)
+        return True
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        if os.path.exists(self.__path):
+            os.unlink(self.__path)
+
+
+class _pmuRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        out = io.TextIOWrapper(self.wfile, encoding='utf-8', errors='replace', write_through=True)
+        try:
+            for raw in self.rfile:
+                if not self.server.execute(raw.decode('utf-8', errors='replace'), out):
+                    break
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            out.detach()
+
+
+def connect(path: str):
+    """ Socket connected to the PMU server at path, or None if none is listening. """
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.connect(path)
+    except OSError:
+        s.close()
+        return None
+    return s
+
+
+def send(path: str, commands: list, out=None) -> bool:
+    """
+    Thin client: runs commands on the PMU server at path, writing their output to out.
+    :return: False if no server is listening.
+    """
+    out = sys.stdout if out is None else out
+    s = connect(path)
+    if s is None:
+        print('No PMU server listening on {}'.format(path))
+        return False
+    with s:
+        s.sendall(''.join(c.strip() + '\n' for c in commands).encode('utf-8'))
+        s.shutdown(socket.SHUT_WR)
+        dec = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        while True:
+            b = s.recv(65536)
+            if not b:
+                break
+            out.write(dec.decode(b))
+            out.flush()
+    return True
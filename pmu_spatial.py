@@ -0,0 +1,433 @@
+from scipy.spatial import cKDTree
+
+import numpy as np
+import math
+
+
+class SegmentIndex(object):
+    """
+    Uniform grid index over 2D line segments.
+    Each segment is registered in every cell its bounding box overlaps, and
+    rectangle queries only inspect the cells the rectangle overlaps.
+    Segments spanning too many cells are kept aside and always tested.
+    """
+    def __init__(self, p0, p1, cellsize=None, maxcells=64):
+        """
+        :param p0: Nx2 array of segment start points [x y].
+        :param p1: Nx2 array of segment end points [x y].
+        :param cellsize: Grid cell side. If None, derived from the data.
+        :param maxcells: Segments overlapping more cells are not gridded.
+        """
+        p0 = np.asarray(p0, dtype=float).reshape(-1, 2)
+        p1 = np.asarray(p1, dtype=float).reshape(-1, 2)
+        if p0.shape != p1.shape:
+            raise ValueError('Segment start and end arrays differ in size.')
+
+        self.__lo = np.minimum(p0, p1)
+        self.__hi = np.maximum(p0, p1)
+        n = self.__lo.shape[0]
+
+        self.__origin = self.__lo.min(axis=0) if n else np.zeros(2)
+        extent = (self.__hi.max(axis=0) - self.__origin) if n else np.zeros(2)
+        if cellsize is None:
+            # About one segment per cell, but never smaller than the average segment
+            area = max(extent[0], 1e-9) * max(extent[1], 1e-9)
+            mean = (self.__hi - self.__lo).mean(axis=0).max() if n else 0.0
+            cellsize = max(np.sqrt(area / max(n, 1)), mean, 1e-6)
+        # Keep the grid itself bounded
+        cellsize = max(cellsize, extent.max() / 2048.0)
+        self.__cs = float(cellsize)
+        self.__nx, self.__ny = [int(i) + 1 for i in np.floor(extent / self.__cs)]
+
+        c0 = self.__cell(self.__lo)
+        c1 = self.__cell(self.__hi)
+        w = c1[:, 0] - c0[:, 0] + 1
+        counts = w * (c1[:, 1] - c0[:, 1] + 1)
+        large = counts > maxcells
+        self.__large = np.flatnonzero(large)
+
+        # Expand each gridded segment into one entry per overlapped cell
+        ids = np.flatnonzero(~large)
+        counts = counts[ids]
+        rep = np.repeat(ids, counts)
+        off = np.arange(rep.size) - np.repeat(np.cumsum(counts) - counts, counts)
+        cx = c0[rep, 0] + off % w[rep]
+        cy = c0[rep, 1] + off // w[rep]
+        cell = cy * self.__nx + cx
+
+        # CSR layout: segments of cell k are ids[start[k]:start[k+1]]
+        order = np.argsort(cell, kind='stable')
+        self.__ids = rep[order]
+        self.__start = np.zeros(self.__nx * self.__ny + 1, dtype=np.int64)
+        np.cumsum(np.bincount(cell, minlength=self.__nx * self.__ny), out=self.__start[1:])
+
+    @property
+    def size(self) -> int:
+        return self.__lo.shape[0]
+
+    @property
+    def bbox(self) -> list:
+        """ [xmin xmax ymin ymax] of all indexed segments. """
+        if self.size == 0:
+            return [0.0, 0.0, 0.0, 0.0]
+        lo = self.__lo.min(axis=0)
+        hi = self.__hi.max(axis=0)
+        return [float(lo[0]), float(hi[0]), float(lo[1]), float(hi[1])]
+
+    def __cell(self, p):
+        c = np.floor((p - self.__origin) / self.__cs).astype(np.int64)
+        c[:, 0] = np.clip(c[:, 0], 0, self.__nx - 1)
+        c[:, 1] = np.clip(c[:, 1], 0, self.__ny - 1)
+        return c
+
+    def query(self, lims) -> np.ndarray:
+        """
+        Returns the sorted indices of segments whose bounding box overlaps
+        the rectangle lims = [xmin xmax ymin ymax] (boundaries included).
+        """
+        if self.size == 0:
+            return np.zeros(0, dtype=np.int64)
+        c = self.__cell(np.array([[lims[0], lims[2]], [lims[1], lims[3]]], dtype=float))
+        # Cells of one grid row are contiguous in the CSR arrays
+        parts = [self.__large]
+        for cy in range(c[0, 1], c[1, 1] + 1):
+            k = cy * self.__nx
+            parts.append(self.__ids[self.__start[k + c[0, 0]]:self.__start[k + c[1, 0] + 1]])
+        cand = np.unique(np.concatenate(parts))
+        lo = self.__lo[cand]
+        hi = self.__hi[cand]
+        keep = (lo[:, 0] <= lims[1]) & (hi[:, 0] >= lims[0]) & \
+               (lo[:, 1] <= lims[3]) & (hi[:, 1] >= lims[2])
+        return cand[keep]
+
+
+def clip_segment(p0, p1, lims):
+    """
+    Clips the segment p0-p1 against the rectangle lims = [xmin xmax ymin ymax]
+    (Liang-Barsky). Only x and y are clipped; further coordinates are interpolated.
+    :return: Parameters (t0, t1) of the portion inside the rectangle, or None.
+    """
+    t0, t1 = 0.0, 1.0
+    for a, (vmin, vmax) in enumerate([(lims[0], lims[1]), (lims[2], lims[3])]):
+        d = p1[a] - p0[a]
+        if d == 0.0:
+            if p0[a] < vmin or p0[a] > vmax:
+                return None
+            continue
+        ta = (vmin - p0[a]) / d
+        tb = (vmax - p0[a]) / d
+        if ta > tb:
+            ta, tb = tb, ta
+        t0 = max(t0, ta)
+        t1 = min(t1, tb)
+        if t0 > t1:
+            return None
+    return t0, t1
+
+
+def nn_tour(start, entries, exits, flippable):
+    """
+    Greedy nearest-neighbour ordering of directed items (e.g. cut groups).
+    From the current position, the closest unvisited entry point is always taken next;
+    flippable items may also be entered at their exit point, being then traversed reversed.
+    :param start: [x y] position before the first item.
+    :param entries: Nx2 array of entry points.
+    :param exits: Nx2 array of exit points.
+    :param flippable: N bool array, items that may be traversed reversed.
+    :return: (order, flipped) arrays; flipped is indexed by item.
+    """
+    entries = np.asarray(entries, dtype=float).reshape(-1, 2)
+    exits   = np.asarray(exits, dtype=float).reshape(-1, 2)
+    n = entries.shape[0]
+    order   = np.zeros(n, dtype=np.int64)
+    flipped = np.zeros(n, dtype=bool)
+    if n == 0:
+        return order, flipped
+
+    # Candidate points; exits are only worth indexing if distinct from the entry
+    rev   = np.flatnonzero(flippable & np.any(entries != exits, axis=1))
+    pts   = np.concatenate((entries, exits[rev]))
+    owner = np.concatenate((np.arange(n), rev))
+    isexit = np.concatenate((np.zeros(n, dtype=bool), np.ones(rev.size, dtype=bool)))
+    npts = np.ones(n, dtype=np.int64)
+    npts[rev] = 2
+
+    visited = np.zeros(n, dtype=bool)
+    alive = np.arange(pts.shape[0])
+    tree  = cKDTree(pts)
+    ndead = 0
+    cur = np.asarray(start, dtype=float)
+    for m in range(n):
+        k = 8
+        while True:
+            kk = min(k, alive.size)
+            _, j = tree.query(cur, k=kk)
+            cand = alive[np.atleast_1d(j)]
+            ok = ~visited[owner[cand]]
+            if ok.any() or kk == alive.size:
+                break
+            k *= 4
+        c = cand[np.argmax(ok)]
+        g = owner[c]
+        visited[g] = True
+        order[m]   = g
+        flipped[g] = isexit[c]
+        cur = entries[g] if flipped[g] else exits[g]
+        # Drop visited points from the tree once they dominate it
+        ndead += npts[g]
+        if ndead > alive.size // 2 and m < n - 1:
+            alive = alive[~visited[owner[alive]]]
+            tree  = cKDTree(pts[alive])
+            ndead = 0
+    return order, flipped
+
+
+def two_opt(start, entries, exits, order, flipped, flippable, passes=3, k=8):
+    """
+    Improves an open tour of directed items with 2-opt moves, only trying
+    reconnections to the k nearest neighbours of each item.
+    Reversing a stretch of the tour flips every item in it, so only stretches
+    made of flippable items are reversed.
+    :return: (order, flipped, gain), gain being the travel length saved.
+    """
+    entries = np.asarray(entries, dtype=float).reshape(-1, 2)
+    exits   = np.asarray(exits, dtype=float).reshape(-1, 2)
+    order   = np.array(order, dtype=np.int64)
+    flipped = np.array(flipped, dtype=bool)
+    flippable = np.asarray(flippable, dtype=bool)
+    n = order.size
+    if n < 2 or not flippable.any():
+        return order, flipped, 0.0
+
+    ent = [tuple(p) for p in entries.tolist()]
+    ext = [tuple(p) for p in exits.tolist()]
+    start = tuple(float(i) for i in start)
+
+    # Neighbours of each item, by proximity of either of its endpoints
+    pts = np.concatenate((entries, exits))
+    tree = cKDTree(pts)
+    kk = min(k + 2, pts.shape[0])
+    _, nb = tree.query(pts, k=kk)
+    nb = (nb % n).reshape(2, n, kk).transpose(1, 0, 2).reshape(n, -1)
+    nb = [list(dict.fromkeys(r)) for r in nb.tolist()]
+    _, snb = tree.query(start, k=kk)
+    snb = list(dict.fromkeys((np.atleast_1d(snb) % n).tolist()))
+
+    pos = np.empty(n, dtype=np.int64)
+    pos[order] = np.arange(n)
+    fixed = np.concatenate(([0], np.cumsum(~flippable[order])))
+
+    def e(g): return ext[g] if flipped[g] else ent[g]
+    def x(g): return ent[g] if flipped[g] else ext[g]
+    def d(a, b): return math.hypot(a[0] - b[0], a[1] - b[1])
+
+    gain = 0.0
+    for _ in range(passes):
+        improved = False
+        for i in range(n):
+            xp = start if i == 0 else x(order[i - 1])
+            cands = snb if i == 0 else nb[order[i - 1]]
+            ei = e(order[i])
+            for h in cands:
+                j = pos[h]
+                if j < i or fixed[j + 1] != fixed[i]:
+                    continue
+                xj = x(order[j])
+                en = e(order[j + 1]) if j + 1 < n else None
+                delta = d(xp, xj) - d(xp, ei)
+                if en is not None:
+                    delta += d(ei, en) - d(xj, en)
+                if delta < -1e-9:
+                    seg = order[i:j + 1][::-1].copy()
+                    order[i:j + 1] = seg
+                    flipped[seg] = ~flipped[seg]
+                    pos[seg] = np.arange(i, j + 1)
+                    gain -= delta
+                    improved = True
+                    ei = e(order[i])
+        if not improved:
+            break
+    return order, flipped, gain
+
+
+arc_rtol = 0.001  # mm a radius arc's half chord may exceed its radius by
+
+
+def arc_geometry(p0, p1, ijr, cw: bool) -> tuple:
+    """
+    Resolves an arc in the XY plane from its start and end points.
+    Raises ValueError if neither center offset nor radius is given, or if the radius is
+    too short for the chord (by more than arc_rtol).
+    :param p0: Start point [x y z].
+    :param p1: End point [x y z].
+    :param ijr: [i j r]; the center offset (i, j) from p0 is used if given, r otherwise
+                (negative r selecting the arc longer than half a turn).
+    :param cw: True for clockwise (G02) arcs.
+    :return: (center, a0, sweep, r0, r1): start angle, signed sweep (radians) and radii at both ends.
+    """
+    p0 = np.asarray(p0, dtype=float)
+    p1 = np.asarray(p1, dtype=float)
+    i, j, r = ijr
+    if i is not None or j is not None:
+        c = p0[0:2] + [i or 0.0, j or 0.0]
+    elif r is not None:
+        m = (p0[0:2] + p1[0:2]) / 2.0
+        d = p1[0:2] - p0[0:2]
+        dl = np.linalg.norm(d)
+        if dl == 0.0:
+            return p0[0:2].copy(), 0.0, 0.0, 0.0, 0.0
+        h2 = r * r - dl * dl / 4.0
+        if h2 < 0.0:
+            # Chords longer than the diameter by round-off only are taken as half turns
+            if dl / 2.0 - abs(r) > arc_rtol:
+                raise ValueError('Arc of radius {:g} can not join [{:g} {:g}] and [{:g} {:g}], {:g} apart.'.format(
+                                 r, p0[0], p0[1], p1[0], p1[1], dl))
+            h2 = 0.0
+        h = math.sqrt(h2)
+        # Center on the right of the chord for short clockwise arcs
+        side = 1.0 if (r > 0) == cw else -1.0
+        c = m + side * h * np.array([d[1], -d[0]]) / dl
+    else:
+        raise ValueError('Arc without center offset or radius.')
+
+    v0 = p0[0:2] - c
+    v1 = p1[0:2] - c
+    a0 = math.atan2(v0[1], v0[0])
+    a1 = math.atan2(v1[1], v1[0])
+    if cw:
+        sweep = -((a0 - a1) % (2.0 * math.pi))
+    else:
+        sweep = (a1 - a0) % (2.0 * math.pi)
+    # Same start and end point: full circle (only expressible with a center offset)
+    if sweep == 0.0 and r is None and np.linalg.norm(v0) > 0.0:
+        sweep = -2.0 * math.pi if cw else 2.0 * math.pi
+    return c, a0, sweep, float(np.linalg.norm(v0)), float(np.linalg.norm(v1))
+
+
+def arc_sample(p0, p1, geom, t) -> np.ndarray:
+    """
+    Points of an arc (see arc_geometry) at fractions t of its sweep.
+    The radius and Z vary linearly along the arc (helix); t = 0 and t = 1 give p0 and p1 exactly.
+    :return: Nx3 array of [x y z].
+    """
+    c, a0, sweep, r0, r1 = geom
+    t = np.asarray(t, dtype=float)
+    a = a0 + sweep * t
+    r = r0 + (r1 - r0) * t
+    pts = np.column_stack((c[0] + r * np.cos(a), c[1] + r * np.sin(a), p0[2] + (p1[2] - p0[2]) * t))
+    pts[t == 0.0] = p0[0:3]
+    pts[t == 1.0] = p1[0:3]
+    return pts
+
+
+def arc_linearize(p0, p1, geom, tol) -> np.ndarray:
+    """
+    Replaces an arc by line segments deviating at most tol from it.
+    :return: Nx3 array of the segment end points (p0 excluded, p1 included).
+    """
+    _, _, sweep, r0, r1 = geom
+    r = max(r0, r1)
+    n = 1
+    if r > tol:
+        n = max(int(math.ceil(abs(sweep) / (2.0 * math.acos(1.0 - tol / r)))), 1)
+    return arc_sample(p0, p1, geom, np.linspace(0.0, 1.0, n + 1)[1:])
+
+
+def expand_arcs(start, end, arcs, tol) -> tuple:
+    """
+    Replaces arcs within a chain of segments by line segments deviating at most tol.
+    :param start: Nx3 segment start points.
+    :param end: Nx3 segment end points.
+    :param arcs: (k, ijr, cw) of every arc, k being its segment index (see arc_geometry).
+    :return: (end, row): end points of the expanded segments, and the original segment
+             each one belongs to; starts are the previous ends (start[0] for the first).
+    """
+    n = np.ones(end.shape[0], dtype=np.int64)
+    pts = {}
+    for k, ijr, cw in arcs:
+        pts[k] = arc_linearize(start[k], end[k], arc_geometry(start[k], end[k], ijr, cw), tol)
+        n[k] = pts[k].shape[0]
+    row = np.repeat(np.arange(end.shape[0]), n)
+    off = np.cumsum(n) - n
+    end = end[row]
+    for k, p in pts.items():
+        end[off[k]:off[k] + n[k]] = p
+    return end, row
+
+
+def polyline_runs(points, mask) -> np.ndarray:
+    """
+    Polylines made of the selected segments of a chain.
+    :param points: (N+1)x3 vertices of a chain of N segments.
+    :param mask: N bool array, segments to keep.
+    :return: Vertices of the kept runs of segments, runs separated by nan rows.
+    """
+    seg = np.flatnonzero(mask)
+    if seg.size == 0:
+        return np.zeros((0, 3))
+    last = seg[np.append(np.diff(seg) > 1, True)]
+    # Start vertex of every kept segment, then end vertex and a separator after each run
+    idx = np.concatenate((seg, last + 1, np.full(last.size, -1)))
+    key = np.concatenate((2.0 * seg, 2.0 * last + 1.0, 2.0 * last + 1.5))
+    idx = idx[np.argsort(key, kind='stable')]
+    out = np.asarray(points, dtype=float)[idx]
+    out[idx < 0] = np.nan
+    return out
+
+
+def simplify_polyline(points, tol) -> np.ndarray:
+    """
+    Vertex clustering: drops vertices falling in the same tol sized cell as the previous
+    one, so no more than one vertex remains per cell along the line (deviation < tol * sqrt(3)).
+    The first and last vertex of each polyline, and nan separators, are kept.
+    """
+    p = np.asarray(points, dtype=float)
+    if p.shape[0] < 3 or tol <= 0:
+        return p
+    gap = np.isnan(p[:, 0])
+    cell = np.floor(np.nan_to_num(p) / tol)
+    keep = np.ones(p.shape[0], dtype=bool)
+    keep[1:] = np.any(cell[1:] != cell[:-1], axis=1)
+    # Polyline ends; runs of separators collapse into one
+    keep |= gap
+    keep[1:] |= gap[:-1]
+    keep[:-1] |= gap[1:]
+    keep[[0, -1]] = True
+    keep[1:] &= ~(gap[1:] & gap[:-1])
+    return p[keep]
+
+
+def douglas_peucker(points, tol) -> np.ndarray:
+    """
+    Douglas-Peucker simplification: keeps the vertices needed for the polyline to
+    deviate at most tol from the original. Closed polylines (first == last vertex)
+    are split at their farthest vertex, so both halves keep their shape.
+    :param points: Nx2 array.
+    :return: Array of the kept vertices, first and last included.
+    """
+    p = np.asarray(points, dtype=float)
+    if p.shape[0] < 3:
+        return p
+    keep = np.zeros(p.shape[0], dtype=bool)
+    keep[[0, -1]] = True
+    stack = [(0, p.shape[0] - 1)]
+    if np.all(p[0] == p[-1]):
+        far = int(np.argmax(np.sum((p - p[0]) ** 2, axis=1)))
+        keep[far] = True
+        stack = [(0, far), (far, p.shape[0] - 1)]
+    while stack:
+        a, b = stack.pop()
+        if b - a < 2:
+            continue
+        d = p[b] - p[a]
+        v = p[a + 1:b] - p[a]
+        dl = math.hypot(d[0], d[1])
+        if dl > 0.0:
+            dist = np.abs(v[:, 0] * d[1] - v[:, 1] * d[0]) / dl
+        else:
+            dist = np.hypot(v[:, 0], v[:, 1])
+        k = int(np.argmax(dist))
+        if dist[k] > tol:
+            keep[a + 1 + k] = True
+            stack += [(a, a + 1 + k), (a + 1 + k, b)]
+    return p[keep]
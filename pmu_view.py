@@ -5,14 +5,33 @@ import matplotlib.pyplot as plt
 from pmu_workspace import *
 from pmu_parsers import *
 from pmu_buffers import *
+from pmu_spatial import *
+from pmu_log import getLogger
+
+import numpy as np
+from scipy.interpolate import griddata
+
+log = getLogger('view')
 
 class pmuView(DefaultWorkspace):
+    """
+    Plots drills and probing grids (2D), heightmaps and toolpaths (3D).
+    3D views are decimated to the screen resolution: the heightmap mesh has about one
+    cell per mesh_px pixels, and toolpaths are simplified to path_px pixels for the
+    visible region, again whenever the axes limits change (zoom).
+    """
+    mesh_px = 8    # screen pixels per heightmap mesh cell
+    path_px = 1.5  # screen pixels of toolpath simplification tolerance
+    maxpts  = 200000  # toolpath vertices drawn at most
+
     def __init__(self):
         DefaultWorkspace.__init__(self)
         self.__gcf  = None # Current figure
         self.__gca  = None # Current axis
         self.__grid = False
         self.__scl  = 1.1
+        self.__ax3d  = None # 3D axis
+        self.__paths = []   # [full resolution polyline, line artist] of 3D toolpaths
         plt.ion()
 
     def __gcaf(self):
@@ -49,7 +68,7 @@ class pmuView(DefaultWorkspace):
 
     def print_drills(self, drills: ExcellonBuffer, print_tol=False):
         if drills is None:
-            print('View: empty drill buffer.')
+            log.info('View: empty drill buffer.')
             return
 
         self.__setup_plot()
@@ -65,10 +84,10 @@ class pmuView(DefaultWorkspace):
 
     def print_probe(self, grid: GridBuffer):
         if type(grid) is not GridBuffer:
-            print('View: wrong buffer type.')
+            log.error('View: wrong buffer type.')
             return
         if grid is None:
-            print('View: empty buffer.')
+            log.info('View: empty buffer.')
             return
 
         self.__setup_plot()
@@ -76,4 +95,89 @@ class pmuView(DefaultWorkspace):
         for g in grid:
             self.__gca.plot(g[0], g[1], 'x', color='blue')
         plt.grid(self.__grid)
-        plt.draw()
\ No newline at end of file
+        plt.draw()
+
+    def __setup_plot3d(self):
+        if self.__ax3d is None or not plt.fignum_exists(self.__ax3d.figure.number):
+            fig = plt.figure()
+            self.__ax3d  = fig.add_subplot(111, projection='3d')
+            self.__paths = []
+            for lim in ['xlim_changed', 'ylim_changed']:
+                self.__ax3d.callbacks.connect(lim, self.__update_paths)
+        self.__ax3d.set_xlabel('X')
+        self.__ax3d.set_ylabel('Y')
+        self.__ax3d.set_zlabel('Z')
+        return self.__ax3d
+
+    @staticmethod
+    def __screen_px(ax) -> float:
+        """ Size of the axes on screen, in pixels (largest side). """
+        fig = ax.figure
+        return float(max(fig.get_size_inches() * fig.dpi * ax.get_position().size))
+
+    def print_hmap3d(self, hmap: HMapBuffer):
+        if type(hmap) is not HMapBuffer or hmap.empty():
+            log.info('View: empty heightmap.')
+            return
+        pts = np.array(list(hmap), dtype=float).reshape(-1, 3)
+        xs, ys = np.unique(pts[:, 0]), np.unique(pts[:, 1])
+        if xs.size * ys.size == pts.shape[0]:
+            # Regular probing grid
+            Z = np.full((ys.size, xs.size), np.nan)
+            Z[np.searchsorted(ys, pts[:, 1]), np.searchsorted(xs, pts[:, 0])] = pts[:, 2]
+        else:
+            n = int(np.ceil(np.sqrt(pts.shape[0])))
+            xs = np.linspace(xs[0], xs[-1], n)
+            ys = np.linspace(ys[0], ys[-1], n)
+            Z = griddata(pts[:, 0:2], pts[:, 2], tuple(np.meshgrid(xs, ys)), method='linear')
+        X, Y = np.meshgrid(xs, ys)
+
+        ax = self.__setup_plot3d()
+        # Level of detail: no more mesh cells than the screen can show
+        cells = max(int(self.__screen_px(ax) / self.mesh_px), 2)
+        ax.plot_surface(X, Y, Z, cmap=cm.viridis, rcount=min(cells, Z.shape[0]),
+                        ccount=min(cells, Z.shape[1]), linewidth=0, antialiased=False, alpha=0.8)
+        plt.draw()
+
+    def print_path3d(self, gcode: GCodeBuffer):
+        if type(gcode) is not GCodeBuffer or gcode.empty():
+            log.info('View: empty GCode buffer.')
+            return
+        t = gcode.motion_table(self[self.pt.initialcoord])
+        if t.size == 0:
+            log.info('View: no motion in GCode buffer.')
+            return
+        arcs = [(k, GCodeBuffer.get_arc(gcode.data[t.index[k]]), t.g[k] == 2) for k in np.flatnonzero(t.arc)]
+        end, row = expand_arcs(t.start, t.end, arcs, self[self.pt.arc_tol])
+        pts = np.concatenate((t.start[0:1], end))
+        rapid = t.g[row] == 0
+
+        ax = self.__setup_plot3d()
+        for mask, style in [(~rapid, dict(color='b', linewidth=0.6)),
+                            (rapid, dict(color='0.6', linestyle=':', linewidth=0.5))]:
+            p = polyline_runs(pts, mask)
+            if p.shape[0] == 0:
+                continue
+            line, = ax.plot(p[:, 0], p[:, 1], p[:, 2], **style)
+            self.__paths.append([p, line])
+        self.__update_paths(ax)
+        plt.draw()
+
+    def __update_paths(self, ax):
+        """ Re-simplifies the toolpaths for the visible region and current zoom. """
+        if not self.__paths:
+            return
+        xl, yl = ax.get_xlim(), ax.get_ylim()
+        # Tolerance of about path_px pixels; points far outside the view are dropped
+        tol = self.path_px * max(xl[1] - xl[0], yl[1] - yl[0]) / self.__screen_px(ax)
+        mx, my = 0.1 * (xl[1] - xl[0]), 0.1 * (yl[1] - yl[0])
+        for p, line in self.__paths:
+            out = (p[:, 0] < xl[0] - mx) | (p[:, 0] > xl[1] + mx) | \
+                  (p[:, 1] < yl[0] - my) | (p[:, 1] > yl[1] + my)
+            v = p.copy()
+            v[out] = np.nan
+            s = simplify_polyline(v, tol)
+            while s.shape[0] > self.maxpts and tol < max(xl[1] - xl[0], yl[1] - yl[0]):
+                tol *= 2.0
+                s = simplify_polyline(v, tol)
+            line.set_data_3d(s[:, 0], s[:, 1], s[:, 2])
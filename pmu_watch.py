@@ -0,0 +1,142 @@
+import ctypes
+import ctypes.util
+import select
+import struct
+import time
+import sys
+import os
+
+
+class FileWatcher(object):
+    """
+    Waits for files to change.
+    On Linux, inotify watches the files' directories, so files replaced by a rename
+    (as many CAM tools and editors save) are still followed. Elsewhere, or if inotify
+    is unavailable, the files are polled with os.stat.
+    A file is reported once it exists and its size, mtime or inode changed, and no
+    further event arrived for debounce seconds (files written in several chunks are
+    only reported once they settled).
+    """
+    IN_MODIFY      = 0x002
+    IN_ATTRIB      = 0x004
+    IN_CLOSE_WRITE = 0x008
+    IN_MOVED_TO    = 0x080
+    IN_CREATE      = 0x100
+    IN_DELETE      = 0x200
+    __mask  = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    __event = struct.Struct('iIII')  # wd, mask, cookie, len
+
+    def __init__(self, paths: list, debounce=0.1, interval=0.1, poll=False):
+        """
+        :param paths: Files to watch.
+        :param debounce: Quiet time (s) after the last event before reporting.
+        :param interval: Polling period (s), if polling.
+        :param poll: Forces polling instead of inotify.
+        """
+        self.__paths    = [os.path.abspath(p) for p in paths]
+        self.__debounce = float(debounce)
+        self.__interval = float(interval)
+        self.__stats    = {p: self.__stat(p) for p in self.__paths}
+        self.__fd  = None
+        self.__wds = {}  # watch descriptor -> directory
+        if not poll:
+            self.__init_inotify()
+
+    @property
+    def paths(self) -> list:
+        return self.__paths
+
+    @property
+    def method(self) -> str:
+        return 'inotify' if self.__fd is not None else 'poll'
+
+    def __init_inotify(self):
+        if not sys.platform.startswith('linux'):
+            return
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        except (OSError, AttributeError):
+            return
+        if fd < 0:
+            return
+        for d in sorted(set(os.path.dirname(p) for p in self.__paths)):
+            wd = libc.inotify_add_watch(fd, d.encode(), self.__mask)
+            if wd < 0:
+                os.close(fd)
+                self.__wds = {}
+                return
+            self.__wds[wd] = d
+        self.__fd = fd
+
+    def close(self):
+        if self.__fd is not None:
+            os.close(self.__fd)
+            self.__fd = None
+            self.__wds = {}
+
+    @staticmethod
+    def __stat(path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return st.st_size, st.st_mtime_ns, st.st_ino
+
+    def __changed(self) -> list:
+        """ Existing files whose stat differs from the last reported one. """
+        return [p for p in self.__paths
+                if self.__stat(p) is not None and self.__stat(p) != self.__stats[p]]
+
+    def __read_events(self) -> bool:
+        """ Drains pending inotify events; True if any concerns a watched file. """
+        hit = False
+        while True:
+            try:
+                buf = os.read(self.__fd, 65536)
+            except BlockingIOError:
+                return hit
+            i = 0
+            while i < len(buf):
+                wd, _, _, n = self.__event.unpack_from(buf, i)
+                name = buf[i + self.__event.size:i + self.__event.size + n].rstrip(b'\0').decode(errors='replace')
+                i += self.__event.size + n
+                if os.path.join(self.__wds.get(wd, ''), name) in self.__stats:
+                    hit = True
+
+    def wait(self, timeout=None) -> list:
+        """
+        Blocks until watched files changed and settled.
+        :param timeout: Maximum time to wait (s); None waits forever.
+        :return: Changed files (empty on timeout), in the order they were given.
+        """
+        end = None if timeout is None else time.monotonic() + timeout
+        while True:
+            left = None if end is None else max(end - time.monotonic(), 0.0)
+            if self.__fd is not None:
+                r, _, _ = select.select([self.__fd], [], [], left)
+                if not r:
+                    return []
+                if not self.__read_events():
+                    continue
+                # Debounce: wait for the writer to go quiet
+                while select.select([self.__fd], [], [], self.__debounce)[0]:
+                    self.__read_events()
+            else:
+                if not self.__changed():
+                    if left == 0.0:
+                        return []
+                    time.sleep(self.__interval if left is None else min(self.__interval, left))
+                    continue
+                sig = {p: self.__stat(p) for p in self.__paths}
+                while True:
+                    time.sleep(self.__debounce)
+                    now = {p: self.__stat(p) for p in self.__paths}
+                    if now == sig:
+                        break
+                    sig = now
+            changed = self.__changed()
+            for p in changed:
+                self.__stats[p] = self.__stat(p)
+            if changed:
+                return changed
@@ -29,6 +29,10 @@ class DefaultParamNameTable():
             Const.__init__(self)
             # Variable name bindings
             self.precision    = 'precision'
+            self.log_level    = 'log_level'
+            self.fixed_point  = 'fixed_point'
+            self.parse_procs  = 'parse_procs'
+            self.gcode_modal  = 'gcode_modal'
 
             self.drltol       = 'drltol'
             self.drlscope     = 'drlscope'
@@ -39,11 +43,56 @@ class DefaultParamNameTable():
             self.probe_tick   = 'probe_tick'
             self.mirrorax     = 'mirrorax'
             self.mirrorval    = 'mirrorval'
+            self.probe_port   = 'probe_port'
+            self.probe_baud   = 'probe_baud'
+            self.probe_feed   = 'probe_feed'
+            self.probe_depth  = 'probe_depth'
+            self.probe_clear  = 'probe_clear'
 
             self.mincutdepth  = 'mincutdepth'
             self.initialcoord = 'initialcoord'
             self.zthreshold   = 'zthreshold'
             self.xysampling   = 'xysampling'
+            self.arc_tol      = 'arc_tol'
+            self.lvl_procs    = 'lvl_procs'
+            self.surf_cache   = 'surf_cache'
+            self.mesh_fw      = 'mesh_fw'
+            self.mesh_size    = 'mesh_size'
+            self.mesh_lims    = 'mesh_lims'
+
+            self.safez        = 'safez'
+            self.crop_lims    = 'crop_lims'
+            self.crop_tiles   = 'crop_tiles'
+
+            self.opt_reverse  = 'opt_reverse'
+            self.opt_passes   = 'opt_passes'
+
+            self.iso_tool     = 'iso_tool'
+            self.iso_passes   = 'iso_passes'
+            self.iso_overlap  = 'iso_overlap'
+            self.iso_depth    = 'iso_depth'
+            self.iso_feed     = 'iso_feed'
+            self.iso_res      = 'iso_res'
+            self.iso_speed    = 'iso_speed'
+            self.iso_mem      = 'iso_mem'
+
+            self.drill_depth  = 'drill_depth'
+            self.drill_clear  = 'drill_clear'
+            self.drill_feed   = 'drill_feed'
+            self.drill_speed  = 'drill_speed'
+            self.spindle_dwell = 'spindle_dwell'
+
+            self.outliertol   = 'outliertol'
+
+            self.max_vel      = 'max_vel'
+            self.max_acc      = 'max_acc'
+            self.junction_dev = 'junction_dev'
+
+            self.resume_every = 'resume_every'
+            self.resume_feed  = 'resume_feed'
+
+            self.watch_debounce = 'watch_debounce'
+            self.history_mb   = 'history_mb'
 
     def __init__(self):
         if not DefaultParamNameTable.__instance:
@@ -60,11 +109,18 @@ class BaseWorkspace(object):
     """
     Specifies a dictionary that can only receive pre-defined types of variables.
     Lists also have pre-defined types of accepted variables.
+    Every change bumps the workspace version and the changed key's version, and is
+    forwarded to subscribed workspaces, which only receive the keys that changed.
     """
     def __init__(self, groupname=''):
         self.__paramdict = OrderedDict()
         self.__groupname = groupname # Defaults to '', root (free) group
 
+        self.__version     = 0     # Bumped on every parameter change
+        self.__versions    = {}    # Version of each key's last change
+        self.__subscribers = []
+        self.__batch       = None  # Keys changed while parsing a dictionary
+
     @property
     def param(self) -> dict:
         return self.__paramdict
@@ -74,6 +130,14 @@ class BaseWorkspace(object):
         """ Returns the name under which the parameters are grouped. """
         return self.__groupname
 
+    @property
+    def version(self) -> int:
+        return self.__version
+
+    def key_version(self, key) -> int:
+        """ Version of the workspace when key last changed (0 if never). """
+        return self.__versions.get(key, 0)
+
     @property
     def dict(self) -> dict:
         d = OrderedDict()
@@ -102,9 +166,49 @@ class BaseWorkspace(object):
         if type(value) is list and \
                 not all([j in self.__tl(key) for j in [type(i) for i in value]]):
             return False
+        if self.__paramdict[key][1] == value:
+            return True
         self.__paramdict[key][1] = value
+        self.__changed(key)
         return True
 
+    def __changed(self, key):
+        self.__version += 1
+        self.__versions[key] = self.__version
+        if self.__batch is not None:
+            self.__batch.append(key)
+        else:
+            self.__notify([key])
+
+    def __notify(self, keys):
+        """ Hands the changed keys to the subclass hook, then to every subscriber. """
+        if not keys:
+            return
+        keys = list(OrderedDict.fromkeys(keys))
+        self.params_changed(keys)
+        changed = OrderedDict((k, self[k]) for k in keys)
+        for s in self.__subscribers:
+            s.parse_dict(changed, quiet=True)
+
+    def subscribe(self, ws):
+        """
+        Keeps ws's parameters in sync with this workspace's: ws gets every parameter now,
+        then only the ones that change. Keys unknown to ws are ignored.
+        """
+        if not issubclass(type(ws), BaseWorkspace):
+            raise TypeError
+        if ws not in self.__subscribers:
+            self.__subscribers.append(ws)
+        ws.parse_dict(self.dict, quiet=True)
+
+    def unsubscribe(self, ws):
+        if ws in self.__subscribers:
+            self.__subscribers.remove(ws)
+
+    def params_changed(self, keys: list):
+        """ Hook called with the keys that changed; derived classes invalidate caches here. """
+        pass
+
     def addparam(self, key: str, typ: list, val):
         """ Add a parameter with predefined key and type.
         If is list, define at least one element type, e.g., addparam('l', [list,int], [1,2])"""
@@ -121,11 +225,23 @@ class BaseWorkspace(object):
     #         self[e] = param[e]
 
     def parse_dict(self, dict, allow_new=False, quiet=False):
-        """Parses dictionary. Converts variables to registered types, including lists."""
+        """Parses dictionary. Converts variables to registered types, including lists.
+        Subscribers are notified once, with all keys that changed."""
+        if self.__batch is not None:
+            return self.__parse_dict(dict, allow_new, quiet)
+        self.__batch = []
+        try:
+            self.__parse_dict(dict, allow_new, quiet)
+        finally:
+            keys, self.__batch = self.__batch, None
+            self.__notify(keys)
+
+    def __parse_dict(self, dict, allow_new, quiet):
         for key in dict:
             if key not in self.__paramdict:
                 if allow_new:
                     self.addparam(key, [type(dict[key])], dict[key])
+                    self.__changed(key)
                 continue
             if type(dict[key]) is str and self.type(key) is list:
                 try:
@@ -159,6 +275,10 @@ class DefaultWorkspace(BaseWorkspace):
 
         # General
         self.addparam(self.pt.precision, [int], 4)  # amount of digits to be used after comma
+        self.addparam(self.pt.log_level, [str], 'info')  # messages shown: debug, info, warning or error
+        self.addparam(self.pt.fixed_point, [int], 0)  # 1 reads/writes coordinates as integer units of precision
+        self.addparam(self.pt.parse_procs, [int], 1)  # processes parsing large GCode files; 0 uses all cores
+        self.addparam(self.pt.gcode_modal, [int], 0)  # 1 reads coordinate-only GCode lines as the modal motion
         # Drill avoidance and grid generation
         self.addparam(self.pt.drltol, [float, int], 1.0)  # minimum distance from probing pt to drill (mm)
         self.addparam(self.pt.drlscope, [float, int], 5.0)  # distance of drills considered when avoiding
@@ -169,11 +289,59 @@ class DefaultWorkspace(BaseWorkspace):
         self.addparam(self.pt.probe_tick, [list, int], [1, 1])  # how many pts, [xtick ytick]
         self.addparam(self.pt.mirrorax, [str], '')  # axis to mirror drills, parallel to 'x' or 'y'
         self.addparam(self.pt.mirrorval, [float, int], 0.0)  # mirror axis position
+        # Probing
+        self.addparam(self.pt.probe_port, [str], '')  # serial port of the (GRBL) controller
+        self.addparam(self.pt.probe_baud, [int], 115200)  # serial baud rate
+        self.addparam(self.pt.probe_feed, [float, int], 50.0)  # probing feed (mm/min)
+        self.addparam(self.pt.probe_depth, [float, int], -2.0)  # lowest height searched for the surface
+        self.addparam(self.pt.probe_clear, [float, int], 1.0)  # retract height between probed points
         # GCode leveling
         self.addparam(self.pt.mincutdepth, [float, int], 0.0)  # height to break motion concatenation
         self.addparam(self.pt.initialcoord, [list, float, int], [0.0, 0.0, 0.0])  # machine initial coordinates
         self.addparam(self.pt.zthreshold, [float, int], 0.01)  # threshold to add another point in leveling path
         self.addparam(self.pt.xysampling, [float, int], 1.0)  # zthreshold sampling rate
+        self.addparam(self.pt.arc_tol, [float, int], 0.005)  # max deviation when arcs are replaced by lines
+        self.addparam(self.pt.lvl_procs, [int], 1)  # leveling processes; 0 uses all cores
+        self.addparam(self.pt.surf_cache, [int], 65536)  # heightmap evaluations kept in cache
+        # Controller-side (firmware mesh) leveling
+        self.addparam(self.pt.mesh_fw, [str], 'marlin_abl')  # mesh format: marlin_abl (M421) or marlin_mbl (G29 S3)
+        self.addparam(self.pt.mesh_size, [list, int], [5, 5])  # firmware mesh nodes, [xnodes ynodes]
+        self.addparam(self.pt.mesh_lims, [list, float, int], [0.0, 1.0, 0.0, 1.0])  # firmware mesh bounds, [xmin xmax ymin ymax]
+        # Cropping
+        self.addparam(self.pt.safez, [float, int], 2.0)  # height of inserted retract/travel moves
+        self.addparam(self.pt.crop_lims, [list, float, int], [0.0, 1.0, 0.0, 1.0])  # [xmin xmax ymin ymax]
+        self.addparam(self.pt.crop_tiles, [list, int], [1, 1])  # how many tiles, [xtiles ytiles]
+        # Travel optimization
+        self.addparam(self.pt.opt_reverse, [int], 0)  # 1 allows cutting open contours backwards
+        self.addparam(self.pt.opt_passes, [int], 3)  # maximum 2-opt improvement passes
+        # Isolation routing
+        self.addparam(self.pt.iso_tool, [float, int], 0.2)  # isolation tool (cut) width
+        self.addparam(self.pt.iso_passes, [int], 1)  # isolation passes around copper
+        self.addparam(self.pt.iso_overlap, [float, int], 0.3)  # overlap of passes, fraction of the tool width
+        self.addparam(self.pt.iso_depth, [float, int], -0.1)  # isolation cut depth
+        self.addparam(self.pt.iso_feed, [float, int], 200.0)  # isolation feed (mm/min)
+        self.addparam(self.pt.iso_res, [float, int], 0.02)  # copper raster resolution; toolpaths are within ~iso_res of exact
+        self.addparam(self.pt.iso_speed, [float, int], 10000.0)  # isolation spindle speed (rpm)
+        self.addparam(self.pt.iso_mem, [float, int], 1024)  # memory the copper raster may take (MB)
+        # Drilling
+        self.addparam(self.pt.drill_depth, [float, int], -1.8)  # hole target depth
+        self.addparam(self.pt.drill_clear, [float, int], 0.5)  # retract height between holes of a tool
+        self.addparam(self.pt.drill_feed, [float, int], 60.0)  # plunge feed (mm/min)
+        self.addparam(self.pt.drill_speed, [float, int], 10000.0)  # drilling spindle speed (rpm)
+        self.addparam(self.pt.spindle_dwell, [float, int], 2.0)  # wait (s) for the spindle to reach speed
+        # Heightmap validation
+        self.addparam(self.pt.outliertol, [float, int], 0.05)  # max residual of a probe to the fitted surface
+        # Run time estimation
+        self.addparam(self.pt.max_vel, [list, float, int], [2000.0, 2000.0, 500.0])  # [x y z] mm/min
+        self.addparam(self.pt.max_acc, [list, float, int], [100.0, 100.0, 50.0])  # [x y z] mm/s^2
+        self.addparam(self.pt.junction_dev, [float, int], 0.01)  # cornering deviation (mm)
+        # Job resume
+        self.addparam(self.pt.resume_every, [int], 1000)  # blocks between modal state checkpoints
+        self.addparam(self.pt.resume_feed, [float, int], 60.0)  # plunge feed if none was set before the line (mm/min)
+        # Watch mode
+        self.addparam(self.pt.watch_debounce, [float, int], 0.1)  # quiet time (s) before reacting to a change
+        # Work buffer history
+        self.addparam(self.pt.history_mb, [float, int], 256)  # memory budget of the undo history (MB)
 
     @property
     def pt(self):
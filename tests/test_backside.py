@@ -0,0 +1,60 @@
+from pmu_planner import *
+
+import numpy as np
+import pytest
+
+
+def front(x, y):
+    return 0.004 * x + 0.002 * y - 0.01
+
+
+def front_hmap() -> HMapBuffer:
+    h = HMapBuffer()
+    h.data = [(float(x), float(y), front(x, y)) for x in np.linspace(0.0, 40.0, 5) for y in np.linspace(0.0, 30.0, 4)]
+    return h
+
+
+def back(x, y, mirrorval=20.0):
+    """ Height seen on the flipped board (mirrored about x = mirrorval). """
+    return -front(2.0 * mirrorval - x, y)
+
+
+def planner() -> pmuPlanner:
+    p = pmuPlanner()
+    for ws in (p.BackSide, p.Leveler):
+        ws[ws.pt.mirrorax]  = 'x'
+        ws[ws.pt.mirrorval] = 20.0
+    p.Leveler[p.Leveler.pt.lvl_procs] = 1
+    return p
+
+
+def test_derive_mirrors_and_inverts():
+    b = planner().BackSide.derive(front_hmap())
+    assert b.size == 20
+    for x, y, z in b:
+        assert z == pytest.approx(back(x, y), abs=1e-4)
+
+
+def test_registration_corrects_offset_and_tilt():
+    reg = HMapBuffer()
+    reg.data = [(x, y, back(x, y) + 0.05 + 0.001 * x) for x, y in [(4.0, 3.0), (36.0, 3.0), (4.0, 27.0), (36.0, 27.0)]]
+    bs = planner().BackSide
+    b = bs.derive(front_hmap(), reg)
+    assert bs.report['offset'] == pytest.approx(0.05, abs=1e-6)
+    assert bs.report['tilt_x'] == pytest.approx(0.001, abs=1e-6)
+    assert bs.report['residual'] == pytest.approx(0.0, abs=1e-6)
+    for x, y, z in b:
+        assert z == pytest.approx(back(x, y) + 0.05 + 0.001 * x, abs=1e-4)
+
+
+def test_level_back_copper():
+    g = GCodeBuffer()
+    g.data = ['G21\n', (0, None, 5.0, 5.0, 2.0), (1, 100.0, None, None, -0.1), (1, None, 35.0, 25.0, None),
+              (0, None, None, None, 2.0)]
+    p = planner()
+    assert p.leveling_run_back(g, front_hmap())
+    moves = [bl for bl in p.buffer.data if type(bl) is tuple]
+    assert moves[-2][2:4] == (35.0, 25.0)
+    for bl in moves:
+        orig = 2.0 if bl[0] == 0 else -0.1
+        assert bl[4] == pytest.approx(orig + back(bl[2], bl[3]), abs=2e-4)
@@ -0,0 +1,53 @@
+from pmu_planner import *
+
+import numpy as np
+import pytest
+
+
+def holes() -> ExcellonBuffer:
+    e = ExcellonBuffer()
+    e.load({1: 0.8, 2: 1.0}, [[1, 2.0, 2.0], [1, 30.0, 2.0], [1, 16.0, 20.0], [2, 35.0, 25.0]])
+    return e
+
+
+def rising(x, y):
+    return 0.05 * x
+
+
+def test_tool_changes_start_the_spindle():
+    d = Drilling()
+    assert d.run_drilling(holes())
+    out = d.drillGCode.data
+    for t in (1, 2):
+        k = out.index('T{} M06\n'.format(t))
+        assert out[k + 1] == 'M03 S{:g}\n'.format(d[d.pt.drill_speed])
+        assert out[k + 2] == 'G04 P{:g}\n'.format(d[d.pt.spindle_dwell])
+        # Stopped before the change, except for the first tool
+        assert (out[k - 2] == 'M05\n') == (t == 2)
+    assert out[-1] == 'M05\n'
+
+
+def test_rapids_clear_the_surface_at_both_holes():
+    d = Drilling()
+    assert d.run_drilling(holes(), rising)
+    clear = d[d.pt.drill_clear]
+    pos = None
+    for bl in d.drillGCode.data:
+        if type(bl) is not tuple:
+            continue
+        p = [pos[a] if pos is not None and bl[2 + a] is None else bl[2 + a] for a in range(3)]
+        if bl[0] == 0 and pos is not None and None not in pos and (p[0], p[1]) != (pos[0], pos[1]):
+            # XY rapids run above the clearance of where they leave and where they arrive
+            assert p[2] == pos[2]
+            assert p[2] >= clear + max(rising(pos[0], pos[1]), rising(p[0], p[1])) - 1e-9
+        pos = p
+
+
+def test_holes_follow_the_surface():
+    d = Drilling()
+    assert d.run_drilling(holes(), rising)
+    depth = d[d.pt.drill_depth]
+    plunges = [bl for bl in d.drillGCode.data if type(bl) is tuple and bl[0] == 1]
+    assert len(plunges) == 4
+    for bl in plunges:
+        assert bl[4] == pytest.approx(depth + rising(bl[2], bl[3]), abs=1e-4)
@@ -0,0 +1,65 @@
+from pmu_planner import *
+
+import numpy as np
+import pytest
+
+
+def estimate(data) -> OrderedDict:
+    g = GCodeBuffer()
+    g.data = data
+    e = Estimating()
+    e[e.pt.initialcoord] = [0.0, 0.0, 0.0]
+    e[e.pt.max_vel] = [2000.0, 2000.0, 500.0]
+    e[e.pt.max_acc] = [100.0, 100.0, 50.0]
+    return e.run_estimate(g)
+
+
+def test_trapezoidal_move():
+    # 10 mm/s reached in 0.1 s over 0.5 mm, at both ends
+    r = estimate([(1, 600.0, 100.0, None, None)])
+    assert r['cut_length'] == pytest.approx(100.0)
+    assert r['cut_time'] == pytest.approx(0.1 + 99.0 / 10.0 + 0.1)
+    assert r['rapid_time'] == 0.0
+
+
+def test_triangular_move():
+    # Too short to reach the feed: accelerates over half, decelerates over the other
+    r = estimate([(1, 600.0, 0.5, None, None)])
+    assert r['cut_time'] == pytest.approx(2.0 * np.sqrt(0.5 / 100.0))
+
+
+def test_rapids_run_at_max_vel():
+    v = 2000.0 / 60.0
+    r = estimate([(0, None, 100.0, None, None)])
+    assert r['rapid_time'] == pytest.approx(2.0 * v / 100.0 + (100.0 - v * v / 100.0) / v)
+    assert r['rapid_length'] == pytest.approx(100.0)
+
+
+def test_z_moves_use_z_limits():
+    r = estimate([(0, None, None, None, -10.0)])
+    v = 500.0 / 60.0
+    assert r['rapid_time'] == pytest.approx(2.0 * v / 50.0 + (10.0 - v * v / 50.0) / v)
+
+
+def test_non_comment_lines_stop_the_machine():
+    straight = [(1, 600.0, 50.0, None, None), (1, None, 100.0, None, None)]
+    assert estimate(straight)['total_time'] == pytest.approx(estimate([(1, 600.0, 100.0, None, None)])['total_time'])
+    commented = estimate([straight[0], '(half way)\n', straight[1]])
+    assert commented['total_time'] == pytest.approx(estimate(straight)['total_time'])
+    assert commented['stops'] == 0
+    stopped = estimate([straight[0], 'M00\n', straight[1]])
+    assert stopped['stops'] == 1
+    # Decelerating and accelerating again take 0.2 s instead of 0.1 s cruising over 1 mm
+    assert stopped['total_time'] == pytest.approx(estimate(straight)['total_time'] + 0.1)
+
+
+def test_corners_slow_down():
+    corner = estimate([(1, 600.0, 50.0, None, None), (1, None, 50.0, 50.0, None)])['total_time']
+    straight = estimate([(1, 600.0, 50.0, None, None), (1, None, 100.0, None, None)])['total_time']
+    assert straight < corner < straight + 0.2
+
+
+def test_arcs_are_estimated_along_their_length():
+    r = estimate([(1, 600.0, 10.0, None, None), (3, None, 0.0, 10.0, None, -10.0, 0.0, None)])
+    assert r['cut_length'] == pytest.approx(10.0 + np.pi * 10.0 / 2.0, rel=1e-3)
+    assert r['segments'] > 2 and r['blocks'] == 2
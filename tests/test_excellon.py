@@ -0,0 +1,112 @@
+from pmu_buffers import ExcellonBuffer, FixedPoint
+from pmu_parsers import ExcellonParser
+
+import numpy as np
+import threading
+import pytest
+
+
+def drills() -> ExcellonBuffer:
+    b = ExcellonBuffer()
+    b.load({1: 0.8, 2: 1.0}, [[2, 5.0, 5.0], [1, 1.0, 2.0], [1, 3.0, 4.0]])
+    return b
+
+
+def test_drills_are_sorted_by_tool():
+    b = drills()
+    assert list(b) == [[0.8, 1.0, 2.0], [0.8, 3.0, 4.0], [1.0, 5.0, 5.0]]
+    assert b.by_tool(1).tolist() == [[0, 1.0, 2.0], [0, 3.0, 4.0]]
+    assert b.by_tool(3).shape == (0, 3)
+
+
+def test_reads_are_read_only_views():
+    b = drills()
+    for a in (b.data, b.xy, b.by_tool(2), b[0:2].data):
+        with pytest.raises(ValueError):
+            a[0, 0] = 7.0
+    assert b.by_tool(2).base is not None
+
+
+def test_mirror_and_translate_return_new_buffers():
+    b = drills()
+    v = b.version
+    m = b.mirror('x', 10.0)
+    t = b.translate(1.0, -1.0)
+    assert m is not b and t is not b and b.version == v
+    assert m.xy[:, 0].tolist() == [19.0, 17.0, 15.0]
+    assert t.xy.tolist() == [[2.0, 1.0], [4.0, 3.0], [6.0, 4.0]]
+    assert b.xy.tolist() == [[1.0, 2.0], [3.0, 4.0], [5.0, 5.0]]
+    assert m.tools == b.tools
+
+
+def test_appends_are_sorted_in():
+    b = drills()
+    b.append([1.0, 9.0, 9.0])
+    b.append([0.5, 0.0, 0.0])
+    assert b.size == 5
+    assert b.tools == {1: 0.8, 2: 1.0, 3: 0.5}
+    assert b.by_tool(2).tolist() == [[1, 5.0, 5.0], [1, 9.0, 9.0]]
+    assert list(b)[-1] == [0.5, 0.0, 0.0]
+
+
+def test_concurrent_appends_and_reads():
+    b = drills()
+
+    def add(k):
+        for i in range(500):
+            b.append([0.8, float(k), float(i)])
+            if i % 50 == 0:
+                b.by_tool(1)
+
+    threads = [threading.Thread(target=add, args=(k,)) for k in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert b.size == 3 + 4 * 500
+    assert b.by_tool(1).shape == (2 + 4 * 500, 3)
+    assert np.all(np.diff(b.data[:, ExcellonBuffer.T]) >= 0)
+
+
+@pytest.fixture
+def excellon(tmp_path):
+    def parse(text, fixed=None):
+        f = tmp_path / 'drills.drl'
+        f.write_text(text)
+        p = ExcellonParser()
+        p.fixed = fixed
+        assert p.parse_file(str(f))
+        return p.buffer
+    return parse
+
+
+HEADER = 'M48\n{}\nT1C0.8\nT2C1.0\n%\n'
+
+
+@pytest.mark.parametrize('fixed', [None, FixedPoint(4)])
+def test_leading_zeros_kept(excellon, fixed):
+    b = excellon(HEADER.format('METRIC,LZ,000.000') + 'T1\nX001500Y0025\nX-0015Y-00025\nM30\n', fixed)
+    assert b.xy.tolist() == [[1.5, 2.5], [-1.5, -0.25]]
+
+
+@pytest.mark.parametrize('fixed', [None, FixedPoint(4)])
+def test_trailing_zeros_kept(excellon, fixed):
+    b = excellon(HEADER.format('METRIC,TZ,000.000') + 'T2\nX1500Y25\nX-1500Y250\nM30\n', fixed)
+    assert b.xy.tolist() == [[1.5, 0.025], [-1.5, 0.25]]
+    assert b.tools == {1: 0.8, 2: 1.0}
+
+
+def test_inch_and_explicit_decimals(excellon):
+    b = excellon(HEADER.format('INCH,LZ') + 'T1\nX0150Y01\nX1.5Y-0.5\nM30\n')
+    assert b.xy == pytest.approx(np.array([[38.1, 25.4], [38.1, -12.7]]))
+    assert b.tools[1] == pytest.approx(0.8 * 25.4)
+
+
+def test_file_format_comment_and_repeats(excellon):
+    b = excellon(HEADER.format(';FILE_FORMAT=2:4\nMETRIC,LZ') + 'T1\nX01Y01\nX005R3\nM30\n')
+    assert b.xy == pytest.approx(np.array([[1.0, 1.0], [1.5, 1.0], [2.0, 1.0], [2.5, 1.0]]))
+
+
+def test_incremental_coordinates(excellon):
+    b = excellon(HEADER.format('METRIC,TZ,000.000\nICI') + 'T1\nX1000Y1000\nX500\nY-2000\nM30\n')
+    assert b.xy.tolist() == [[1.0, 1.0], [1.5, 1.0], [1.5, -1.0]]
@@ -0,0 +1,87 @@
+from pmu_parsers import GCodeParser
+
+import pytest
+
+
+PROGRAM = """G21
+G90 G00 X0 Y0 Z5 S1000 M03
+G01 Z-0.1 F100
+X10 Y0
+G01 X10 Y10 T2
+G02 X0 Y10 I-5 J0
+G92 X0 Y0
+G53 G00 Z10
+G00 X5 Y5 M02
+"""
+
+
+@pytest.fixture
+def gcode(tmp_path):
+    def parse(text, modal_axes=False, procs=1):
+        f = tmp_path / 'in.nc'
+        f.write_text(text)
+        p = GCodeParser()
+        p.modal_axes = modal_axes
+        p.procs = procs
+        assert p.parse_file(str(f))
+        return p
+    return parse
+
+
+def written(p, tmp_path) -> list:
+    out = tmp_path / 'out.nc'
+    assert p.write_file(str(out), p.buffer)
+    return out.read_text().splitlines()
+
+
+def test_other_words_stay_on_the_motion_line(gcode, tmp_path):
+    p = gcode(PROGRAM)
+    data = p.buffer.data
+    assert data[1] == 'G90 S1000 M03 '
+    assert data[2] == (0, None, 0.0, 0.0, 5.0)
+    assert p.report['prefixed'] == 3
+    lines = written(p, tmp_path)
+    assert len(lines) == len(PROGRAM.splitlines()) + 1  # M02 on a line of its own
+    assert lines[1] == 'G90 S1000 M03 G00 X0.0 Y0.0 Z5.0'
+    assert lines[4] == 'T2 G01 X10.0 Y10.0'
+
+
+def test_program_end_follows_the_block(gcode, tmp_path):
+    p = gcode(PROGRAM)
+    assert p.buffer.data[-2:] == [(0, None, 5.0, 5.0, None), 'M02\n']
+    assert written(p, tmp_path)[-2:] == ['G00 X5.0 Y5.0', 'M02']
+
+
+def test_coordinates_without_g_word(gcode):
+    p = gcode(PROGRAM)
+    assert p.buffer.data[4] == 'X10 Y0\n'
+    p = gcode(PROGRAM, modal_axes=True)
+    assert p.buffer.data[4] == (1, None, 10.0, 0.0, None)
+
+
+def test_argument_codes_stay_whole(gcode):
+    p = gcode(PROGRAM)
+    assert 'G92 X0 Y0\n' in p.buffer.data
+    assert 'G53 G00 Z10\n' in p.buffer.data
+    p = gcode('G81 X1 Y1 Z-1 R1\nX2 Y2\n', modal_axes=True)
+    assert p.buffer.data == ['G81 X1 Y1 Z-1 R1\n', 'X2 Y2\n']
+
+
+def test_arcs(gcode):
+    p = gcode(PROGRAM)
+    assert (2, None, 0.0, 10.0, None, -5.0, 0.0, None) in p.buffer.data
+    assert p.report['arcs'] == 1
+    p = gcode('G18\nG02 X1 Z1 I1 K0\n')
+    assert p.buffer.data[1] == 'G02 X1 Z1 I1 K0\n'
+    assert p.report['skipped_arcs'] == 1
+
+
+def test_parallel_parse_matches_serial(gcode, monkeypatch):
+    text = 'G01 X0 Y0 F100\n' + ''.join('X{} Y{} S{}\n'.format(i, i % 7, i % 3) for i in range(2000))
+    serial = gcode(text, modal_axes=True)
+    monkeypatch.setattr(GCodeParser, 'parallelMin', 0)
+    parallel = gcode(text, modal_axes=True, procs=3)
+    assert parallel.buffer.data == serial.buffer.data
+    assert parallel.report == serial.report
+    assert parallel.buffer.source_lines() == serial.buffer.source_lines()
+    assert len(serial.buffer.source_lines()) == 2001
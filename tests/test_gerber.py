@@ -0,0 +1,75 @@
+from pmu_parsers import GerberParser
+
+import pytest
+
+
+KICAD = """%TF.GenerationSoftware,KiCad,Pcbnew,8.0*%
+%FSLAX46Y46*%
+%MOMM*%
+%LPD*%
+%AMRoundRect*
+0 Rectangle with rounded corners*
+0 $1 Rounding radius*
+21,1,$2-$1-$1,$3,$4,$5,0*
+1,1,$1+$1,$4,$5*%
+%ADD10RoundRect,0.250000X1.000000X1.000000X0.000000X0.000000*%
+%ADD11C,0.800000*%
+%ADD12R,1.500000X0.600000*%
+%ADD13O,1.000000X2.000000*%
+%ADD14P,1.200000X6*%
+%ADD15R,1.000000*%
+G04 pads*
+D10*
+X10000000Y10000000D03*
+D11*
+X20000000Y10000000D03*
+D12*
+X30000000Y10000000D03*
+D13*
+X40000000Y10000000D03*
+D14*
+X50000000Y10000000D03*
+D15*
+X60000000Y10000000D03*
+D11*
+X0Y0D02*
+X5000000Y0D01*
+M02*
+"""
+
+
+@pytest.fixture
+def gerber(tmp_path):
+    def parse(text):
+        f = tmp_path / 'layer.gbr'
+        f.write_text(text)
+        p = GerberParser()
+        return p.parse_file(str(f)), p.buffer.data
+    return parse
+
+
+def test_macro_apertures_are_skipped(gerber):
+    ok, obs = gerber(KICAD)
+    assert ok
+    flashes = [o for o in obs if o[0] == 'F']
+    # The RoundRect macro and the rectangle lacking its height are skipped
+    assert [o[3] for o in flashes] == [20.0, 30.0, 40.0, 50.0]
+
+
+def test_standard_apertures(gerber):
+    ok, obs = gerber(KICAD)
+    assert ok
+    aps = {o[3]: o[2] for o in obs if o[0] == 'F'}
+    assert aps[20.0] == ('C', 0.8)
+    assert aps[30.0] == ('R', 1.5, 0.6)
+    assert aps[40.0] == ('O', 1.0, 2.0)
+    assert aps[50.0] == ('C', 1.2)
+    lines = [o for o in obs if o[0] == 'L']
+    assert lines == [('L', True, ('C', 0.8), 0.0, 0.0, 5.0, 0.0)]
+
+
+def test_inch_apertures(gerber):
+    ok, obs = gerber('%FSLAX24Y24*%\n%MOIN*%\n%ADD10C,0.0100*%\nD10*\nX10000Y0D03*\nM02*\n')
+    assert ok
+    assert obs[0][2] == ('C', pytest.approx(0.254))
+    assert obs[0][3] == pytest.approx(25.4)
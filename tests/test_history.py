@@ -0,0 +1,51 @@
+from pmu_planner import *
+
+import pmu_planner
+
+
+def points(n=300) -> GridBuffer:
+    g = GridBuffer()
+    g.data = [[float(i), float(i % 7), 0.0] for i in range(n)]
+    return g
+
+
+def test_restored_points_are_copies():
+    h = BufferHistory()
+    g = points()
+    h.push(g, 'grid')
+    g.data[0][2] = 1.0
+    b, desc = h.restore()
+    assert desc == 'grid' and b is not g
+    assert b.data[0] == [0.0, 0.0, 0.0]
+    b.data[1][2] = 2.0
+    assert h.restore()[0].data[1] == [1.0, 1.0, 0.0]
+
+
+def test_versions_share_chunks():
+    h = BufferHistory()
+    g = GCodeBuffer()
+    g.data = [(1, None, float(i), 0.0, -0.1) for i in range(2000)]
+    h.push(g, 'a')
+    size = h.bytes
+    g2 = GCodeBuffer()
+    g2.data = list(g.data)
+    g2.data[1000] = 'M00\n'
+    h.push(g2, 'b')
+    assert size < h.bytes < size * 1.2
+    assert h.diff(0, 1) == [(1000, 1001, 1000, 1001)]
+    assert h.undo() and h.restore()[0].data == g.data
+
+
+def test_colliding_chunks_are_keyed_by_contents(monkeypatch):
+    # Every block hashes alike: each is a chunk of its own, all sharing one hash
+    monkeypatch.setattr(pmu_planner, 'hash', lambda bl: 0, raising=False)
+    h = BufferHistory()
+    g = GCodeBuffer()
+    g.data = ['G21\n', (0, None, 1.0, 2.0, 3.0), 'M05\n', (0, None, 1.0, 2.0, 3.0)]
+    h.push(g, 'a')
+    size = h.bytes
+    g2 = GCodeBuffer()
+    g2.data = list(g.data)
+    h.push(g2, 'b')
+    assert h.bytes == size and h.entries == [('b', 'GCodeBuffer', 4)]
+    assert h.restore()[0].data == g.data
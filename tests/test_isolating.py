@@ -0,0 +1,45 @@
+from pmu_planner import *
+
+import numpy as np
+import pytest
+
+
+def pad(r=0.65, x=1.0, y=1.0) -> GerberBuffer:
+    g = GerberBuffer()
+    g.data = [('F', True, ('C', 2.0 * r), x, y)]
+    return g
+
+
+def test_contour_offsets_a_round_pad():
+    iso = Isolating()
+    assert iso.run_isolation(pad())
+    (c,), = iso.contours
+    r = np.hypot(np.asarray(c)[:, 0] - 1.0, np.asarray(c)[:, 1] - 1.0)
+    # Within the documented bound of the raster
+    tol = 0.86 * iso[iso.pt.iso_res] + iso[iso.pt.arc_tol]
+    assert np.abs(r - (0.65 + iso[iso.pt.iso_tool] / 2.0)).max() <= tol
+
+
+def test_spindle_runs_while_cutting():
+    iso = Isolating()
+    assert iso.run_isolation(pad())
+    out = iso.isoGCode.data
+    start = out.index('M03 S{:g}\n'.format(iso[iso.pt.iso_speed]))
+    cuts = [k for k, bl in enumerate(out) if type(bl) is tuple and bl[0] == 1]
+    assert start < cuts[0] and out[-1] == 'M05\n'
+
+
+def test_raster_memory_is_capped():
+    iso = Isolating()
+    iso[iso.pt.iso_mem] = 1
+    board = pad()
+    board.data = board.data + pad(x=50.0, y=50.0).data
+    with pytest.raises(ValueError, match='iso_mem'):
+        iso.run_isolation(board)
+
+
+def test_coarse_raster_warns(caplog):
+    iso = Isolating()
+    iso[iso.pt.iso_res] = 0.05
+    assert iso.run_isolation(pad())
+    assert 'coarse' in caplog.text
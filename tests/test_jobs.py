@@ -0,0 +1,65 @@
+from pmu_jobs import *
+from pmu_log import getLogger, console
+
+import logging
+import pytest
+import sys
+import io
+
+
+def test_manager_leaves_stdout_alone_until_a_job_starts():
+    out = sys.stdout
+    jm = JobManager()
+    assert sys.stdout is out
+    try:
+        j = jm.start('echo', lambda args: print(*args), ['hello'])
+        j.join()
+        assert isinstance(sys.stdout, JobStdout)
+        assert j.state == 'done'
+        assert j.read_output() == 'hello\n'
+    finally:
+        jm.shutdown()
+    assert sys.stdout is out
+
+
+def test_shutdown_cancels_running_jobs():
+    def loop(args):
+        while True:
+            progress(0)
+    jm = JobManager()
+    j = jm.start('loop', loop, [])
+    jm.shutdown()
+    assert not j.running and j.state == 'cancelled'
+
+
+@pytest.fixture
+def console_stream():
+    root = logging.getLogger('pmu')
+    handlers, level = list(root.handlers), root.level
+    s = io.StringIO()
+    console('info', s)
+    yield s
+    root.handlers[:] = handlers
+    root.setLevel(level)
+
+
+def test_console_has_its_own_stream(console_stream):
+    log = getLogger('test')
+    jm = JobManager()
+    jm.install()
+    try:
+        log.info('main {}', 1)
+        assert console_stream.getvalue() == 'main 1\n'
+        j = jm.start('log', lambda args: log.info('job {}', 2), [])
+        j.join()
+        assert j.read_output() == 'job 2\n'
+        out = io.StringIO()
+        redirect_output(out)
+        try:
+            log.info('served {}', 3)
+        finally:
+            redirect_output(None)
+        assert out.getvalue() == 'served 3\n'
+    finally:
+        jm.shutdown()
+    assert console_stream.getvalue() == 'main 1\n'
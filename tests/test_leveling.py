@@ -0,0 +1,83 @@
+from pmu_planner import *
+
+import numpy as np
+import pytest
+
+
+def plane(x, y):
+    return 0.01 * x - 0.005 * y + 0.02
+
+
+def grid_hmap(nx=5, ny=5, f=plane) -> HMapBuffer:
+    h = HMapBuffer()
+    h.data = [(float(x), float(y), float(f(x, y)))
+              for x in np.linspace(0.0, 40.0, nx) for y in np.linspace(0.0, 30.0, ny)]
+    return h
+
+
+def test_grid_surface_reproduces_points():
+    h = grid_hmap(f=lambda x, y: 0.001 * x * y)
+    s = HeightmapSurface(list(h))
+    assert s.gridded
+    for x, y, z in h:
+        assert s(x, y) == pytest.approx(z, abs=1e-12)
+
+
+def test_scattered_surface_reproduces_points():
+    pts = list(grid_hmap())
+    pts[6] = (pts[6][0] + 0.7, pts[6][1] - 0.4, plane(pts[6][0] + 0.7, pts[6][1] - 0.4))
+    s = HeightmapSurface(pts)
+    assert not s.gridded
+    assert s(pts[6][0], pts[6][1]) == pytest.approx(pts[6][2], abs=1e-12)
+    assert s(21.3, 12.9) == pytest.approx(plane(21.3, 12.9), abs=1e-6)
+
+
+def test_surface_is_flat_outside_the_grid():
+    s = HeightmapSurface(list(grid_hmap()))
+    assert s(-10.0, 15.0) == pytest.approx(plane(0.0, 15.0))
+    assert s(55.0, 45.0) == pytest.approx(plane(40.0, 30.0))
+
+
+def test_surface_needs_two_ticks_per_axis():
+    with pytest.raises(ValueError):
+        HeightmapSurface([(0.0, 0.0, 0.0), (1.0, 0.0, 0.0), (2.0, 0.0, 0.0)])
+
+
+def test_level_buffer_end_to_end():
+    g = GCodeBuffer()
+    g.data = ['G21\n', (0, None, 1.0, 1.0, 2.0), (1, 100.0, None, None, -0.1),
+              (1, None, 39.0, 1.0, None), (1, None, 39.0, 29.0, None), (0, None, None, None, 2.0), 'M05\n']
+    lvl = Leveling()
+    lvl[lvl.pt.lvl_procs] = 1
+    assert lvl.run_leveling(g, grid_hmap())
+    out = lvl.leveledGCode.data
+    assert out[0] == 'G21\n' and out[-1] == 'M05\n'
+    moves = [bl for bl in out if type(bl) is tuple]
+    # The plane changes by 0.38 mm along the first cut: points are added every zthreshold
+    assert len(moves) > len(g.data) - 2
+    for bl in moves:
+        orig = 2.0 if bl[0] == 0 else -0.1
+        assert bl[4] == pytest.approx(orig + plane(bl[2], bl[3]), abs=2e-4)
+
+
+def test_parallel_leveling_matches_serial():
+    rng = np.random.default_rng(3)
+    g = GCodeBuffer()
+    data = ['G21\n', (0, None, 0.0, 0.0, 2.0), (1, 100.0, None, None, -0.1)]
+    for k, (x, y) in enumerate(rng.random((3000, 2)) * [40.0, 30.0]):
+        data.append((1, None, round(float(x), 4), round(float(y), 4), None))
+        if k % 500 == 0:
+            data.append('(pass {})\n'.format(k))
+    data += [(0, None, None, None, 2.0), 'M05\n']
+    g.data = data
+    h = grid_hmap(6, 5, lambda x, y: 0.0004 * (x - 20.0) ** 2 - 0.003 * y)
+
+    serial = Leveling()
+    serial[serial.pt.lvl_procs] = 1
+    assert serial.run_leveling(g, h)
+    parallel = Leveling()
+    parallel[parallel.pt.lvl_procs] = 3
+    parallel.parallelMin = 0
+    assert parallel.run_leveling(g, h)
+    assert parallel.report['cache_misses'] == 0  # leveled by the workers
+    assert parallel.leveledGCode.data == serial.leveledGCode.data
@@ -0,0 +1,48 @@
+from pmu_planner import *
+
+import numpy as np
+import pytest
+
+
+def surface(x, y):
+    return 0.002 * x - 0.003 * y + 0.01
+
+
+def planner() -> pmuPlanner:
+    p = pmuPlanner()
+    m = p.Mesher
+    m[m.pt.mesh_size] = [3, 2]
+    m[m.pt.mesh_lims] = [0.0, 40.0, 0.0, 30.0]
+    return p
+
+
+def buffers():
+    h = HMapBuffer()
+    h.data = [(float(x), float(y), surface(x, y)) for x in np.linspace(0.0, 40.0, 5) for y in np.linspace(0.0, 30.0, 5)]
+    g = GCodeBuffer()
+    g.data = ['G21\n', (0, None, 1.0, 1.0, 2.0), (1, 100.0, 10.0, 10.0, -0.1), 'M05\n']
+    return g, h
+
+
+@pytest.mark.parametrize('fw, cmd', [('marlin_abl', 'M421'), ('marlin_mbl', 'G29 S3')])
+def test_mesh_preamble(fw, cmd):
+    p = planner()
+    p.Mesher[p.Mesher.pt.mesh_fw] = fw
+    g, h = buffers()
+    assert p.meshing_run(g, h)
+    out = p.buffer.data
+    nodes = [l for l in out if type(l) is str and l.startswith(cmd)]
+    assert len(nodes) == 6
+    for i, x in enumerate([0.0, 20.0, 40.0]):
+        for j, y in enumerate([0.0, 30.0]):
+            assert '{} I{} J{} Z{}\n'.format(cmd, i, j, round(surface(x, y), 4) + 0.0) in nodes
+    # Leveling enabled, then the program unmodified
+    k = out.index('M420 S1 Z0\n')
+    assert out[k + 1:] == g.data
+
+
+def test_unknown_firmware_fails():
+    p = planner()
+    p.Mesher[p.Mesher.pt.mesh_fw] = 'grbl'
+    g, h = buffers()
+    assert not p.meshing_run(g, h)
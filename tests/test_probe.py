@@ -0,0 +1,81 @@
+from pmu_probe import *
+
+import pytest
+
+
+class FakeMachine(object):
+    """ Probes the plane z = 0.01 x - 0.02 y, failing after `fail` points if given. """
+    def __init__(self, fail=None):
+        self.probed = []
+        self.fail = fail
+
+    def probe(self, x, y, depth, feed, clear):
+        if self.fail is not None and len(self.probed) == self.fail:
+            raise RuntimeError('probe not triggered')
+        self.probed.append((x, y))
+        return 0.01 * x - 0.02 * y
+
+
+def grid(n=4) -> GridBuffer:
+    g = GridBuffer()
+    g.data = [[float(x), float(y)] for x in range(n) for y in range(n)]
+    return g
+
+
+def prober() -> Probing:
+    p = Probing()
+    p[p.pt.probe_lims] = [0.0, 3.0, 0.0, 3.0]
+    p[p.pt.probe_tick] = [4, 4]
+    return p
+
+
+def test_interrupted_run_resumes(tmp_path):
+    hmap = str(tmp_path / 'hmap.csv')
+    with pytest.raises(RuntimeError):
+        prober().run_probing(grid(), hmap, machine=FakeMachine(fail=5))
+    session, points = ProbeLog(hmap).read()
+    assert list(points) == [0, 1, 2, 3, 4]
+    assert not os.path.exists(hmap)
+
+    p = prober()
+    m = FakeMachine()
+    assert p.run_probing(grid(), hmap, machine=m)
+    assert p.resumed == 5 and len(m.probed) == 11
+    assert p.probedHMap.size == 16
+    assert not os.path.exists(ProbeLog(hmap).path)
+    with open(hmap) as fd:
+        rows = [[float(i) for i in l.split(',')] for l in fd]
+    assert rows[5] == pytest.approx([1.0, 1.0, -0.01])
+
+
+def test_torn_last_line_is_dropped(tmp_path):
+    hmap = str(tmp_path / 'hmap.csv')
+    with pytest.raises(RuntimeError):
+        prober().run_probing(grid(), hmap, machine=FakeMachine(fail=3))
+    plog = ProbeLog(hmap)
+    with open(plog.path, 'a') as fd:
+        fd.write('3,0.0,3.0,-0.0')  # interrupted while writing
+    assert list(plog.read()[1]) == [0, 1, 2]
+
+    # Appending after the torn line starts on a line of its own
+    plog.open(plog.read()[0])
+    plog.append(3, 0.0, 3.0, -0.06)
+    plog.close()
+    assert plog.read()[1][3] == (0.0, 3.0, -0.06)
+
+    m = FakeMachine()
+    p = prober()
+    assert p.run_probing(grid(), hmap, machine=m)
+    assert p.resumed == 4 and len(m.probed) == 12
+
+
+def test_other_session_starts_over(tmp_path):
+    hmap = str(tmp_path / 'hmap.csv')
+    with pytest.raises(RuntimeError):
+        prober().run_probing(grid(), hmap, machine=FakeMachine(fail=3))
+    p = prober()
+    p[p.pt.probe_tick] = [3, 3]
+    m = FakeMachine()
+    assert p.run_probing(grid(3), hmap, machine=m)
+    assert p.resumed == 0 and len(m.probed) == 9
+    assert os.path.exists(ProbeLog(hmap).path + '.old')
@@ -0,0 +1,71 @@
+from pmu_parsers import GCodeParser
+from pmu_planner import *
+
+import numpy as np
+import pytest
+
+
+PROGRAM = """G21 G90
+G00 X0 Y0 Z5 M00
+G01 Z-0.1 F100
+G01 X30 Y0 S1000
+G01 X30 Y20
+G00 Z5
+"""
+
+
+@pytest.fixture
+def program(tmp_path) -> GCodeBuffer:
+    f = tmp_path / 'in.nc'
+    f.write_text(PROGRAM)
+    p = GCodeParser()
+    assert p.parse_file(str(f))
+    return p.buffer
+
+
+def resumed(buff, line) -> list:
+    r = Resuming()
+    assert r.run_resume(buff, line)
+    return r.resumedGCode.data
+
+
+def test_resumes_at_source_lines(program):
+    # Lines 2 and 4 gave two entries each: a stop after the block, a prefix before it
+    assert len(program.data) == len(PROGRAM.splitlines()) + 2
+    out = resumed(program, 5)
+    assert out[-2:] == [(1, None, 30.0, 20.0, None), (0, None, None, None, 5.0)]
+    assert (1, None, 30.0, 0.0, None) not in out
+    out = resumed(program, 4)
+    assert out[-4:-2] == ['S1000 ', (1, None, 30.0, 0.0, None)]
+
+
+def test_buffers_without_source_lines_resume_at_buffer_lines(program):
+    g = GCodeBuffer()
+    g.data = list(program.data)
+    assert resumed(g, 5)[-3:] == program.data[-3:]
+
+
+def test_plunge_without_program_feed():
+    g = GCodeBuffer()
+    g.data = ['G21\n', (0, None, 0.0, 0.0, 5.0), (1, None, 10.0, 0.0, -0.1), (1, 100.0, 10.0, 10.0, -0.1)]
+    r = Resuming()
+    r[r.pt.resume_feed] = 40.0
+    assert r.run_resume(g, 4)
+    plunge = [bl for bl in r.resumedGCode.data if type(bl) is tuple and bl[0] == 1][0]
+    assert plunge[1] == 40.0 and plunge[4] == -0.1
+
+
+def test_leveled_program_resumes_at_source_lines(program):
+    h = HMapBuffer()
+    h.data = [(float(x), float(y), 0.01 * x) for x in np.linspace(0.0, 40.0, 5) for y in np.linspace(0.0, 30.0, 5)]
+    lvl = Leveling()
+    lvl[lvl.pt.lvl_procs] = 1
+    assert lvl.run_leveling(program, h)
+    leveled = lvl.leveledGCode
+    starts = leveled.source_lines()
+    assert len(starts) == len(PROGRAM.splitlines())
+    # The cut along X was split into several leveled pieces
+    assert starts[4] - starts[3] > 2
+    out = resumed(leveled, 5)
+    assert out[-len(leveled.data) + starts[4]:] == leveled.data[starts[4]:]
+    assert out[-2][2:4] == (30.0, 20.0)
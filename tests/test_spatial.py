@@ -0,0 +1,54 @@
+from pmu_spatial import nn_tour, two_opt
+
+import numpy as np
+import pytest
+
+
+def travel(start, entries, exits, order, flipped) -> float:
+    """ Length of the moves between items, visiting them in order. """
+    pos, t = np.asarray(start, dtype=float), 0.0
+    for g in order:
+        a, b = (exits[g], entries[g]) if flipped[g] else (entries[g], exits[g])
+        t += np.hypot(*(a - pos))
+        pos = b
+    return t
+
+
+def test_two_opt_untangles_a_crossing():
+    pts = np.array([[1.0, 0.0], [2.0, 1.0], [2.0, 0.0], [3.0, 1.0]])
+    order, flipped, gain = two_opt([0.0, 0.0], pts, pts, [0, 1, 2, 3], np.zeros(4, bool), np.ones(4, bool))
+    assert sorted(order.tolist()) == [0, 1, 2, 3]
+    assert gain > 0
+    assert travel([0.0, 0.0], pts, pts, order, flipped) == pytest.approx(
+        travel([0.0, 0.0], pts, pts, [0, 1, 2, 3], np.zeros(4, bool)) - gain)
+    assert order.tolist() == [0, 2, 1, 3]
+
+
+def test_two_opt_improves_nearest_neighbour_tours():
+    rng = np.random.default_rng(1)
+    pts = rng.uniform(0.0, 100.0, (300, 2))
+    flippable = np.ones(300, bool)
+    order, flipped = nn_tour([0.0, 0.0], pts, pts, flippable)
+    before = travel([0.0, 0.0], pts, pts, order, flipped)
+    order2, flipped2, gain = two_opt([0.0, 0.0], pts, pts, order, flipped, flippable)
+    assert sorted(order2.tolist()) == list(range(300))
+    assert gain > 0
+    assert travel([0.0, 0.0], pts, pts, order2, flipped2) == pytest.approx(before - gain)
+
+
+def test_two_opt_keeps_the_direction_of_fixed_items():
+    rng = np.random.default_rng(2)
+    entries = rng.uniform(0.0, 50.0, (60, 2))
+    exits = entries + rng.uniform(-5.0, 5.0, (60, 2))
+    flippable = np.arange(60) % 3 != 0
+    order, flipped = nn_tour([0.0, 0.0], entries, exits, flippable)
+    before = travel([0.0, 0.0], entries, exits, order, flipped)
+    order2, flipped2, gain = two_opt([0.0, 0.0], entries, exits, order, flipped, flippable)
+    assert not flipped2[~flippable].any()
+    assert travel([0.0, 0.0], entries, exits, order2, flipped2) == pytest.approx(before - gain)
+
+
+def test_two_opt_without_flippable_items_keeps_the_tour():
+    pts = np.array([[1.0, 0.0], [2.0, 1.0], [2.0, 0.0], [3.0, 1.0]])
+    order, flipped, gain = two_opt([0.0, 0.0], pts, pts + 0.5, [0, 1, 2, 3], np.zeros(4, bool), np.zeros(4, bool))
+    assert order.tolist() == [0, 1, 2, 3] and not flipped.any() and gain == 0.0
@@ -0,0 +1,48 @@
+from pmu_watch import FileWatcher
+
+import threading
+import time
+import os
+import pytest
+
+
+@pytest.fixture(params=[False, True], ids=['inotify', 'poll'])
+def watched(request, tmp_path):
+    path = tmp_path / 'board.nc'
+    path.write_text('G21\n')
+    other = tmp_path / 'other.nc'
+    w = FileWatcher([str(path)], debounce=0.2, interval=0.02, poll=request.param)
+    yield w, path, other
+    w.close()
+
+
+def write_slowly(path, chunks=6, gap=0.05):
+    with open(path, 'a') as fd:
+        for _ in range(chunks):
+            time.sleep(gap)
+            fd.write('G01 X1 Y1\n')
+            fd.flush()
+
+
+def test_chunked_write_is_reported_once_settled(watched):
+    w, path, _ = watched
+    t = threading.Thread(target=write_slowly, args=(path,))
+    t.start()
+    changed = w.wait(timeout=5.0)
+    t.join()
+    assert changed == [str(path)]
+    assert path.read_text().count('\n') == 7
+    assert w.wait(timeout=0.3) == []
+
+
+def test_replacing_rename_is_reported(watched):
+    w, path, other = watched
+    other.write_text('G21\nG00 X0 Y0\n')
+    os.replace(str(other), str(path))
+    assert w.wait(timeout=5.0) == [str(path)]
+
+
+def test_other_files_are_ignored(watched):
+    w, _, other = watched
+    other.write_text('G21\n')
+    assert w.wait(timeout=0.3) == []